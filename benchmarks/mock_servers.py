@@ -0,0 +1,406 @@
+"""Local stand-ins for the Porkbun v3 JSON API, Shlink REST v2 and the lyrics API.
+
+Only the endpoints used by utilcli are implemented, with enough fidelity to exercise
+the command paths. Every server counts requests and accepted connections so the
+benchmark can report how many round trips and handshakes a command needs.
+
+Run directly to keep the servers up for manual testing:
+
+    python benchmarks/mock_servers.py --latency 0.05
+"""
+from datetime import datetime, timedelta
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "mock"
+    # Headers and body are written separately, with Nagle on every response would stall on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _send_chunked(self, status, chunks, content_type, cache_control=None):
+        # Streams an iterable of str chunks with chunked transfer encoding, flushing each as it is produced
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+        for chunk in chunks:
+            data = chunk.encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send(self, status, body=None, content_type="application/json", cache_control=None):
+        if body is not None and not isinstance(body, (str, dict, list)):
+            return self._send_chunked(status, body, content_type, cache_control)
+        data = b""
+        if body is not None:
+            data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        if cache_control and status == 200:
+            # Validator for conditional requests, a matching If-None-Match gets an empty 304
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+            if self.headers.get("If-None-Match") == etag:
+                status, data = 304, b""
+            self.send_response(status)
+            self.send_header("Cache-Control", cache_control)
+            self.send_header("ETag", etag)
+        else:
+            self.send_response(status)
+        if data:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        with self.server.stats.lock:
+            self.server.stats.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self._body()
+        status, payload, content_type = self.server.app.handle(method, url.path, query, body, self.headers)
+        # Only the lyrics API sends caching headers
+        cache_control = getattr(self.server.app, "cache_control", None)
+        cache_control = cache_control(url.path) if cache_control and method == "GET" else None
+        self._send(status, payload, content_type, cache_control)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class PorkbunApp:
+    def __init__(self, domain="example.com", zone_size=50, txt_records=0, domain_count=1):
+        # Extra domains are example1.com, example2.com, ... with the same zone layout
+        self.domain = domain
+        self.domains = [domain] + [domain.replace(".", f"{n}.", 1) for n in range(1, domain_count)]
+        self.lock = threading.Lock()
+        self.next_id = 1000
+        self.records = {}
+        for domain in self.domains:
+            for i in range(zone_size):
+                self.add(f"host{i}.{domain}", "A", f"10.0.{i // 250}.{i % 250}", "600")
+            # ACME challenges and DKIM keys, the bulk of large real-world zones
+            for i in range(txt_records):
+                if i % 2:
+                    self.add(f"sel{i}._domainkey.{domain}", "TXT", "v=DKIM1; k=rsa; p=" + "A" * 392, "600")
+                else:
+                    self.add(f"_acme-challenge.host{i}.{domain}", "TXT", "x" * 43, "120")
+            self.add(domain, "NS", "curitiba.ns.porkbun.com", "86400")
+
+    def add(self, name, type, content, ttl, prio="0"):
+        with self.lock:
+            self.next_id += 1
+            rid = str(self.next_id)
+            self.records[rid] = {
+                "id": rid,
+                "name": name,
+                "type": type,
+                "content": content,
+                "ttl": str(ttl),
+                "prio": str(prio),
+                "notes": "",
+            }
+            return rid
+
+    def handle(self, method, path, query, body, headers):
+        if not body.get("apikey") or not body.get("secretapikey"):
+            return 200, {"status": "ERROR", "message": "Invalid API key."}, "application/json"
+        m = re.match(r"^/api/json/v3/dns/(\w+)/([^/]+)(?:/(\w+))?$", path)
+        if not m:
+            return 404, {"status": "ERROR", "message": "Not found"}, "application/json"
+        action, domain, rid = m.groups()
+        if domain not in self.domains:
+            return 200, {"status": "ERROR", "message": "Invalid domain."}, "application/json"
+        if action == "retrieve":
+            with self.lock:
+                records = [x for x in self.records.values() if x["name"] == domain or x["name"].endswith(f".{domain}")]
+            return 200, {"status": "SUCCESS", "cloudflare": "enabled", "records": records}, "application/json"
+        if action == "create":
+            name = f'{body["name"]}.{domain}' if body.get("name") else domain
+            rid = self.add(name, body["type"], body["content"], body.get("ttl", 600), body.get("prio", 0))
+            return 200, {"status": "SUCCESS", "id": int(rid)}, "application/json"
+        if action == "edit":
+            with self.lock:
+                if rid not in self.records:
+                    return 200, {"status": "ERROR", "message": "Invalid record ID."}, "application/json"
+                name = f'{body["name"]}.{domain}' if body.get("name") else domain
+                self.records[rid].update(
+                    name=name, type=body["type"], content=body["content"], ttl=str(body.get("ttl", 600))
+                )
+            return 200, {"status": "SUCCESS"}, "application/json"
+        if action == "delete":
+            with self.lock:
+                if self.records.pop(rid, None) is None:
+                    return 200, {"status": "ERROR", "message": "Invalid record ID."}, "application/json"
+            return 200, {"status": "SUCCESS"}, "application/json"
+        return 404, {"status": "ERROR", "message": "Not found"}, "application/json"
+
+
+class ShlinkApp:
+    def __init__(self, domains=("s.example.com", "arv.cx"), url_count=50):
+        self.domains = list(domains)
+        self.lock = threading.Lock()
+        self.urls = {}
+        self.visits = {}
+        for i in range(url_count):
+            self.create(f"https://example.org/page/{i}", f"code{i}", self.domains[0])
+
+    def create(self, long_url, code, domain):
+        with self.lock:
+            key = (domain, code)
+            if key in self.urls:
+                return None
+            entry = {
+                "shortCode": code,
+                "shortUrl": f"https://{domain}/{code}",
+                "longUrl": long_url,
+                "dateCreated": (datetime(2024, 1, 1) + timedelta(hours=len(self.urls))).isoformat() + "+00:00",
+                "visitsCount": 3,
+                "tags": ["campaign"] if code.endswith("0") else [],
+                "domain": None if domain == self.domains[0] else domain,
+                "title": None,
+                "crawlable": False,
+            }
+            self.urls[key] = entry
+            self.visits[key] = [
+                {
+                    "referer": "",
+                    "date": f"2024-01-0{d + 1}T10:00:00+00:00",
+                    "userAgent": f"agent-{d}",
+                    "visitLocation": None,
+                    "potentialBot": False,
+                }
+                for d in range(3)
+            ]
+            return entry
+
+    def _error(self, status, title, detail):
+        return status, {"type": title.upper().replace(" ", "_"), "title": title, "detail": detail, "status": status}
+
+    def handle(self, method, path, query, body, headers):
+        ct = "application/json"
+        if headers.get("X-Api-Key") is None:
+            return (*self._error(401, "Invalid API key", "Provided API key does not exist"), ct)
+        if path == "/rest/v2/domains" and method == "GET":
+            data = [{"domain": d, "isDefault": i == 0} for i, d in enumerate(self.domains)]
+            return 200, {"domains": {"data": data}}, ct
+        if path == "/rest/v2/short-urls":
+            if method == "POST":
+                domain = body.get("domain") or self.domains[0]
+                code = body.get("customSlug") or f"gen{len(self.urls)}"
+                if body.get("findIfExists"):
+                    with self.lock:
+                        existing = [
+                            x
+                            for (d, c), x in self.urls.items()
+                            if d == domain and x["longUrl"] == body["longUrl"] and c == body.get("customSlug", c)
+                        ]
+                    if existing:
+                        return 200, existing[0], ct
+                entry = self.create(body["longUrl"], code, domain)
+                if entry is None:
+                    return (*self._error(400, "Invalid custom slug", f'Provided slug "{code}" is in use.'), ct)
+                return 200, entry, ct
+            if method == "GET":
+                page = int(query.get("page", ["1"])[0])
+                per_page = int(query.get("itemsPerPage", ["10"])[0])
+                with self.lock:
+                    items = list(self.urls.values())
+                tags = query.get("tags[]")
+                if tags:
+                    match = all if query.get("tagsMode", ["any"])[0] == "all" else any
+                    items = [x for x in items if match(t in x["tags"] for t in tags)]
+                if "domain" in query:
+                    domain = query["domain"][0]
+                    items = [x for x in items if (x["domain"] or "DEFAULT") == domain]
+                if "startDate" in query:
+                    items = [x for x in items if x["dateCreated"] >= query["startDate"][0]]
+                if "endDate" in query:
+                    items = [x for x in items if x["dateCreated"] <= query["endDate"][0]]
+                pages = max(1, -(-len(items) // per_page))
+                data = items[(page - 1) * per_page : page * per_page]
+                pagination = {
+                    "currentPage": page,
+                    "pagesCount": pages,
+                    "itemsPerPage": per_page,
+                    "itemsInCurrentPage": len(data),
+                    "totalItems": len(items),
+                }
+                return 200, {"shortUrls": {"data": data, "pagination": pagination}}, ct
+        m = re.match(r"^/rest/v2/short-urls/([^/]+)(/visits)?$", path)
+        if m:
+            code, visits = m.groups()
+            domain = query.get("domain", [self.domains[0]])[0]
+            key = (domain, code)
+            with self.lock:
+                entry = self.urls.get(key)
+                if entry is None:
+                    return (*self._error(404, "Short URL not found", f'No URL found with short code "{code}"'), ct)
+                if visits:
+                    data = self.visits[key]
+                    start = query.get("startDate", [None])[0]
+                    if start:
+                        data = [v for v in data if v["date"] >= start]
+                    pagination = {"currentPage": 1, "pagesCount": 1, "itemsPerPage": len(data)}
+                    return 200, {"visits": {"data": data, "pagination": pagination}}, ct
+                if method == "GET":
+                    return 200, entry, ct
+                if method == "PATCH":
+                    entry["longUrl"] = body.get("longUrl", entry["longUrl"])
+                    return 200, entry, ct
+                if method == "DELETE":
+                    del self.urls[key]
+                    return 204, None, ct
+        return (*self._error(404, "Not found", path), ct)
+
+
+class LyricsApp:
+    PROVIDERS = ("ln", "genius", "al")
+
+    def __init__(self, result_count=5, provider_latency=None, lyrics_lines=40, line_delay=0.0, ndjson=False):
+        self.result_count = result_count
+        self.provider_latency = provider_latency or {}
+        self.lyrics_lines = lyrics_lines
+        # With a delay lyrics are streamed line by line, like a provider that's slow to scrape
+        self.line_delay = line_delay
+        # Whether searches can answer with one NDJSON result per line, per provider as each one finishes
+        self.ndjson = ndjson
+
+    def _search_stream(self, providers):
+        elapsed = 0
+        for p in sorted(providers, key=lambda x: self.provider_latency.get(x, 0)):
+            time.sleep(max(self.provider_latency.get(p, 0) - elapsed, 0))
+            elapsed = max(elapsed, self.provider_latency.get(p, 0))
+            for i in range(self.result_count):
+                yield json.dumps({"title": f"Song {i}", "artist": f"Artist {i % 3}", "provider": p}) + "\n"
+
+    def _lyrics_stream(self, index):
+        for n in range(self.lyrics_lines):
+            time.sleep(self.line_delay)
+            yield f"{chr(10) if n else ''}[{index}] line {n} la la la"
+
+    def cache_control(self, path):
+        # Searches are revalidated every time, lyrics are fresh for an hour
+        return "max-age=3600" if re.match(r"^/api/lyrics/\d+$", path) else "no-cache"
+
+    def handle(self, method, path, query, body, headers):
+        providers = query.get("p") or list(self.PROVIDERS)
+        if path == "/api/lyrics":
+            if self.ndjson and "application/x-ndjson" in (headers.get("Accept") or ""):
+                return 200, self._search_stream(providers), "application/x-ndjson"
+            time.sleep(max([self.provider_latency.get(p, 0) for p in providers] or [0]))
+            results = [
+                {"title": f"Song {i}", "artist": f"Artist {i % 3}", "provider": p}
+                for p in providers
+                for i in range(self.result_count)
+            ]
+            return 200, {"status": "OK", "results": results}, "application/json"
+        m = re.match(r"^/api/lyrics/(\d+)$", path)
+        if m:
+            index = int(m.group(1))
+            if self.line_delay:
+                return 200, self._lyrics_stream(index), "text/plain; charset=utf-8"
+            text = "\n".join(f"[{index}] line {n} la la la" for n in range(self.lyrics_lines))
+            return 200, text, "text/plain; charset=utf-8"
+        return 404, {"status": "ERROR", "message": "Not found"}, "application/json"
+
+
+def serve(app, latency=0.0, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.app = app
+    server.latency = latency
+    server.stats = Stats()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the mock APIs until interrupted")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--zone-size", type=int, default=50)
+    parser.add_argument("--txt-records", type=int, default=0)
+    parser.add_argument("--domains", type=int, default=1)
+    parser.add_argument("--url-count", type=int, default=50)
+    args = parser.parse_args()
+
+    porkbun = serve(
+        PorkbunApp(zone_size=args.zone_size, txt_records=args.txt_records, domain_count=args.domains),
+        latency=args.latency,
+    )
+    shlink = serve(ShlinkApp(url_count=args.url_count), latency=args.latency)
+    lyrics = serve(LyricsApp(), latency=args.latency)
+    print(json.dumps(mock_config(porkbun, shlink, lyrics), indent=4))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+def mock_config(porkbun, shlink, lyrics):
+    # A config.json pointing utilcli at the given mock servers
+    return {
+        "porkbun": {
+            "API_KEY": "pk1_mock",
+            "SECRET_KEY": "sk1_mock",
+            "DOMAIN": porkbun.app.domain if len(porkbun.app.domains) == 1 else porkbun.app.domains,
+            "SERVER_IP": "192.0.2.10",
+            "API_URL": f"http://127.0.0.1:{porkbun.server_port}/api/json/v3",
+        },
+        "shlink": {
+            "DOMAIN": shlink.app.domains[0],
+            "API_KEY": "mock",
+            "API_URL": f"http://127.0.0.1:{shlink.server_port}/rest/v2",
+        },
+        "utilapi": {"HOST": "http://127.0.0.1", "PORT": str(lyrics.server_port), "PREFETCH": 3},
+    }
+
+
+if __name__ == "__main__":
+    main()
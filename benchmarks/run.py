@@ -0,0 +1,186 @@
+"""Benchmark every util command against local mock servers.
+
+Starts the mock Porkbun, Shlink and lyrics servers from mock_servers.py, points a
+temporary config at them and runs each scenario in a fresh interpreter. For every
+scenario it reports the median wall time, the HTTP requests and TCP connections
+the servers saw, and the peak RSS of the CLI process:
+
+    python benchmarks/run.py --latency 0.05 --zone-size 2000
+    python benchmarks/run.py --filter shlink --repeat 5 --json
+"""
+from mock_servers import LyricsApp, PorkbunApp, ShlinkApp, mock_config, serve
+from pathlib import Path
+import multiprocessing
+import statistics
+import subprocess
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+
+ENTRYPOINT = "import sys; sys.argv[0] = 'util'; from utilcli.daemon import main; main()"
+SOURCE = Path(__file__).resolve().parent.parent
+
+
+def scenarios(workdir: Path):
+    # (name, argv for run i, stdin)
+    zone_file, bulk_file = workdir / "zone.txt", workdir / "bulk.csv"
+    zone_file.write_text(
+        "$TTL 600\n"
+        + "".join(f"host{i} IN A 10.0.{i // 250}.{i % 250}\n" for i in range(0, 40, 2))
+        + "www IN CNAME host0\n"
+    )
+
+    def bulk(i):
+        bulk_file.write_text("".join(f"https://example.org/bulk/{i}/{n},bulk{i}x{n}\n" for n in range(100)))
+        return ["shlink", "create-shorturl", "--file", str(bulk_file)]
+
+    def bulk_edit(i):
+        # Edits and deletes the short URLs created by the bulk create scenario
+        bulk_file.write_text("".join(f"arv.cx/bulk{i}x{n},https://example.org/edited/{n}\n" for n in range(100)))
+        return ["shlink", "edit-shorturl", "--file", str(bulk_file)]
+
+    def bulk_delete(i):
+        bulk_file.write_text("".join(f"arv.cx/bulk{i}x{n}\n" for n in range(100)))
+        return ["shlink", "delete-shorturl", "--file", str(bulk_file)]
+
+    return [
+        ("util --help", lambda i: ["--help"], None),
+        ("porkbun list-record", lambda i: ["porkbun", "list-record"], None),
+        ("porkbun list-record --type NS", lambda i: ["porkbun", "list-record", "--type", "NS"], None),
+        ("porkbun list-record --type TXT", lambda i: ["porkbun", "list-record", "--type", "TXT"], None),
+        ("porkbun list-record --output ndjson", lambda i: ["porkbun", "list-record", "--output", "ndjson"], None),
+        ("porkbun list-record --all-domains", lambda i: ["porkbun", "list-record", "--all-domains"], None),
+        ("porkbun search --content", lambda i: ["porkbun", "search", "--content", "10.0.0.7"], None),
+        ("porkbun create-record", lambda i: ["porkbun", "create-record", f"bench-{i}"], None),
+        ("porkbun delete-record", lambda i: ["porkbun", "delete-record", f"bench-{i}"], None),
+        ("porkbun apply --dry-run", lambda i: ["porkbun", "apply", str(zone_file), "--dry-run"], None),
+        ("porkbun apply", lambda i: ["porkbun", "apply", str(zone_file), "--no-prune"], None),
+        (
+            "porkbun ddns --once",
+            lambda i: ["porkbun", "ddns", "ddns", "--once", "--command", f"echo 192.0.2.{i % 250}"],
+            None,
+        ),
+        ("shlink create-shorturl", lambda i: ["shlink", "create-shorturl", f"https://example.org/{i}", f"b{i}"], None),
+        ("shlink create-shorturl (known URL)", lambda i: ["shlink", "create-shorturl", "https://example.org/"], None),
+        ("shlink create-shorturl --file (100)", bulk, None),
+        (
+            "shlink edit-shorturl",
+            lambda i: ["shlink", "edit-shorturl", f"arv.cx/b{i}", "https://example.org/edited"],
+            None,
+        ),
+        ("shlink delete-shorturl", lambda i: ["shlink", "delete-shorturl", f"arv.cx/b{i}"], None),
+        ("shlink edit-shorturl --file (100)", bulk_edit, None),
+        ("shlink delete-shorturl --file (100)", bulk_delete, None),
+        ("shlink list-shorturls --format csv", lambda i: ["shlink", "list-shorturls", "--format", "csv"], None),
+        ("shlink list-shorturls --tag", lambda i: ["shlink", "list-shorturls", "--tag", "campaign"], None),
+        ("lyrics", lambda i: ["lyrics", "song"], "1\n"),
+        ("lyrics --parallel", lambda i: ["lyrics", "song", "--parallel"], "1\n"),
+    ]
+
+
+def run(argv, stdin, env, cwd):
+    # Returns (wall seconds, exit code, peak RSS in KiB) of one CLI invocation
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", ENTRYPOINT, *argv],
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    process.stdin.write((stdin or "").encode())
+    process.stdin.close()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, process.returncode, usage.ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every mock response")
+    parser.add_argument("--zone-size", type=int, default=200, help="Number of records in the mock zone")
+    parser.add_argument("--txt-records", type=int, default=0, help="Number of extra TXT records in the mock zone")
+    parser.add_argument("--domains", type=int, default=1, help="Number of domains on the mock Porkbun")
+    parser.add_argument("--url-count", type=int, default=200, help="Number of short URLs on the mock Shlink")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the median is reported")
+    parser.add_argument("--filter", default="", help="Only run scenarios containing this text")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--daemon", action="store_true", help="Run porkbun and shlink commands through `util serve`")
+    parser.add_argument("--queue", action="store_true", help="Queue DNS and short URL changes instead of sending them")
+    args = parser.parse_args()
+
+    # Peak RSS carries over from the forking process, so commands are started from a fresh helper rather than from
+    # this one, which holds the mock datasets
+    launcher = multiprocessing.get_context("spawn").Pool(1)
+    porkbun = serve(
+        PorkbunApp(zone_size=args.zone_size, txt_records=args.txt_records, domain_count=args.domains),
+        latency=args.latency,
+    )
+    shlink = serve(ShlinkApp(url_count=args.url_count), latency=args.latency)
+    lyrics = serve(LyricsApp(), latency=args.latency)
+    servers = (porkbun, shlink, lyrics)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        (workdir / "utilcli").mkdir()
+        config = mock_config(porkbun, shlink, lyrics)
+        if args.queue:
+            config["queue"] = {"ENABLED": True}
+        (workdir / "utilcli" / "config.json").write_text(json.dumps(config))
+        # Commands copy results to the clipboard, a no-op `clip` keeps that from failing
+        (workdir / "bin").mkdir()
+        (workdir / "bin" / "clip").write_text("#!/bin/sh\ncat > /dev/null\n")
+        (workdir / "bin" / "clip").chmod(0o755)
+        env = {
+            **os.environ,
+            "XDG_CONFIG_HOME": str(workdir),
+            "PYTHONPATH": str(SOURCE),
+            "PATH": f"{workdir / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+            # Never reaches a daemon the user already has running
+            "UTILCLI_SOCKET": str(workdir / "util.sock"),
+        }
+        daemon = None
+        if args.daemon:
+            daemon = subprocess.Popen(
+                [sys.executable, "-c", ENTRYPOINT, "serve"], cwd=SOURCE, env=env, stdout=subprocess.PIPE
+            )
+            daemon.stdout.readline()
+
+        if not args.json:
+            print(f"{'scenario':<38} {'wall':>9} {'requests':>9} {'conns':>6} {'peak rss':>9} {'exit':>5}")
+        for name, argv, stdin in scenarios(workdir):
+            if args.filter not in name:
+                continue
+            samples = []
+            for i in range(args.repeat):
+                for server in servers:
+                    server.stats.reset()
+                wall, code, rss = launcher.apply(run, (argv(i), stdin, env, SOURCE))
+                requests = sum(x.stats.requests for x in servers)
+                connections = sum(x.stats.connections for x in servers)
+                samples.append((wall, requests, connections, rss, code))
+
+            wall = statistics.median(x[0] for x in samples)
+            requests, connections = samples[-1][1], samples[-1][2]
+            rss, code = max(x[3] for x in samples), max(x[4] for x in samples)
+            if args.json:
+                result = {"scenario": name, "wall_ms": round(wall * 1000, 1), "requests": requests}
+                result.update(connections=connections, peak_rss_kib=rss, exit_code=code)
+                print(json.dumps(result))
+            else:
+                print(
+                    f"{name:<38} {wall * 1000:>7.1f}ms {requests:>9} {connections:>6} {rss / 1024:>7.1f}MB {code:>5}"
+                )
+
+        if daemon:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
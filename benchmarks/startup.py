@@ -0,0 +1,77 @@
+"""Cold-start benchmark for the util CLI.
+
+Runs each command line in a fresh interpreter and reports the median wall time.
+The `lyrics song` scenario runs against the mock lyrics server from mock_servers.py,
+so it also measures building and using the lyrics client. Use --src to point at
+another checkout (e.g. a `git worktree` of an older commit) to compare before and
+after a change:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --src /tmp/utilcli-baseline
+"""
+from mock_servers import LyricsApp, serve
+from pathlib import Path
+import statistics
+import subprocess
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+
+# (command line, stdin)
+COMMANDS = [
+    (["--help"], None),
+    (["lyrics", "--help"], None),
+    (["shlink", "--help"], None),
+    (["porkbun", "--help"], None),
+    # Searches the mock server and prints the first result
+    (["lyrics", "song"], "1\n"),
+]
+
+DUMMY_CONFIG = {
+    "porkbun": {"API_KEY": "", "SECRET_KEY": "", "DOMAIN": "example.com", "SERVER_IP": "127.0.0.1"},
+    "shlink": {"DOMAIN": "localhost", "API_KEY": ""},
+}
+
+ENTRYPOINT = "import sys; sys.argv[0] = 'util'; from utilcli.main import app; app()"
+
+
+def run(src: Path, args, env, stdin: str = None) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", ENTRYPOINT, *args],
+        cwd=src,
+        env={**env, "PYTHONPATH": str(src)},
+        input=(stdin or "").encode(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--src", type=Path, default=Path(__file__).resolve().parent.parent)
+    parser.add_argument("--runs", type=int, default=15)
+    args = parser.parse_args()
+
+    lyrics = serve(LyricsApp())
+    config = {**DUMMY_CONFIG, "utilapi": {"HOST": "http://127.0.0.1", "PORT": str(lyrics.server_port)}}
+    with tempfile.TemporaryDirectory() as config_home:
+        (Path(config_home) / "utilcli").mkdir()
+        (Path(config_home) / "utilcli" / "config.json").write_text(json.dumps(config))
+        env = {**os.environ, "XDG_CONFIG_HOME": config_home}
+
+        run(args.src, ["--help"], env)
+        print(f"{'command':<24} {'median':>9} {'min':>9}")
+        for command, stdin in COMMANDS:
+            timings = [run(args.src, command, env, stdin) for _ in range(args.runs)]
+            label = "util " + " ".join(command)
+            print(f"{label:<24} {statistics.median(timings) * 1000:>7.1f}ms {min(timings) * 1000:>7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,52 @@
-from .shlink import app as shlink
-from .porkbun import app as porkbun
-from .utilapi import lyrics
+from typing import Dict, List, Optional, Tuple
+from importlib import import_module
+from typer.core import TyperGroup
+import typer
+import click
+
+
+# name: (module, attribute, short help), imported only when the command is actually invoked
+LAZY_COMMANDS: Dict[str, Tuple[str, str, str]] = {
+    "batch": ("utilcli.commands.batch", "batch", "Run porkbun and shlink commands read from a file in one process"),
+    "cache": ("utilcli.commands.cache", "app", "Inspect or clear the HTTP response cache"),
+    "lyrics": ("utilcli.commands.utilapi", "lyrics", "Search lyrics and print the chosen one"),
+    "porkbun": ("utilcli.commands.porkbun", "app", "Manage Porkbun DNS records"),
+    "queue": ("utilcli.commands.queue", "app", "Inspect and flush queued DNS and short URL changes"),
+    "serve": ("utilcli.commands.serve", "serve", "Keep clients warm in a daemon that porkbun and shlink run in"),
+    "shlink": ("utilcli.commands.shlink", "app", "Manage Shlink short URLs"),
+}
+
+
+class LazyGroup(TyperGroup):
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted({*super().list_commands(ctx), *LAZY_COMMANDS})
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
+        if name not in self.commands and name in LAZY_COMMANDS:
+            self.commands[name] = self.__load(name)
+        return super().get_command(ctx, name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter) -> None:
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in LAZY_COMMANDS:
+                rows.append((name, LAZY_COMMANDS[name][2]))
+            else:
+                command = self.get_command(ctx, name)
+                if command is not None and not command.hidden:
+                    rows.append((name, command.get_short_help_str()))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+    @staticmethod
+    def __load(name: str) -> click.Command:
+        module, attribute, short_help = LAZY_COMMANDS[name]
+        target = getattr(import_module(module), attribute)
+        wrapper = typer.Typer()
+        if isinstance(target, typer.Typer):
+            wrapper.add_typer(target, name=name, help=short_help)
+        else:
+            wrapper.command(name=name, help=short_help)(target)
+        wrapper.callback()(lambda: None)
+        return typer.main.get_group(wrapper).commands[name]
@@ -0,0 +1,234 @@
+from utilcli.daemon import FORWARDED_GROUPS, NOT_FORWARDED
+from utilcli.modules.Concurrency import run_keyed
+from utilcli.utility import set_clipboard_enabled
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Set, TextIO, Tuple
+import threading
+import shlex
+import typer
+import click
+import json
+import sys
+import io
+
+
+class ThreadOutput(io.TextIOBase):
+    # Stands in for sys.stdout/sys.stderr, writes from a thread that is capturing go to that thread's buffer and
+    # everything else to the original stream
+    encoding = "utf-8"
+    errors = "strict"
+
+    def __init__(self, stream: TextIO, local: threading.local, name: str) -> None:
+        self.__stream = stream
+        self.__local = local
+        self.__name = name
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: str) -> int:
+        buffer = getattr(self.__local, self.__name, None)
+        return (buffer if buffer is not None else self.__stream).write(data)
+
+    def flush(self) -> None:
+        if getattr(self.__local, self.__name, None) is None:
+            self.__stream.flush()
+
+
+class BatchLine:
+    __slots__ = ("line", "argv", "key", "error")
+
+    def __init__(self, line: int, argv: List[str], key: Optional[str] = None, error: str = None) -> None:
+        self.line = line
+        self.argv = argv
+        self.key = key
+        self.error = error
+
+
+def parse_command(group: click.MultiCommand, argv: List[str]) -> Tuple[List[str], click.Command, Dict[str, Any]]:
+    # Runs argv through the commands' own parsers, down to the subcommand, and returns the subcommand path, the
+    # subcommand and its raw parameters. Nothing is converted, so files aren't opened and the config isn't read.
+    names, command = [], group
+    while True:
+        ctx = click.Context(command, info_name=names[-1] if names else None, resilient_parsing=True)
+        params, argv, _ = command.make_parser(ctx).parse_args(list(argv))
+        if not isinstance(command, click.MultiCommand) or not argv:
+            return names, command, params
+        name, command, argv = command.resolve_command(ctx, argv)
+        names.append(name)
+
+
+def reads_stdin(group: click.MultiCommand, argv: List[str]) -> bool:
+    # Whether a file parameter of the subcommand is "-", however it was spelled (-f -, -f-, --file=-)
+    try:
+        _, command, params = parse_command(group, argv)
+    except click.ClickException:
+        return False
+    for param in command.params:
+        if isinstance(param.type, click.File):
+            value = params.get(param.name, param.default)
+            if "-" in (value if isinstance(value, (list, tuple)) else [value]):
+                return True
+    return False
+
+
+def porkbun_target(command: str, params: Dict[str, Any]) -> Optional[Tuple[Hashable, Optional[str]]]:
+    # The zone and the relative record name, None as the name for lines about the whole zone: listings, apply,
+    # several hostnames and deletes by pattern or bare label, which match records anywhere in the zone
+    from utilcli.commands.porkbun import get_porkbun_api
+    from utilcli.modules.PorkbunAPI import PorkbunRecordIndex
+
+    domains = params.get("domains") or []
+    if command in ("list-record", "search"):
+        if params.get("all_domains") or len(domains) > 1 or (command == "search" and not domains):
+            return None
+        return ("porkbun", get_porkbun_api(domains[0] if domains else None).DOMAIN), None
+    porkbun = get_porkbun_api(params.get("domain"))
+    hosts = [params["host"]] if command == "create-record" else params.get("hostnames") or []
+    if (
+        len(hosts) != 1
+        or command == "delete-record"
+        and (PorkbunRecordIndex.is_pattern(hosts[0]) or "." not in hosts[0])
+    ):
+        return ("porkbun", porkbun.DOMAIN), None
+    return ("porkbun", porkbun.DOMAIN), porkbun.relative_name(hosts[0].strip()).lower()
+
+
+def shlink_target(command: str, params: Dict[str, Any]) -> Optional[Tuple[Hashable, Optional[str]]]:
+    # The short code, None for bulk and listing lines about every short URL. Whether a domain is one the server
+    # hosts, or falls back to its default domain, is only known to the server, so short codes aren't told apart by
+    # domain. A shorten without a slug gets its code from the server and is ordered by its URL instead.
+    from utilcli.commands.shlink import short_url_key
+    from utilcli.modules.ShlinkURLIndex import normalize_url
+
+    if params.get("file"):
+        return "shlink", None
+    if command == "create-shorturl":
+        if params.get("slug"):
+            return "shlink", params["slug"].casefold()
+        return ("shlink", f"url {normalize_url(params['url'])}") if params.get("url") else None
+    identifiers = params.get("url_identifiers") or [params.get("url_identifier")]
+    if command in ("delete-shorturl", "edit-shorturl") and len(identifiers) == 1 and identifiers[0]:
+        return "shlink", short_url_key(identifiers[0]).rpartition("/")[2].casefold()
+    return "shlink", None
+
+
+TARGETS = {"porkbun": porkbun_target, "shlink": shlink_target}
+
+
+class BatchOrder:
+    # Lines about the same target keep their input order. A line about a single target (a record name, a short code)
+    # runs after the earlier lines about it, a line about its whole scope (a zone, every short URL) after every
+    # earlier line in the scope and before the later ones. A JSON key replaces the target, lines that can't be
+    # parsed or span several scopes aren't ordered.
+    def __init__(self, groups: Dict[str, click.MultiCommand]) -> None:
+        self.__groups = groups
+        self.__targets: Dict[Hashable, Set[str]] = {}
+
+    def __target(self, item: BatchLine) -> Optional[Tuple[Hashable, Optional[str]]]:
+        try:
+            names, _, params = parse_command(self.__groups[item.argv[0]], item.argv[1:])
+            return TARGETS[item.argv[0]](" ".join(names), params)
+        except Exception:
+            return None
+
+    def keys(self, item: BatchLine) -> List[Hashable]:
+        if item.error:
+            return [("line", item.line)]
+        if item.key is not None:
+            return [(item.argv[0], "key", item.key)]
+        target = self.__target(item)
+        if target is None:
+            return [("line", item.line)]
+        scope, name = target
+        if name is not None:
+            self.__targets.setdefault(scope, set()).add(name)
+            return [(scope, name), scope]
+        # Lines about single targets before an earlier whole scope line already ran before it
+        return [scope, *((scope, x) for x in self.__targets.pop(scope, ()))]
+
+
+def parse_line(line: int, text: str) -> Optional[BatchLine]:
+    # Either a shell style command line or JSON: an argv array, or {"argv": [...] or "...", "key": "..."}
+    text = text.strip()
+    if not text or text.startswith("#"):
+        return None
+    key = None
+    try:
+        if text[0] in "[{":
+            data = json.loads(text)
+            if isinstance(data, dict):
+                key, data = data.get("key"), data.get("argv")
+            argv = shlex.split(data) if isinstance(data, str) else data
+            if not isinstance(argv, list) or not all(isinstance(x, str) for x in argv):
+                return BatchLine(line, [], error="argv must be a string or an array of strings")
+        else:
+            argv = shlex.split(text)
+    except ValueError as e:
+        return BatchLine(line, [], error=str(e))
+
+    if argv[:1] == ["util"]:
+        argv = argv[1:]
+    if len(argv) < 2 or argv[0] not in FORWARDED_GROUPS or tuple(argv[:2]) in NOT_FORWARDED:
+        return BatchLine(line, argv, error=f"Only {' and '.join(FORWARDED_GROUPS)} commands can run in a batch")
+    return BatchLine(line, argv, None if key is None else str(key))
+
+
+def read_lines(file: TextIO) -> Iterator[BatchLine]:
+    for line, text in enumerate(file, 1):
+        parsed = parse_line(line, text)
+        if parsed is not None:
+            yield parsed
+
+
+def batch(
+    file: typer.FileText = typer.Argument("-", help="Commands to run, one per line, - for stdin"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of commands running at once"),
+    clipboard: bool = typer.Option(False, "--clipboard", help="Let commands copy their results to the clipboard"),
+):
+    from utilcli.main import app
+
+    root = typer.main.get_command(app)
+    # Resolved up front so the lazily imported command groups and their clients are shared by every line
+    groups: Dict[str, click.Command] = {
+        name: root.get_command(click.Context(root, info_name="util"), name) for name in FORWARDED_GROUPS
+    }
+    local = threading.local()
+
+    def run(item: BatchLine) -> Tuple[int, str, str]:
+        if item.error:
+            raise Exception(item.error)
+        if reads_stdin(groups[item.argv[0]], item.argv[1:]):
+            raise Exception("stdin isn't available to commands in a batch")
+        local.stdout, local.stderr = io.StringIO(), io.StringIO()
+        try:
+            try:
+                group = groups[item.argv[0]]
+                result = group.main(item.argv[1:], prog_name=f"util {item.argv[0]}", standalone_mode=False)
+                exit_code = result if isinstance(result, int) else 0
+            except click.ClickException as e:
+                local.stderr.write(f"Error: {e.format_message()}\n")
+                exit_code = e.exit_code
+            except click.Abort:
+                exit_code = 1
+            return exit_code, local.stdout.getvalue(), local.stderr.getvalue()
+        finally:
+            local.stdout = local.stderr = None
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadOutput(stdout, local, "stdout"), ThreadOutput(stderr, local, "stderr")
+    set_clipboard_enabled(clipboard)
+    failed = 0
+    try:
+        for item, outcome, error in run_keyed(run, read_lines(file), key=BatchOrder(groups).keys, workers=workers):
+            result = {"line": item.line, "argv": item.argv}
+            if error:
+                result.update(exit_code=1, error=str(error))
+            else:
+                exit_code, out, err = outcome
+                result.update(exit_code=exit_code, stdout=out, stderr=err)
+            failed += result["exit_code"] != 0
+            typer.echo(json.dumps(result))
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        set_clipboard_enabled(True)
+    raise typer.Exit(code=1 if failed else 0)
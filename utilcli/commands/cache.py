@@ -0,0 +1,37 @@
+from utilcli.utility import get_http_cache
+from utilcli.modules.Output import OutputFormat, write_record
+import typer
+
+
+app = typer.Typer()
+
+
+def get_cache():
+    cache = get_http_cache()
+    if cache is None:
+        typer.echo("The HTTP cache is disabled, CACHE_SIZE_MB is 0")
+        raise typer.Exit(code=1)
+    return cache
+
+
+@app.command()
+def stats(output: OutputFormat = typer.Option("text", "--output", help="Output format")):
+    stats = get_cache().stats()
+    if output != OutputFormat.text:
+        return write_record(output, stats)
+    lookups = stats["hits"] + stats["revalidated"] + stats["misses"]
+    typer.echo(f"Entries     : {stats['entries']}")
+    typer.echo(f"Size        : {stats['size'] / 1024:.1f} KiB")
+    typer.echo(f"Hits        : {stats['hits']}")
+    typer.echo(f"Revalidated : {stats['revalidated']}")
+    typer.echo(f"Misses      : {stats['misses']}")
+    typer.echo(f"Stored      : {stats['stored']}")
+    typer.echo(f"Evicted     : {stats['evicted']}")
+    if lookups:
+        typer.echo(f"Hit ratio   : {(stats['hits'] + stats['revalidated']) / lookups:.1%}")
+
+
+@app.command()
+def clear(reset_stats: bool = typer.Option(False, "--reset-stats", help="Also reset the hit and miss counters")):
+    cleared = get_cache().clear(reset_counters=reset_stats)
+    typer.echo(f"Removed {cleared} cached responses")
@@ -1,48 +1,302 @@
-from utilcli.utility import copy_to_clipboard, CONFIG
+from utilcli.utility import (
+    configure_limits,
+    copy_to_clipboard,
+    echo_error,
+    get_app_dir,
+    get_config,
+    get_http_transport,
+    get_mutation_queue,
+    start_flusher,
+)
 from utilcli.modules import PorkbunAPI
+from utilcli.modules.PorkbunAPI import PorkbunRecord, PorkbunRecordIndex
+from utilcli.modules.Output import OutputFormat, RecordWriter, write_record
+from utilcli.modules.PorkbunMirror import PorkbunMirror
+from utilcli.modules.PorkbunFleet import PorkbunFleet
+from utilcli.modules.PorkbunZone import apply_plan, load_zone_file, plan_zone
+from utilcli.modules.PorkbunDDNS import CommandIPSource, DDNSUpdater, InterfaceIPSource
+from utilcli.modules.Tracer import get_tracer
+from typing import Dict, List, Optional
+from datetime import datetime
+from functools import lru_cache
 from operator import itemgetter
+from pathlib import Path
 import typer
 
 
 app = typer.Typer()
 
 
-api_key, secret_key, domain, default_ip = itemgetter("API_KEY", "SECRET_KEY", "DOMAIN", "SERVER_IP")(
-    CONFIG.get("porkbun")
-)
-porkbun = PorkbunAPI(api_key, secret_key, domain, default_ip)
+def get_domains() -> List[str]:
+    # DOMAIN is a single domain or a list of them, the first one is the default
+    domains = get_config("porkbun")["DOMAIN"]
+    return [domains] if isinstance(domains, str) else list(domains)
+
+
+@lru_cache(maxsize=None)
+def get_porkbun_mirror() -> Optional[PorkbunMirror]:
+    mirror_ttl = get_config("porkbun").get("MIRROR_TTL")
+    return PorkbunMirror(get_app_dir() / "porkbun_mirror.sqlite3", ttl=mirror_ttl) if mirror_ttl else None
+
+
+def get_porkbun_api(domain: str = None) -> PorkbunAPI:
+    return get_domain_api(domain.lower().rstrip(".") if domain else get_domains()[0])
+
+
+@lru_cache(maxsize=None)
+@get_tracer().span("porkbun client")
+def get_domain_api(domain: str) -> PorkbunAPI:
+    config = get_config("porkbun")
+    api_key, secret_key, default_ip = itemgetter("API_KEY", "SECRET_KEY", "SERVER_IP")(config)
+    porkbun = PorkbunAPI(
+        api_key,
+        secret_key,
+        domain,
+        default_ip,
+        transport=get_http_transport(),
+        base_url=config.get("API_URL"),
+        mirror=get_porkbun_mirror(),
+    )
+    configure_limits("porkbun", porkbun.base_url)
+    return porkbun
+
+
+def get_fleet(domains: Optional[List[str]], workers: int) -> PorkbunFleet:
+    # The given domains, every configured one when there are none
+    return PorkbunFleet([get_porkbun_api(x) for x in dict.fromkeys(domains or get_domains())], workers=workers)
+
+
+DOMAIN_OPTION = typer.Option(None, "--domain", "-d", help="Domain to manage, the first configured one by default")
 
 
 @app.command()
-def create_record(host: str, ip: str = None, type: str = "A", ttl: int = 300):
+def create_record(
+    host: str,
+    ip: str = None,
+    type: str = "A",
+    ttl: int = 300,
+    domain: Optional[str] = DOMAIN_OPTION,
+    output: OutputFormat = typer.Option("text", "--output", help="Output format"),
+):
+    porkbun = get_porkbun_api(domain)
+    queue = get_mutation_queue()
+    if queue is not None:
+        try:
+            payload = porkbun.record_payload(host=host, ip=ip, record_type=type, ttl=ttl)
+        except Exception as e:
+            return echo_error(e, output)
+        mutation = queue.enqueue(
+            "porkbun",
+            porkbun.DOMAIN,
+            payload["name"].lower(),
+            "create",
+            {"host": host, "ip": payload["content"], "type": payload["type"], "ttl": ttl},
+        )
+        write_record(output, mutation, text=lambda x: f"Record creation queued (#{x.id})")
+        return start_flusher()
     try:
         resp = porkbun.create_record(host=host, ip=ip, record_type=type, ttl=ttl)
     except Exception as e:
-        return typer.echo(e)
+        return echo_error(e, output)
     if not resp.ok():
-        return typer.echo(resp.message)
-    typer.echo(f"Record successfully created ({resp.new_record.host})")
+        return echo_error(resp.message, output)
+    write_record(output, resp.new_record, text=lambda x: f"Record successfully created ({x.host})")
     copy_to_clipboard(resp.new_record.host)
 
 
+SORT_KEYS = {
+    "domain": lambda x: x[0],
+    "host": lambda x: x[1].host.lower(),
+    "type": lambda x: x[1].type.name,
+    "ip": lambda x: x[1].ip,
+    "ttl": lambda x: int(x[1].ttl or 0),
+}
+
+
+def echo_fleet_records(records: List, errors: Dict[str, str], output: OutputFormat) -> None:
+    fields = ("domain", *PorkbunRecord.FIELDS)
+    with RecordWriter(output, fields=fields, text=lambda x: f"Domain: {x[0]}\n{x[1]}") as writer:
+        for domain, record in records:
+            writer.write((domain, record) if output == OutputFormat.text else {"domain": domain, **record.to_dict()})
+    for domain, error in errors.items():
+        typer.echo(f"{domain}: {error}", err=True)
+    if errors:
+        raise typer.Exit(code=1)
+
+
 @app.command()
-def list_record(type: str = "A"):
+def list_record(
+    type: str = "A",
+    refresh: bool = typer.Option(False, "--refresh", help="Fetch the zone from the API even if the mirror is fresh"),
+    domains: Optional[List[str]] = typer.Option(None, "--domain", "-d", help="Domains to list, can be repeated"),
+    all_domains: bool = typer.Option(False, "--all-domains", help="List every configured domain"),
+    sort: Optional[str] = typer.Option(None, help=f"Sort the merged records by {', '.join(SORT_KEYS)}"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent API calls"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format, records are written as they arrive"),
+):
+    if sort is not None and sort not in SORT_KEYS:
+        typer.echo(f"Can't sort by {sort}, use one of {', '.join(SORT_KEYS)}")
+        raise typer.Exit(code=1)
+    if not all_domains and len(domains or []) <= 1 and sort is None:
+        # A single zone is streamed as it downloads
+        porkbun = get_porkbun_api(domains[0] if domains else None)
+        try:
+            with RecordWriter(output, fields=PorkbunRecord.FIELDS) as writer:
+                for record in porkbun.iter_records(record_type=type, refresh=refresh):
+                    writer.write(record)
+        except Exception as e:
+            return echo_error(e, output)
+        return
+
+    fleet = get_fleet(None if all_domains else domains or [get_porkbun_api().DOMAIN], workers)
     try:
-        resp = porkbun.list_record(record_type=type)
+        records, errors = fleet.list_records(record_type=type, refresh=refresh, sort=SORT_KEYS.get(sort))
     except Exception as e:
-        return typer.echo(e)
+        return echo_error(e, output)
+    echo_fleet_records(records, errors, output)
+
+
+@app.command()
+def search(
+    content: Optional[str] = typer.Option(None, help="Record content (IP, target, ...), glob patterns work"),
+    host: Optional[str] = typer.Option(None, help="FQDN of the record, glob patterns work"),
+    type: Optional[str] = typer.Option(None, help="Record type"),
+    domains: Optional[List[str]] = typer.Option(None, "--domain", "-d", help="Domains to search, all by default"),
+    refresh: bool = typer.Option(False, "--refresh", help="Fetch the zones from the API even if the mirror is fresh"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent API calls"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format"),
+):
+    if not (content or host or type):
+        typer.echo("Please provide at least one of --content, --host or --type")
+        raise typer.Exit(code=1)
+    try:
+        index, errors = get_fleet(domains, workers).index(refresh=refresh)
+        records = index.search(content=content, host=host, record_type=type)
+    except Exception as e:
+        return echo_error(e, output)
+    echo_fleet_records(records, errors, output)
+
+
+@app.command()
+def delete_record(
+    hostnames: List[str] = typer.Argument(..., help="Hostnames, FQDNs or glob patterns (e.g. 'pr-*')"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent API calls"),
+    refresh: bool = typer.Option(False, "--refresh", help="Match against the API even if the mirror is fresh"),
+    domain: Optional[str] = DOMAIN_OPTION,
+    output: OutputFormat = typer.Option("text", "--output", help="Output format"),
+):
+    porkbun = get_porkbun_api(domain)
+    queue = get_mutation_queue()
+    if queue is not None:
+        # One mutation per hostname, a pattern is matched against the zone when the queue is flushed. Patterns and
+        # bare labels match records anywhere in the zone and are ordered against every other change to it.
+        with RecordWriter(output, text=lambda x: f"Record deletion queued (#{x.id} {x.key or '@'})") as writer:
+            for host in dict.fromkeys(x.strip() for x in hostnames if x.strip()):
+                name = porkbun.relative_name(host).lower()
+                scope_wide = PorkbunRecordIndex.is_pattern(host) or "." not in host
+                mutation = queue.enqueue("porkbun", porkbun.DOMAIN, name, "delete", {"host": host}, scope_wide)
+                writer.write(mutation)
+        return start_flusher()
+    try:
+        resp = porkbun.delete_records(hosts=hostnames, workers=workers, refresh=refresh)
+    except Exception as e:
+        return echo_error(e, output)
+    with RecordWriter(
+        output, fields=PorkbunRecord.FIELDS, text=lambda x: f"Record succesfully deleted ({x.host})"
+    ) as writer:
+        for record in resp.deleted_records:
+            writer.write(record)
     if not resp.ok():
-        return typer.echo(resp.message)
-    for record in resp.list_records:
-        typer.echo(record)
+        echo_error(resp.message, output)
+        raise typer.Exit(code=1)
 
 
 @app.command()
-def delete_record(hostname: str):
+def apply(
+    zone_file: Path = typer.Argument(..., exists=True, dir_okay=False),
+    dry_run: bool = typer.Option(False, "--dry-run", help="Only print the plan"),
+    prune: bool = typer.Option(True, help="Delete records that are not in the zone file"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent API calls"),
+    domain: Optional[str] = DOMAIN_OPTION,
+    output: OutputFormat = typer.Option(
+        "text", "--output", help="Output format, the plan with --dry-run and the result of every change otherwise"
+    ),
+):
+    porkbun = get_porkbun_api(domain)
     try:
-        resp = porkbun.delete_record(hostname)
+        desired = load_zone_file(zone_file, porkbun.DOMAIN)
+        # Changes are planned against the live zone, never against the mirror
+        resp = porkbun.list_record(refresh=True)
     except Exception as e:
-        return typer.echo(e)
+        return echo_error(e, output)
     if not resp.ok():
-        return typer.echo(resp.message)
-    typer.echo(f"Record succesfully deleted ({resp.deleted_record.host})")
+        return echo_error(resp.message, output)
+
+    # With machine readable output the records are the only thing on stdout, summaries go to stderr
+    text = output == OutputFormat.text
+    plan = plan_zone(desired, resp.list_records, porkbun.DOMAIN, prune=prune)
+    if text or dry_run:
+        with RecordWriter(output) as writer:
+            for change in plan.changes:
+                writer.write(change)
+    typer.echo(plan.summary(), err=not text)
+    if dry_run or plan.is_empty():
+        return
+
+    failed = 0
+    with RecordWriter(OutputFormat.text if text else output) as writer:
+        for change, resp, error in apply_plan(porkbun, plan, workers=workers):
+            message = str(error) if error else None if resp.ok() else resp.message
+            failed += message is not None
+            if not text:
+                writer.write({**change.to_dict(), "ok": message is None, "error": message})
+            elif message:
+                writer.write(f"Failed to {change.action} {change.record.host}: {message}")
+    typer.echo(f"Applied {len(plan.changes) - failed} of {len(plan.changes)} changes", err=not text)
+    if failed:
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def ddns(
+    host: str,
+    type: str = "A",
+    ttl: int = 600,
+    interface: Optional[str] = typer.Option(None, help="Read the address from this network interface"),
+    command: Optional[str] = typer.Option(None, help="Read the address from the output of this shell command"),
+    interval: float = typer.Option(300, min=1, help="Seconds between address checks"),
+    max_backoff: float = typer.Option(3600, min=1, help="Upper bound in seconds for the retry delay"),
+    once: bool = typer.Option(False, "--once", help="Check a single time and exit"),
+    domain: Optional[str] = DOMAIN_OPTION,
+):
+    porkbun = get_porkbun_api(domain)
+    config = get_config("porkbun").get("DDNS", {})
+    interface = interface if interface else config.get("INTERFACE")
+    command = command if command else config.get("COMMAND")
+    if bool(interface) == bool(command):
+        typer.echo("Please provide either --interface or --command")
+        raise typer.Exit(code=1)
+
+    version = 6 if type.upper() == "AAAA" else 4
+    try:
+        source = InterfaceIPSource(interface, version) if interface else CommandIPSource(command, version)
+        updater = DDNSUpdater(porkbun, host, source, record_type=type, ttl=ttl)
+    except Exception as e:
+        return typer.echo(e)
+
+    def log(message: str):
+        typer.echo(f"[{datetime.now().isoformat(timespec='seconds')}] {message}")
+
+    if once:
+        try:
+            log(updater.sync() or f"{updater.FQDN} is up to date")
+        except Exception as e:
+            log(e)
+            raise typer.Exit(code=1)
+        return
+
+    log(f"Watching {updater.FQDN} every {interval:g}s")
+    try:
+        updater.run(interval=interval, max_backoff=max_backoff, on_event=log)
+    except KeyboardInterrupt:
+        log("Stopped")
@@ -0,0 +1,136 @@
+from utilcli.utility import get_config, get_mutation_queue
+from utilcli.modules.CommandResponse import CommandResponse
+from utilcli.modules.MutationQueue import MutationQueue, QueuedMutation
+from utilcli.modules.Output import OutputFormat, RecordWriter
+from utilcli.modules.RequestScheduler import is_transient_error, is_transient_status
+from typing import Optional
+import typer
+
+
+app = typer.Typer()
+
+
+def get_queue() -> MutationQueue:
+    queue = get_mutation_queue()
+    if queue is None:
+        typer.echo("The queue is disabled, set ENABLED in the queue section of the config")
+        raise typer.Exit(code=1)
+    return queue
+
+
+def send_porkbun(mutation: QueuedMutation) -> CommandResponse:
+    from utilcli.commands.porkbun import get_porkbun_api
+
+    porkbun, payload = get_porkbun_api(mutation.scope), mutation.payload
+    if mutation.action == "create":
+        if mutation.attempts:
+            # An earlier attempt may have reached Porkbun before it failed, e.g. on a read timeout, sending it again
+            # would create the record twice
+            record = porkbun.record_payload(
+                host=payload["host"], ip=payload["ip"], record_type=payload["type"], ttl=payload["ttl"]
+            )
+            host = f"{record['name']}.{porkbun.DOMAIN}" if record["name"] else porkbun.DOMAIN
+            res = porkbun.list_record(record_type=payload["type"], refresh=True, host=host)
+            if res.ok() and any(x.ip == record["content"] for x in res.list_records):
+                return res
+        return porkbun.create_record(
+            host=payload["host"], ip=payload["ip"], record_type=payload["type"], ttl=payload["ttl"]
+        )
+    try:
+        return porkbun.delete_records(hosts=[payload["host"]], refresh=True)
+    except Exception as e:
+        # Already gone is what the deletion was after
+        if str(e).startswith("Provided host is invalid"):
+            return CommandResponse(is_ok=True)
+        raise
+
+
+def send_shlink(mutation: QueuedMutation) -> CommandResponse:
+    from utilcli.commands.shlink import get_shlink_api
+
+    shlink_api, payload = get_shlink_api(), mutation.payload
+    if mutation.action == "shorten":
+        # An earlier attempt may have created the short URL before its answer got lost
+        res = shlink_api.shorten(
+            url=payload["url"],
+            slug=payload["slug"],
+            alt_domain=payload["alt_domain"],
+            verify=payload["verify"],
+            find_if_exists=mutation.attempts > 0,
+        )
+    elif mutation.action == "edit":
+        res = shlink_api.edit_short_url(payload["identifier"], payload["url"])
+    else:
+        res = shlink_api.delete_short_url(payload["identifier"])
+    return res
+
+
+def execute(mutation: QueuedMutation) -> CommandResponse:
+    send = send_porkbun if mutation.provider == "porkbun" else send_shlink
+    # A transport failure or a transient status is worth another attempt, anything else fails the mutation at once
+    try:
+        res = send(mutation)
+    except Exception as e:
+        if is_transient_error(e):
+            raise
+        return CommandResponse(is_ok=False, message=str(e))
+    status_code = getattr(res, "status_code", None)
+    if status_code is not None and is_transient_status(status_code):
+        raise Exception(res.message or f"Server responded with {status_code}")
+    return res
+
+
+def echo_result(mutation: QueuedMutation, error: Optional[str]) -> None:
+    if error is None:
+        typer.echo(f"#{mutation.id} {mutation.provider} {mutation.action} {mutation.key} sent")
+    elif mutation.status == MutationQueue.FAILED:
+        typer.echo(f"#{mutation.id} {mutation.provider} {mutation.action} {mutation.key} failed: {error}")
+    else:
+        typer.echo(f"#{mutation.id} {mutation.provider} {mutation.action} {mutation.key} will be retried: {error}")
+
+
+@app.command()
+def status(
+    failed: bool = typer.Option(False, "--failed", help="Only list the failed mutations"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format, lists the mutations"),
+):
+    queue = get_queue()
+    mutations = queue.mutations(MutationQueue.FAILED if failed else None)
+    if output != OutputFormat.text:
+        with RecordWriter(output, fields=QueuedMutation.__slots__) as writer:
+            for mutation in mutations:
+                writer.write(mutation)
+        return
+    counts = queue.counts()
+    typer.echo(f"Pending     : {counts[MutationQueue.PENDING]}")
+    typer.echo(f"Sending     : {counts[MutationQueue.SENDING]}")
+    typer.echo(f"Failed      : {counts[MutationQueue.FAILED]}")
+    for mutation in mutations:
+        typer.echo(mutation)
+
+
+@app.command()
+def flush(
+    wait: bool = typer.Option(False, "--wait", help="Keep going until the mutations waiting for a retry are sent"),
+    quiet: bool = typer.Option(False, "--quiet", help="Print nothing, the exit code tells whether anything failed"),
+    workers: Optional[int] = typer.Option(None, min=1, help="Maximum number of concurrent requests"),
+):
+    workers = workers or get_config("queue", required=False).get("WORKERS", 8)
+    counts = get_queue().flush(execute, workers=workers, wait=wait, on_result=None if quiet else echo_result)
+    if not quiet:
+        typer.echo(
+            f"{counts['sent']} sent, {counts['coalesced']} coalesced, "
+            f"{counts['retrying']} retrying, {counts['failed']} failed"
+        )
+    if counts["failed"]:
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def retry():
+    typer.echo(f"{get_queue().requeue_failed()} failed mutations queued again")
+
+
+@app.command()
+def drop():
+    typer.echo(f"Dropped {get_queue().drop_failed()} failed mutations")
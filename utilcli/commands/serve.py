@@ -0,0 +1,30 @@
+from utilcli.daemon import DaemonServer, request, socket_path
+from typing import Optional
+import typer
+
+
+def serve(
+    socket: Optional[str] = typer.Option(None, envvar="UTILCLI_SOCKET", help="Path of the daemon's Unix socket"),
+    idle_timeout: int = typer.Option(0, help="Exit after this many seconds without a command, 0 to never exit"),
+    stop: bool = typer.Option(False, "--stop", help="Stop the running daemon"),
+):
+    path = socket if socket else socket_path()
+    if stop:
+        if request({"stop": True}, path) is None:
+            typer.echo(f"No daemon is listening on {path}", err=True)
+            raise typer.Exit(1)
+        typer.echo("Daemon stopped")
+        return
+
+    if request({"ping": True}, path) is not None:
+        typer.echo(f"A daemon is already listening on {path}", err=True)
+        raise typer.Exit(1)
+    server = DaemonServer(path, idle_timeout)
+    server.bind()
+    typer.echo(f"Listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
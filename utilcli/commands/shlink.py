@@ -1,51 +1,485 @@
-from utilcli.utility import copy_to_clipboard, CONFIG
+from utilcli.utility import (
+    configure_limits,
+    copy_to_clipboard,
+    echo_error,
+    get_app_dir,
+    get_config,
+    get_http_transport,
+    get_mutation_queue,
+    start_flusher,
+)
 from utilcli.modules import ShlinkAPI
+from utilcli.modules.DiskCache import DiskCache
+from utilcli.modules.Concurrency import run_ordered
+from utilcli.modules.ShlinkVisitStore import ShlinkVisitStore
+from utilcli.modules.ShlinkURLIndex import ShlinkURLIndex, normalize_url
+from utilcli.modules.ShlinkAPI import ShlinkResponse, ShlinkShortURL
+from utilcli.modules.Output import OutputFormat, RecordWriter, write_record
+from utilcli.modules.Tracer import get_tracer
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+from functools import lru_cache
 from operator import itemgetter
-from typing import Optional
+from datetime import date, datetime, timedelta
+from pathlib import Path
 import typer
+import json
+import csv
 
 
 app = typer.Typer()
 
-domain, api_key = itemgetter(
-    "DOMAIN",
-    "API_KEY",
-)(CONFIG.get("shlink"))
 
-shlink_api = ShlinkAPI(domain, api_key)
+@lru_cache(maxsize=None)
+def get_domain_cache() -> DiskCache:
+    config = get_config("shlink")
+    return DiskCache(
+        get_app_dir() / "shlink_domains.json",
+        ttl=config.get("DOMAIN_CACHE_TTL", 3600),
+        stale_ttl=config.get("DOMAIN_CACHE_STALE_TTL", 86400),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_url_index() -> Optional[ShlinkURLIndex]:
+    # None when URL_INDEX_SIZE is 0
+    size = get_config("shlink").get("URL_INDEX_SIZE", 100000)
+    return ShlinkURLIndex(get_app_dir() / "shlink_url_index.sqlite3", max_entries=size) if size else None
+
+
+# Set by the group callback for the current invocation, the daemon reuses the client across invocations
+CLIENT_OPTIONS = {"no_cache": False, "no_index": False}
+
+
+def configure_client(shlink_api: ShlinkAPI) -> ShlinkAPI:
+    shlink_api.domain_cache = None if CLIENT_OPTIONS["no_cache"] else get_domain_cache()
+    shlink_api.url_index = None if CLIENT_OPTIONS["no_index"] else get_url_index()
+    return shlink_api
+
+
+@lru_cache(maxsize=None)
+@get_tracer().span("shlink client")
+def get_shlink_api() -> ShlinkAPI:
+    config = get_config("shlink")
+    domain, api_key = itemgetter(
+        "DOMAIN",
+        "API_KEY",
+    )(config)
+    shlink_api = ShlinkAPI(
+        domain,
+        api_key,
+        transport=get_http_transport(),
+        api_url=config.get("API_URL"),
+    )
+    configure_limits("shlink", shlink_api.base_url)
+    return configure_client(shlink_api)
+
+
+@lru_cache(maxsize=None)
+def get_visit_store() -> ShlinkVisitStore:
+    return ShlinkVisitStore(get_app_dir() / "shlink_visits.sqlite3")
+
+
+@app.callback()
+def main(
+    no_cache: bool = typer.Option(False, "--no-cache", help="Always fetch the domain list from the server"),
+    no_index: bool = typer.Option(False, "--no-index", help="Always shorten on the server, even known URLs"),
+):
+    # The client is only built by the commands that talk to the server, visits-report and url-index stats/clear
+    # never pay for it
+    CLIENT_OPTIONS.update(no_cache=no_cache, no_index=no_index)
+    if get_shlink_api.cache_info().currsize:
+        configure_client(get_shlink_api())
+
+
+DEFAULT_DOMAIN = "arv.cx"
+
+
+def short_url_key(identifier: str) -> str:
+    # domain/short code of an identifier without asking the server for its domains, mutations of the same short URL
+    # are coalesced in the queue by this key
+    identifier = identifier.strip()
+    if ShlinkAPI.validate_url(identifier):
+        identifier = identifier.split("://", 1)[1]
+    domain, _, short_code = identifier.rstrip("/").rpartition("/")
+    return f"{(domain or get_shlink_api().API_DOMAIN).lower()}/{short_code}"
+
+
+def enqueue_shlink(key: str, action: str, payload: dict, output: OutputFormat, message: str) -> None:
+    mutation = get_mutation_queue().enqueue("shlink", get_shlink_api().API_DOMAIN, key, action, payload)
+    write_record(output, mutation, text=lambda x: f"{message} queued (#{x.id})")
+    start_flusher()
+
+
+def read_bulk_rows(file: TextIO) -> Iterator[Tuple[int, str, Optional[str], Optional[str]]]:
+    # Streams (line, url, slug, domain) rows, the header row is optional
+    for line, row in enumerate(csv.reader(file), 1):
+        row = [x.strip() for x in row]
+        if not row or not row[0] or row[0].startswith("#"):
+            continue
+        if line == 1 and row[0].lower() == "url":
+            continue
+        url, slug, domain = (row + [None, None])[:3]
+        yield line, url, slug or None, domain or None
+
+
+def shorten_bulk(file: TextIO, default_domain: str, workers: int, verify: bool) -> int:
+    shlink_api = get_shlink_api()
+    res = shlink_api.get_available_domain()
+    if not res.ok():
+        typer.echo(res.message)
+        return 1
+    domains = res.domains
+
+    def shorten(row):
+        _, url, slug, domain = row
+        return shlink_api.shorten(
+            url=url, slug=slug, alt_domain=domain or default_domain, domains=domains, verify=verify
+        )
+
+    failed = 0
+    for (line, url, slug, domain), resp, error in run_ordered(shorten, read_bulk_rows(file), workers=workers):
+        result = {"line": line, "url": url, "slug": slug, "domain": domain or default_domain}
+        if error or not resp.ok():
+            failed += 1
+            result.update(ok=False, error=str(error) if error else resp.message)
+        else:
+            result.update(ok=True, short_code=resp.short_code, short_url=resp.short_url)
+        typer.echo(json.dumps(result))
+    return 1 if failed else 0
 
 
 @app.command()
 def create_shorturl(
-    url: str, slug: Optional[str] = typer.Argument(None), alt_domain: Optional[str] = typer.Argument("arv.cx")
+    url: Optional[str] = typer.Argument(None),
+    slug: Optional[str] = typer.Argument(None),
+    alt_domain: Optional[str] = typer.Argument(DEFAULT_DOMAIN),
+    file: Optional[typer.FileText] = typer.Option(
+        None, "--file", "-f", help="CSV of url[,slug[,domain]] rows to shorten in bulk, '-' for stdin"
+    ),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent requests in bulk mode"),
+    verify: bool = typer.Option(
+        False, "--verify", help="Confirm a URL found in the url index with the server before reusing it"
+    ),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format, bulk mode always writes JSON lines"),
 ):
+    shlink_api = get_shlink_api()
+    if file:
+        raise typer.Exit(code=shorten_bulk(file, alt_domain, workers, verify))
+    if not url:
+        typer.echo("Please provide an url or a file with --file")
+        raise typer.Exit(code=1)
+    if get_mutation_queue() is not None:
+        if not shlink_api.validate_url(url):
+            message = "Please provide a valid url, make sure the url contains either http:// or https:// prefix"
+            return echo_error(message, output)
+        domain = (alt_domain or shlink_api.API_DOMAIN).lower()
+        key = f"{domain}/{slug}" if slug else f"{domain} {normalize_url(url)}"
+        payload = {"url": url, "slug": slug, "alt_domain": alt_domain, "verify": verify}
+        return enqueue_shlink(key, "shorten", payload, output, "Short URL")
     try:
-        resp = shlink_api.shorten(url=url, slug=slug, alt_domain=alt_domain)
+        resp = shlink_api.shorten(url=url, slug=slug, alt_domain=alt_domain, verify=verify)
     except Exception as e:
-        return typer.echo(e)
+        return echo_error(e, output)
     if not resp.ok():
-        return typer.echo(resp.message)
-    typer.echo(resp.short_url)
+        return echo_error(resp.message, output)
+    result = {"url": url, "short_code": resp.short_code, "short_url": resp.short_url}
+    write_record(output, result, text=lambda x: x["short_url"])
     copy_to_clipboard(resp.short_url)
 
 
+def read_identifier_rows(file: TextIO, columns: int) -> Iterator[Tuple[int, List[Optional[str]]]]:
+    # Streams (line, [identifier, ...]) rows padded to `columns`, the header row is optional
+    for line, row in enumerate(csv.reader(file), 1):
+        row = [x.strip() for x in row]
+        if not row or not row[0] or row[0].startswith("#"):
+            continue
+        if line == 1 and row[0].lower() in ("identifier", "url_identifier"):
+            continue
+        yield line, [x or None for x in (row + [None] * columns)[:columns]]
+
+
+def change_bulk(rows: List[Tuple[int, List[Optional[str]]]], edit: bool, workers: int) -> int:
+    # Resolves the domains once and validates every row before the first request, nothing is changed if any row is
+    # invalid. Rows are (line, [identifier]) for deletes and (line, [identifier, new url]) for edits.
+    shlink_api = get_shlink_api()
+    res, identifiers = shlink_api.resolve_identifiers([x[0] for _, x in rows])
+    if not res.ok():
+        typer.echo(res.message)
+        return 1
+
+    invalid, seen = [], {}
+    for (line, (identifier, *new_url)), parsed in zip(rows, identifiers):
+        short_code = parsed.get_short_code()
+        key = (parsed.is_domain_specified()[1], short_code)
+        if not short_code or "/" in short_code or any(x.isspace() for x in short_code):
+            error = "Not a short code, short URL or domain/short code"
+        elif edit and not (new_url[0] and shlink_api.validate_url(new_url[0])):
+            error = "The new url must contain either http:// or https:// prefix"
+        elif key in seen:
+            error = f"Same short URL as line {seen[key]}"
+        else:
+            seen[key] = line
+            continue
+        invalid.append({"line": line, "identifier": identifier, "ok": False, "error": error})
+    if invalid:
+        for result in invalid:
+            typer.echo(json.dumps(result))
+        typer.echo(f"{len(invalid)} invalid of {len(rows)}, nothing was changed", err=True)
+        return 1
+
+    def change(row):
+        _, (identifier, *new_url) = row
+        if edit:
+            return shlink_api.edit_short_url(identifier, new_url[0], domains=res.domains)
+        return shlink_api.delete_short_url(identifier, domains=res.domains)
+
+    failed = 0
+    for (line, (identifier, *new_url)), resp, error in run_ordered(change, rows, workers=workers):
+        result = {"line": line, "identifier": identifier, **({"new_url": new_url[0]} if edit else {})}
+        if error or not resp.ok():
+            failed += 1
+            result.update(ok=False, error=str(error) if error else resp.message)
+        else:
+            result.update(ok=True)
+        typer.echo(json.dumps(result))
+    typer.echo(f"{len(rows) - failed} {'updated' if edit else 'deleted'}, {failed} failed", err=True)
+    return 1 if failed else 0
+
+
 @app.command()
-def delete_shorturl(url_identifier: str):
+def delete_shorturl(
+    url_identifiers: Optional[List[str]] = typer.Argument(None),
+    file: Optional[typer.FileText] = typer.Option(
+        None, "--file", "-f", help="Identifiers to delete in bulk, one per line, '-' for stdin"
+    ),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent requests in bulk mode"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format, bulk mode always writes JSON lines"),
+):
+    shlink_api = get_shlink_api()
+    if file or len(url_identifiers or []) > 1:
+        rows = list(read_identifier_rows(file, 1)) if file else [(i, [x]) for i, x in enumerate(url_identifiers, 1)]
+        raise typer.Exit(code=change_bulk(rows, edit=False, workers=workers))
+    if not url_identifiers:
+        typer.echo("Please provide an identifier or a file with --file")
+        raise typer.Exit(code=1)
+    if get_mutation_queue() is not None:
+        key = short_url_key(url_identifiers[0])
+        return enqueue_shlink(key, "delete", {"identifier": url_identifiers[0]}, output, "Deletion")
     try:
-        resp = shlink_api.delete_short_url(url_identifier)
+        resp = shlink_api.delete_short_url(url_identifiers[0])
     except Exception as e:
-        return typer.echo(e)
+        resp = ShlinkResponse(is_ok=False, status_code=None, message=str(e))
     if not resp.ok():
-        return typer.echo(resp.message)
-    typer.echo("URL successfully deleted")
+        # Fails like bulk mode does, batch and scripts tell a failed delete by the exit code
+        echo_error(resp.message, output)
+        raise typer.Exit(code=1)
+    write_record(output, {"identifier": url_identifiers[0], "ok": True}, text=lambda x: "URL successfully deleted")
 
 
 @app.command()
-def edit_shorturl(url_identifier: str, new_url: str):
+def edit_shorturl(
+    url_identifier: Optional[str] = typer.Argument(None),
+    new_url: Optional[str] = typer.Argument(None),
+    file: Optional[typer.FileText] = typer.Option(
+        None, "--file", "-f", help="CSV of identifier,new_url rows to edit in bulk, '-' for stdin"
+    ),
+    workers: int = typer.Option(8, min=1, help="Maximum number of concurrent requests in bulk mode"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format, bulk mode always writes JSON lines"),
+):
+    shlink_api = get_shlink_api()
+    if file:
+        raise typer.Exit(code=change_bulk(list(read_identifier_rows(file, 2)), edit=True, workers=workers))
+    if not url_identifier or not new_url:
+        typer.echo("Please provide an identifier and the new url, or a file with --file")
+        raise typer.Exit(code=1)
+    if get_mutation_queue() is not None:
+        if not shlink_api.validate_url(new_url):
+            echo_error(
+                "Please provide a valid url, make sure the new url contains either http:// or https:// prefix", output
+            )
+            raise typer.Exit(code=1)
+        payload = {"identifier": url_identifier, "url": new_url}
+        return enqueue_shlink(short_url_key(url_identifier), "edit", payload, output, "Update")
     try:
         resp = shlink_api.edit_short_url(url_identifier, new_url)
     except Exception as e:
-        return typer.echo(e)
+        resp = ShlinkResponse(is_ok=False, status_code=None, message=str(e))
     if not resp.ok():
-        return typer.echo(resp.message)
-    typer.echo("URL successfully updated")
+        echo_error(resp.message, output)
+        raise typer.Exit(code=1)
+    result = {"identifier": url_identifier, "new_url": new_url, "ok": True}
+    write_record(output, result, text=lambda x: "URL successfully updated")
+
+
+def write_short_urls(short_urls: Iterable[ShlinkShortURL], format: OutputFormat, file: TextIO) -> int:
+    # Rows are written as pages arrive, nothing is buffered beyond the pages in flight
+    with RecordWriter(format, file, fields=ShlinkShortURL.FIELDS) as writer:
+        for short_url in short_urls:
+            writer.write(short_url)
+    return writer.count
+
+
+@app.command()
+def list_shorturls(
+    tag: List[str] = typer.Option(None, "--tag", "-t", help="Only short URLs with this tag, can be repeated"),
+    all_tags: bool = typer.Option(False, "--all-tags", help="Require every --tag instead of any of them"),
+    domain: Optional[str] = typer.Option(None, help="Only short URLs of this domain, DEFAULT for the default one"),
+    since: Optional[datetime] = typer.Option(None, help="Only short URLs created at or after this date"),
+    until: Optional[datetime] = typer.Option(None, help="Only short URLs created at or before this date"),
+    search: Optional[str] = typer.Option(None, help="Only short URLs matching this search term"),
+    format: OutputFormat = typer.Option("text", "--output", "--format", help="Output format"),
+    out: Optional[Path] = typer.Option(
+        None, "--out", "-o", dir_okay=False, help="Write to this file instead of stdout"
+    ),
+    page_size: int = typer.Option(500, min=1, help="Short URLs per page"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of pages fetched concurrently"),
+):
+    shlink_api = get_shlink_api()
+    try:
+        total, short_urls = shlink_api.list_short_urls(
+            tags=tag,
+            match_all_tags=all_tags,
+            domain=domain,
+            start_date=since,
+            end_date=until,
+            search_term=search,
+            page_size=page_size,
+            workers=workers,
+        )
+        with typer.open_file(str(out) if out else "-", "w", encoding="utf-8") as file:
+            count = write_short_urls(short_urls, format, file)
+    except Exception as e:
+        # stdout may be the export itself, keep errors out of it
+        typer.echo(e, err=True)
+        raise typer.Exit(code=1)
+    if out:
+        typer.echo(f"{count} short URLs exported to {out}")
+
+
+@app.command()
+def sync_visits(
+    tag: List[str] = typer.Option(None, "--tag", "-t", help="Only short URLs with this tag, can be repeated"),
+    domain: Optional[str] = typer.Option(None, help="Only short URLs of this domain, DEFAULT for the default one"),
+    full: bool = typer.Option(False, "--full", help="Fetch every visit again instead of only new ones"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of short URLs synced concurrently"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format of the summary"),
+):
+    shlink_api = get_shlink_api()
+    store = get_visit_store()
+    state = {} if full else store.sync_state()
+    unchanged = 0
+
+    def changed_short_urls() -> Iterator[Tuple[ShlinkShortURL, Optional[str]]]:
+        # Short URLs whose visit count didn't move since the last sync are skipped without a request
+        nonlocal unchanged
+        for short_url in short_urls:
+            high_water, count = state.get((short_url.domain or "", short_url.short_code), (None, None))
+            if count is not None and count == short_url.visits:
+                unchanged += 1
+                continue
+            yield short_url, high_water
+
+    def fetch(item: Tuple[ShlinkShortURL, Optional[str]]):
+        short_url, since = item
+        return shlink_api.get_visits(short_url.short_code, domain=short_url.domain, start_date=since)
+
+    new_visits = synced = failed = 0
+    try:
+        _, short_urls = shlink_api.list_short_urls(tags=tag, domain=domain, workers=workers)
+        for (short_url, since), visits, error in run_ordered(fetch, changed_short_urls(), workers):
+            if error:
+                failed += 1
+                typer.echo(f"{short_url.short_url}: {error}", err=output != OutputFormat.text)
+                continue
+            new_visits += store.store(short_url.domain, short_url.short_code, visits, since, short_url.visits)
+            synced += 1
+    except Exception as e:
+        echo_error(e, output)
+        raise typer.Exit(code=1)
+    summary = {"new_visits": new_visits, "synced": synced, "unchanged": unchanged, "failed": failed}
+    write_record(
+        output,
+        summary,
+        text=lambda x: f"{x['new_visits']} new visits from {x['synced']} short URLs, {x['unchanged']} unchanged",
+    )
+    if failed:
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def visits_report(
+    days: int = typer.Option(7, min=1, help="Number of days to report, ending today"),
+    since: Optional[datetime] = typer.Option(None, help="Report every day from this date instead of --days"),
+    top: int = typer.Option(10, min=1, help="Short URLs listed per day"),
+    output: OutputFormat = typer.Option("text", "--output", help="Output format"),
+):
+    since = (since.date() if since else date.today() - timedelta(days=days - 1)).isoformat()
+    if output != OutputFormat.text:
+        with RecordWriter(output, fields=("day", "domain", "short_code", "visits")) as writer:
+            for day, domain, short_code, visits in get_visit_store().top_by_day(since, top):
+                writer.write({"day": day, "domain": domain, "short_code": short_code, "visits": visits})
+        return
+    current_day = None
+    for day, domain, short_code, visits in get_visit_store().top_by_day(since, top):
+        if day != current_day:
+            if current_day is not None:
+                typer.echo()
+            typer.echo(day)
+            current_day = day
+        typer.echo(f"{visits:>8}  {f'{domain}/' if domain else ''}{short_code}")
+    if current_day is None:
+        typer.echo(f"No visits since {since}, run sync-visits first")
+
+
+url_index_app = typer.Typer(help="Local index of shortened URLs that answers repeated create-shorturl calls")
+app.add_typer(url_index_app, name="url-index")
+
+
+def get_enabled_url_index() -> ShlinkURLIndex:
+    url_index = get_url_index()
+    if url_index is None:
+        typer.echo("The url index is disabled, URL_INDEX_SIZE is 0")
+        raise typer.Exit(code=1)
+    return url_index
+
+
+@url_index_app.command("seed")
+def seed_url_index(
+    tag: List[str] = typer.Option(None, "--tag", "-t", help="Only short URLs with this tag, can be repeated"),
+    domain: Optional[str] = typer.Option(None, help="Only short URLs of this domain, DEFAULT for the default one"),
+    workers: int = typer.Option(8, min=1, help="Maximum number of pages fetched concurrently"),
+):
+    url_index = get_enabled_url_index()
+    shlink_api = get_shlink_api()
+    try:
+        _, short_urls = shlink_api.list_short_urls(tags=tag, domain=domain, workers=workers)
+        added = url_index.add_many(shlink_api.API_DOMAIN, short_urls)
+    except Exception as e:
+        typer.echo(e)
+        raise typer.Exit(code=1)
+    typer.echo(f"{added} short URLs added, {url_index.stats()['entries']} in the index")
+
+
+@url_index_app.command("verify")
+def verify_url_index(workers: int = typer.Option(8, min=1, help="Maximum number of concurrent requests")):
+    get_enabled_url_index()
+    try:
+        confirmed, removed = get_shlink_api().verify_url_index(workers=workers)
+    except Exception as e:
+        typer.echo(e)
+        raise typer.Exit(code=1)
+    typer.echo(f"{confirmed} short URLs confirmed, {removed} stale ones removed")
+
+
+@url_index_app.command("stats")
+def url_index_stats(output: OutputFormat = typer.Option("text", "--output", help="Output format")):
+    stats = get_enabled_url_index().stats()
+    if output != OutputFormat.text:
+        return write_record(output, stats)
+    typer.echo(f"Entries     : {stats['entries']} of {stats['max_entries']}")
+    typer.echo(f"Domains     : {stats['domains']}")
+
+
+@url_index_app.command("clear")
+def clear_url_index():
+    typer.echo(f"Removed {get_enabled_url_index().clear()} short URLs")
@@ -1,31 +1,173 @@
 from utilcli.modules import UtilAPI
-from utilcli.utility import CONFIG
+from utilcli.modules.UtilAPI import LyricsItem, LyricsPrefetcher
+from utilcli.modules.Tracer import get_tracer
+from utilcli.modules.Output import OutputFormat, RecordWriter
+from utilcli.utility import configure_limits, echo_error, get_config, get_http_transport
+from typing import Iterator, List, Optional, Tuple
+from functools import lru_cache
 from operator import itemgetter
-from typing import Optional
+import threading
 import typer
+import click
+import sys
+import os
 
 
-host, port = itemgetter("HOST", "PORT")(CONFIG.get("utilapi"))
-utilapi = UtilAPI(host, port)
+@lru_cache(maxsize=None)
+@get_tracer().span("utilapi client")
+def get_utilapi() -> UtilAPI:
+    host, port = itemgetter("HOST", "PORT")(get_config("utilapi"))
+    utilapi = UtilAPI(host, port, transport=get_http_transport())
+    configure_limits("utilapi", utilapi.base_url)
+    return utilapi
 
 
-def lyrics(keyword: str, provider: Optional[str] = typer.Argument(None)):
+class SearchResults:
+    def __init__(self, prefetcher: LyricsPrefetcher) -> None:
+        self.__prefetcher = prefetcher
+        self.__items: List[LyricsItem] = []
+        self.__seen = set()
+        self.__lock = threading.Lock()
+
+    def add(self, items: List[LyricsItem]) -> List[Tuple[int, LyricsItem]]:
+        added = []
+        with self.__lock:
+            for item in items:
+                key = ((item.artist or "").strip().casefold(), (item.title or "").strip().casefold())
+                if key in self.__seen:
+                    continue
+                self.__seen.add(key)
+                self.__items.append(item)
+                self.__prefetcher.prefetch(item)
+                added.append((len(self.__items), item))
+        return added
+
+    def get(self, choice: int) -> Optional[LyricsItem]:
+        with self.__lock:
+            return self.__items[choice - 1] if 1 <= choice <= len(self.__items) else None
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__items)
+
+
+def echo_results(added: List[Tuple[int, LyricsItem]]) -> None:
+    if added:
+        typer.echo("\n".join(f"[{index}] {x.artist} {x.title}" for index, x in added))
+
+
+def search_in_background(utilapi: UtilAPI, keyword: str, source: Optional[List[str]], timeout: float, results):
+    responses = utilapi.search_lyrics_parallel(query=keyword, source=source, timeout=timeout)
+    first_response = threading.Event()
+    typer.echo("[0] Cancel")
+
+    def consume():
+        for provider, res in responses:
+            if res.ok():
+                echo_results(results.add(res.results))
+            else:
+                typer.echo(f"{provider}: {res.message}", err=True)
+            if len(results):
+                first_response.set()
+        first_response.set()
+
+    threading.Thread(target=consume, name="lyrics-search", daemon=True).start()
+    first_response.wait()
+
+
+def write_search_results(
+    utilapi: UtilAPI, keyword: str, source: Optional[List[str]], parallel: bool, timeout: float, output: OutputFormat
+) -> None:
+    # Every result as a record as soon as it's found, nothing is prompted for
+    results = SearchResults(LyricsPrefetcher(0))
+
+    def batches() -> Iterator[List[LyricsItem]]:
+        if not parallel:
+            yield from ([x] for x in utilapi.stream_search_lyrics(query=keyword, source=source))
+            return
+        for provider, res in utilapi.search_lyrics_parallel(query=keyword, source=source, timeout=timeout):
+            if not res.ok():
+                typer.echo(f"{provider}: {res.message}", err=True)
+            yield res.results
+
+    with RecordWriter(output, fields=("index", "title", "artist", "provider")) as writer:
+        for batch in batches():
+            for index, item in results.add(batch):
+                writer.write({"index": index, **item.to_dict()})
+
+
+def show_lyrics(chunks: Iterator[str], pager: Optional[bool]) -> None:
+    # Written as the chunks arrive so the first lines show up while the rest is still downloading
+    def text() -> Iterator[str]:
+        try:
+            yield from chunks
+        except Exception as e:
+            yield f"\n{e}"
+
+    if pager is None:
+        pager = bool(os.environ.get("PAGER")) and sys.stdout.isatty()
+    if pager:
+        return click.echo_via_pager(text())
+    output = text()
+    first = next(output, "")
+    typer.clear()
+    typer.echo(first, nl=False)
+    for chunk in output:
+        typer.echo(chunk, nl=False)
+    typer.echo()
+
+
+def lyrics(
+    keyword: str,
+    provider: Optional[str] = typer.Argument(None),
+    prefetch: Optional[int] = typer.Option(
+        None, min=0, help="Number of top results to fetch in the background while choosing  [default: 3]"
+    ),
+    parallel: bool = typer.Option(
+        False, "--parallel", help="Query every provider separately and show results as they arrive"
+    ),
+    timeout: float = typer.Option(10, min=0, help="Seconds to wait for the providers with --parallel"),
+    pager: Optional[bool] = typer.Option(
+        None, "--pager/--no-pager", help="Show the lyrics through $PAGER  [default: when $PAGER is set on a terminal]"
+    ),
+    output: OutputFormat = typer.Option(
+        "text", "--output", help="Print the search results in this format instead of choosing one"
+    ),
+):
+    utilapi = get_utilapi()
+    source = provider.split(",") if provider else None
+    if output != OutputFormat.text:
+        try:
+            return write_search_results(utilapi, keyword, source, parallel, timeout, output)
+        except Exception as e:
+            return echo_error(e, output)
+    if prefetch is None:
+        prefetch = get_config("utilapi").get("PREFETCH", 3)
+    prefetcher = LyricsPrefetcher(prefetch)
+    results = SearchResults(prefetcher)
+
     try:
-        r = utilapi.search_lyrics(query=keyword, source=provider.split(",") if provider else None)
+        if parallel:
+            search_in_background(utilapi, keyword, source, timeout, results)
+        else:
+            # Results are listed as the server sends them when it supports NDJSON
+            items = utilapi.stream_search_lyrics(query=keyword, source=source)
+            typer.echo("[0] Cancel")
+            for item in items:
+                echo_results(results.add([item]))
     except Exception as e:
         return typer.echo(e)
 
-    if not r.ok():
-        return typer.echo(r.message)
-    results = [f"[{index}] {x.artist} {x.title}" for index, x in enumerate(r.results, 1)]
-    typer.echo("[0] Cancel")
-    typer.echo("\n".join(results))
-    while True:
-        choice = typer.prompt("")
-        choice = int(choice) if choice.isdigit() else -1
-        if choice == 0:
-            return
-        if 1 <= choice <= len(results):
-            typer.clear()
-            typer.echo(r.results[choice - 1].get_lyrics())
-            break
+    if len(results) == 0:
+        return typer.echo("No lyrics found")
+    try:
+        while True:
+            choice = typer.prompt("")
+            choice = int(choice) if choice.isdigit() else -1
+            if choice == 0:
+                return
+            item = results.get(choice)
+            if item:
+                return show_lyrics(prefetcher.stream_lyrics(item), pager)
+    finally:
+        prefetcher.close()
@@ -0,0 +1,287 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional
+import threading
+import socket
+import json
+import stat
+import time
+import sys
+import os
+import io
+
+# Interactive or long running commands always run in the calling process
+FORWARDED_GROUPS = ("porkbun", "shlink")
+NOT_FORWARDED = (("porkbun", "ddns"),)
+
+
+def socket_path() -> str:
+    if os.environ.get("UTILCLI_SOCKET"):
+        return os.environ["UTILCLI_SOCKET"]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+    return os.path.join(runtime_dir, f"utilcli-{os.getuid()}.sock")
+
+
+def is_private(path: str) -> bool:
+    # Another local user could create the socket first, e.g. in a shared temp dir, and would receive every forwarded
+    # command line and cwd. Only a socket of our own that nobody else can replace is used.
+    try:
+        info, parent = os.lstat(path), os.stat(os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        return False
+    return parent.st_uid in (0, os.getuid()) and (not parent.st_mode & 0o022 or bool(parent.st_mode & stat.S_ISVTX))
+
+
+def _read_message(reader: BinaryIO) -> Optional[Dict]:
+    line = reader.readline()
+    return json.loads(line) if line else None
+
+
+def _send_message(sock: socket.socket, message: Dict) -> None:
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def connect(path: str = None) -> Optional[socket.socket]:
+    # None when no daemon is listening
+    path = path if path else socket_path()
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    if not is_private(path):
+        sys.stderr.write(f"Ignoring the util daemon socket {path}, it isn't private to this user\n")
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(message: Dict, path: str = None) -> Optional[Dict]:
+    # A single reply, None when no daemon is listening
+    sock = connect(path)
+    if sock is None:
+        return None
+    with sock, sock.makefile("rb") as reader:
+        _send_message(sock, message)
+        return _read_message(reader)
+
+
+def forward(argv: List[str]) -> Optional[int]:
+    # Runs the command in a running daemon and returns its exit code, None when it has to run in-process instead
+    if os.environ.get("UTILCLI_NO_DAEMON") or os.environ.get("UTILCLI_TRACE"):
+        return None
+    if not argv or argv[0] not in FORWARDED_GROUPS or tuple(argv[:2]) in NOT_FORWARDED:
+        return None
+    message = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "config_home": os.environ.get("XDG_CONFIG_HOME"),
+    }
+    sock = connect()
+    if sock is None:
+        return None
+    # The daemon replies with the command's output as it's written and its exit code at the end
+    with sock, sock.makefile("rb") as reader:
+        try:
+            _send_message(sock, message)
+            while True:
+                response = _read_message(reader)
+                if response is None:
+                    raise OSError("the daemon closed the connection")
+                if response.get("fallback"):
+                    return None
+                if "exit_code" in response:
+                    return response["exit_code"]
+                stream = sys.stdout if "stdout" in response else sys.stderr
+                stream.write(response.get("stdout", response.get("stderr")))
+                stream.flush()
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Lost the connection to the util daemon: {e}\n")
+            return 1
+
+
+class SocketOutput(io.TextIOBase):
+    # Stands in for sys.stdout/sys.stderr while a forwarded command runs, every write is sent to the client right
+    # away so listings stream like they do in-process
+    encoding = "utf-8"
+    errors = "strict"
+
+    def __init__(self, connection: socket.socket, name: str, lock: threading.Lock) -> None:
+        self.__connection = connection
+        self.__name = name
+        self.__lock = lock
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: str) -> int:
+        if not isinstance(data, str):
+            raise TypeError(f"write() argument must be str, not {type(data).__name__}")
+        if data:
+            # Bulk commands write from their worker threads
+            with self.__lock:
+                _send_message(self.__connection, {self.__name: data})
+        return len(data)
+
+
+class DaemonServer:
+    def __init__(self, path: str = None, idle_timeout: float = 0) -> None:
+        self.PATH = path if path else socket_path()
+        self.IDLE_TIMEOUT = idle_timeout
+        # Commands share the process wide cwd and std streams, and cached clients may hold thread bound SQLite
+        # connections, so they all run one at a time on the same thread
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__pending = 0
+        self.__lock = threading.Lock()
+        self.__last_request = time.monotonic()
+        self.__stopped = threading.Event()
+        self.__socket: Optional[socket.socket] = None
+        self.__config_version = None
+
+    def __reload_config(self) -> None:
+        # The parsed config and every client built from it are cached for the daemon's life, an edited config file
+        # drops them so the next command starts from the new one
+        from utilcli.utility import get_config_path
+
+        try:
+            info = os.stat(get_config_path())
+            version = (info.st_mtime_ns, info.st_size, info.st_ino)
+        except OSError:
+            version = None
+        if version == self.__config_version:
+            return
+        self.__config_version = version
+        for name, module in list(sys.modules.items()):
+            if not name.startswith("utilcli."):
+                continue
+            for value in list(vars(module).values()):
+                if callable(getattr(value, "cache_clear", None)):
+                    value.cache_clear()
+
+    def __execute(self, message: Dict, connection: socket.socket) -> int:
+        from utilcli.commands.batch import reads_stdin
+        from utilcli.main import app
+        import traceback
+        import typer
+        import click
+
+        command = typer.main.get_command(app)
+        group = command.get_command(click.Context(command, info_name="util"), message["argv"][0])
+        # Started for another config, or reading stdin: the client runs the command itself, a piped bulk run streams
+        # its input in-process instead of being read whole into memory first
+        if message.get("config_home") != os.environ.get("XDG_CONFIG_HOME") or reads_stdin(group, message["argv"][1:]):
+            _send_message(connection, {"fallback": True})
+            return None
+
+        self.__reload_config()
+        lock = threading.Lock()
+        streams = sys.stdin, sys.stdout, sys.stderr
+        previous = os.getcwd()
+        try:
+            os.chdir(message["cwd"])
+            sys.stdin = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+            sys.stdout, sys.stderr = SocketOutput(connection, "stdout", lock), SocketOutput(connection, "stderr", lock)
+            try:
+                command.main(message["argv"], prog_name="util")
+                exit_code = 0
+            except SystemExit as e:
+                if isinstance(e.code, str):
+                    sys.stderr.write(f"{e.code}\n")
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                # Fails in turn when the client has gone away, the connection is dropped without an exit code
+                sys.stderr.write(traceback.format_exc())
+                exit_code = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = streams
+            os.chdir(previous)
+        return exit_code
+
+    def __handle(self, connection: socket.socket) -> None:
+        with connection, connection.makefile("rb") as reader:
+            try:
+                message = _read_message(reader)
+                if message is None:
+                    return
+                if message.get("ping"):
+                    _send_message(connection, {"pid": os.getpid()})
+                    return
+                if message.get("stop"):
+                    _send_message(connection, {"stopped": True})
+                    self.stop()
+                    return
+                with self.__lock:
+                    self.__pending += 1
+                try:
+                    exit_code = self.__executor.submit(self.__execute, message, connection).result()
+                finally:
+                    with self.__lock:
+                        self.__pending -= 1
+                        self.__last_request = time.monotonic()
+                if exit_code is not None:
+                    _send_message(connection, {"exit_code": exit_code})
+            except (OSError, ValueError):
+                pass
+
+    def __watch_idle(self) -> None:
+        while not self.__stopped.wait(min(self.IDLE_TIMEOUT, 60)):
+            with self.__lock:
+                idle = not self.__pending and time.monotonic() - self.__last_request > self.IDLE_TIMEOUT
+            if idle:
+                self.stop()
+
+    def bind(self) -> None:
+        if request({"ping": True}, self.PATH) is not None:
+            raise Exception(f"A daemon is already listening on {self.PATH}")
+        if os.path.exists(self.PATH):
+            # Left behind by a daemon that didn't exit cleanly
+            os.unlink(self.PATH)
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        previous_umask = os.umask(0o177)
+        try:
+            self.__socket.bind(self.PATH)
+        finally:
+            os.umask(previous_umask)
+        self.__socket.listen(64)
+
+    def serve_forever(self) -> None:
+        if self.__socket is None:
+            self.bind()
+        if self.IDLE_TIMEOUT:
+            threading.Thread(target=self.__watch_idle, daemon=True).start()
+        try:
+            while not self.__stopped.is_set():
+                try:
+                    connection, _ = self.__socket.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self.__handle, args=(connection,), daemon=True).start()
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        self.__stopped.set()
+        if self.__socket is not None:
+            # Wakes up the accept loop, closing the socket alone doesn't
+            try:
+                self.__socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.__socket.close()
+            self.__socket = None
+            if os.path.exists(self.PATH):
+                os.unlink(self.PATH)
+
+
+def main() -> None:
+    # Entry point of the `util` script. It stays on the standard library until it knows the command can't be
+    # forwarded to a daemon, that's what makes forwarded invocations cheap.
+    exit_code = forward(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+    from utilcli.main import app
+
+    app()
@@ -1,9 +1,47 @@
-from utilcli.commands import shlink, porkbun, lyrics
+from utilcli.commands import LazyGroup
+from typing import Optional
+from enum import Enum
 import typer
 
-app = typer.Typer()
-app.add_typer(shlink, name="shlink")
-app.add_typer(porkbun, name="porkbun")
+# Subcommands are registered lazily, see utilcli.commands.LAZY_COMMANDS
+app = typer.Typer(cls=LazyGroup)
 
-# Base level command
-app.command()(lyrics)
+
+class TraceFormat(str, Enum):
+    summary = "summary"
+    chrome = "chrome"
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    trace: Optional[str] = typer.Option(
+        None,
+        envvar="UTILCLI_TRACE",
+        metavar="FILE",
+        help="Record timings of config loading, client setup and every request to FILE, - for stderr",
+    ),
+    trace_format: TraceFormat = typer.Option(
+        "summary",
+        envvar="UTILCLI_TRACE_FORMAT",
+        help="JSON summary, or a Chrome trace-event file for chrome://tracing or Perfetto",
+    ),
+):
+    if not trace:
+        return
+    from utilcli.modules.Tracer import get_tracer
+
+    tracer = get_tracer()
+    tracer.enable()
+
+    def write_trace():
+        output = tracer.dump(trace_format.value)
+        if trace == "-":
+            typer.echo(output, err=True)
+        else:
+            with open(trace, "w") as file:
+                file.write(output)
+
+    # Resources are released in reverse, so the command span is closed before the trace is written
+    ctx.call_on_close(write_trace)
+    ctx.with_resource(tracer.span(f"util {ctx.invoked_subcommand}", "command"))
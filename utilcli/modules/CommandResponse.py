@@ -1,3 +1,7 @@
+from utilcli.modules.Output import to_json
+from typing import Dict
+
+
 class CommandResponse:
     def __init__(self, is_ok: bool, message: str = None) -> None:
         self.is_ok = is_ok
@@ -5,3 +9,6 @@ class CommandResponse:
 
     def ok(self) -> bool:
         return self.is_ok
+
+    def to_dict(self) -> Dict:
+        return {name: to_json(value) for name, value in vars(self).items() if not name.startswith("_")}
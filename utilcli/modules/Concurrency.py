@@ -0,0 +1,105 @@
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Tuple, Union
+from collections import deque
+import threading
+
+
+def run_concurrently(
+    func: Callable[[Any], Any], items: Iterable[Any], workers: int = 8
+) -> Iterator[Tuple[Any, Any, Exception]]:
+    # Yields (item, result, error) in completion order, at most `workers` calls in flight
+    if workers < 1:
+        raise Exception("Number of workers must be at least 1")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+def _settle(item: Any, future: Future) -> Tuple[Any, Any, Exception]:
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+def run_ordered(
+    func: Callable[[Any], Any], items: Iterable[Any], workers: int = 8
+) -> Iterator[Tuple[Any, Any, Exception]]:
+    # Yields (item, result, error) in input order, consuming `items` lazily so memory stays bounded
+    if workers < 1:
+        raise Exception("Number of workers must be at least 1")
+    window = workers * 2
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                yield _settle(*pending.popleft())
+        while pending:
+            yield _settle(*pending.popleft())
+
+
+def _copy_outcome(source: Future, target: Future) -> None:
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def run_keyed(
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    key: Callable[[Any], Union[Hashable, List[Hashable]]],
+    workers: int = 8,
+) -> Iterator[Tuple[Any, Any, Exception]]:
+    # Like run_ordered, but items with the same key run one after another in input order. A waiting item is chained
+    # to the future of the previous one instead of holding a worker. A list of keys also waits for the last items of
+    # the other keys, the item is only ordered against later items of its first key.
+    if workers < 1:
+        raise Exception("Number of workers must be at least 1")
+    window = workers * 2
+    tails: Dict[Hashable, Future] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit(item: Any, previous: List[Future]) -> Future:
+            previous = [x for x in previous if not x.done()]
+            if not previous:
+                return executor.submit(func, item)
+            chained, waiting, lock = Future(), [len(previous)], threading.Lock()
+
+            def start(_):
+                with lock:
+                    waiting[0] -= 1
+                    if waiting[0]:
+                        return
+                try:
+                    executor.submit(func, item).add_done_callback(lambda x: _copy_outcome(x, chained))
+                except RuntimeError as e:
+                    # The executor was shut down because the caller stopped consuming results
+                    chained.set_exception(e)
+
+            for future in previous:
+                future.add_done_callback(start)
+            return chained
+
+        def settle(item_key: Hashable, item: Any, future: Future) -> Tuple[Any, Any, Exception]:
+            outcome = _settle(item, future)
+            if tails.get(item_key) is future:
+                del tails[item_key]
+            return outcome
+
+        pending = deque()
+        for item in items:
+            item_keys = key(item)
+            item_keys = item_keys if isinstance(item_keys, list) else [item_keys]
+            item_key = item_keys[0]
+            tails[item_key] = submit(item, [tails[x] for x in item_keys if x in tails])
+            pending.append((item_key, item, tails[item_key]))
+            if len(pending) >= window:
+                yield settle(*pending.popleft())
+        while pending:
+            yield settle(*pending.popleft())
@@ -0,0 +1,71 @@
+from typing import Any, Callable, Dict, Tuple
+from pathlib import Path
+import threading
+import json
+import time
+import os
+
+
+class DiskCache:
+    def __init__(self, path: Path, ttl: int = 3600, stale_ttl: int = 86400) -> None:
+        self.PATH = Path(path)
+        self.TTL = ttl
+        self.STALE_TTL = stale_ttl
+        self.__lock = threading.Lock()
+        self.__refreshing = set()
+
+    def __read(self) -> Dict:
+        try:
+            with open(self.PATH) as cache:
+                return json.loads(cache.read())
+        except (OSError, ValueError):
+            return {}
+
+    def __write(self, entries: Dict) -> None:
+        self.PATH.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.PATH.with_name(f"{self.PATH.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "w") as cache:
+            cache.write(json.dumps(entries))
+        os.replace(temp_path, self.PATH)
+
+    def get(self, key: str) -> Tuple[Any, bool]:
+        # Returns (value, is_fresh); stale entries are still returned until TTL + STALE_TTL has passed
+        entry = self.__read().get(key)
+        if not entry:
+            return None, False
+        age = time.time() - entry.get("stored_at", 0)
+        if age > self.TTL + self.STALE_TTL:
+            return None, False
+        return entry.get("value"), age <= self.TTL
+
+    def set(self, key: str, value: Any) -> None:
+        with self.__lock:
+            entries = self.__read()
+            entries[key] = {"value": value, "stored_at": time.time()}
+            self.__write(entries)
+
+    def invalidate(self, key: str) -> None:
+        with self.__lock:
+            entries = self.__read()
+            if entries.pop(key, None) is not None:
+                self.__write(entries)
+
+    def revalidate(self, key: str, fetch: Callable[[], Any]) -> None:
+        # Refreshes the entry in the background, `fetch` returns None when the value must not be cached
+        with self.__lock:
+            if key in self.__refreshing:
+                return
+            self.__refreshing.add(key)
+
+        def refresh():
+            try:
+                value = fetch()
+                if value is not None:
+                    self.set(key, value)
+            except Exception:
+                pass
+            finally:
+                with self.__lock:
+                    self.__refreshing.discard(key)
+
+        threading.Thread(target=refresh, name=f"revalidate-{key}").start()
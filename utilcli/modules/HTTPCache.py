@@ -0,0 +1,276 @@
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, Optional, Tuple
+from pathlib import Path
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+import zlib
+
+if TYPE_CHECKING:
+    import requests
+
+
+def _cache_control(headers: Dict[str, str]) -> Dict[str, Optional[str]]:
+    directives = {}
+    for directive in (headers.get("Cache-Control") or "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+class CachedResponse:
+    __slots__ = ("key", "url", "status", "headers", "body", "expires_at")
+
+    def __init__(self, key: str, url: str, status: int, headers: Dict[str, str], body: bytes, expires_at: float):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def validators(self) -> Dict[str, str]:
+        # Conditional request headers, the server answers 304 when the stored body is still current
+        validators = {}
+        if self.headers.get("ETag"):
+            validators["If-None-Match"] = self.headers["ETag"]
+        if self.headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = self.headers["Last-Modified"]
+        return validators
+
+    def to_response(self) -> "requests.Response":
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+        from datetime import timedelta
+        import requests
+
+        response = requests.Response()
+        response.status_code = self.status
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = self.url
+        response.reason = "OK"
+        response.elapsed = timedelta(0)
+        response._content = self.body
+        # iter_content replays _content instead of reading from a connection
+        response._content_consumed = True
+        return response
+
+
+class HTTPCache:
+    # On-disk cache of GET responses. Bodies are stored zlib compressed and the least recently used entries are
+    # evicted once the bodies take more than MAX_SIZE bytes. Freshness follows Cache-Control, Expires and Age,
+    # DEFAULT_TTL applies to responses that carry neither. Stale entries with an ETag or Last-Modified are
+    # revalidated with a conditional request.
+    __SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    # Headers that describe the stored body, the rest belong to the exchange that fetched it
+    __STORED_HEADERS = ("Content-Type", "Cache-Control", "ETag", "Last-Modified", "Expires", "Date", "Age", "Vary")
+    COUNTERS = ("hits", "revalidated", "misses", "stored", "evicted")
+
+    def __init__(self, path: Path, max_size: int = 64 << 20, default_ttl: int = 0) -> None:
+        self.PATH = Path(path)
+        self.MAX_SIZE = max_size
+        self.DEFAULT_TTL = default_ttl
+        self.__lock = threading.RLock()
+        self.__connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def __db(self) -> sqlite3.Connection:
+        # Opened on first use, commands that never send a GET don't touch the file
+        with self.__lock:
+            if self.__connection is None:
+                self.PATH.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(self.PATH, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(self.__SCHEMA)
+                self.__connection = connection
+            return self.__connection
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+    @staticmethod
+    def accepts(method: str, kwargs: Dict) -> bool:
+        # Only GETs without a body are cached
+        return method.upper() == "GET" and not kwargs.get("json") and not kwargs.get("data")
+
+    @staticmethod
+    def key(url: str, kwargs: Dict) -> Tuple[str, str]:
+        # (key, full url). Request headers such as API keys are part of the key so accounts never share entries.
+        from requests.models import PreparedRequest
+
+        request = PreparedRequest()
+        request.prepare_url(url, kwargs.get("params"))
+        headers = json.dumps(sorted((k.lower(), v) for k, v in (kwargs.get("headers") or {}).items()))
+        return hashlib.sha256(f"{request.url}\n{headers}".encode()).hexdigest(), request.url
+
+    def __count(self, name: str) -> None:
+        self.__db.execute(
+            "INSERT INTO counters VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def __expires_at(self, headers: Dict[str, str]) -> Optional[float]:
+        # None when the response must not be stored
+        directives = _cache_control(headers)
+        if "no-store" in directives:
+            return None
+        vary = {x.strip().lower() for x in (headers.get("Vary") or "").split(",") if x.strip()}
+        if vary - {"accept-encoding"}:
+            return None
+        now = time.time()
+        if "no-cache" in directives:
+            ttl = 0
+        elif (directives.get("max-age") or "").isdigit():
+            age = headers.get("Age")
+            ttl = int(directives["max-age"]) - (int(age) if age and age.isdigit() else 0)
+        elif _http_date(headers.get("Expires")) is not None:
+            ttl = _http_date(headers["Expires"]) - (_http_date(headers.get("Date")) or now)
+        else:
+            ttl = self.DEFAULT_TTL
+        if ttl <= 0 and not headers.get("ETag") and not headers.get("Last-Modified"):
+            return None
+        return now + max(ttl, 0)
+
+    def lookup(self, key: str) -> Optional[CachedResponse]:
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT url, status, headers, body, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        url, status, headers, body, expires_at = row
+        return CachedResponse(key, url, status, json.loads(headers), zlib.decompress(body), expires_at)
+
+    def hit(self, entry: CachedResponse) -> "requests.Response":
+        with self.__lock, self.__db:
+            self.__db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), entry.key))
+            self.__count("hits")
+        return entry.to_response()
+
+    def update(
+        self, key: str, url: str, entry: Optional[CachedResponse], response: "requests.Response", streamed: bool
+    ) -> "requests.Response":
+        # Handles the server's answer to a miss or a revalidation and returns the response for the caller
+        if entry is not None and response.status_code == 304:
+            headers = {**entry.headers, **self.__stored_headers(response.headers)}
+            expires_at = self.__expires_at(headers)
+            with self.__lock, self.__db:
+                if expires_at is None:
+                    self.__db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                else:
+                    self.__db.execute(
+                        "UPDATE entries SET headers = ?, expires_at = ?, last_used = ? WHERE key = ?",
+                        (json.dumps(headers), expires_at, time.time(), key),
+                    )
+                self.__count("revalidated")
+            return CachedResponse(key, entry.url, entry.status, headers, entry.body, expires_at or 0).to_response()
+
+        headers = self.__stored_headers(response.headers)
+        expires_at = self.__expires_at(headers) if response.status_code == 200 else None
+        with self.__lock, self.__db:
+            self.__count("misses")
+            if expires_at is None and entry is not None:
+                self.__db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if expires_at is None:
+            return response
+        if streamed:
+            # Stored once the caller has read the whole body, a partial read leaves the cache untouched
+            self.__tee(response, lambda body: self.__store(key, url, response.status_code, headers, body, expires_at))
+        else:
+            self.__store(key, url, response.status_code, headers, response.content, expires_at)
+        return response
+
+    def __store(self, key: str, url: str, status: int, headers: Dict[str, str], content: bytes, expires_at: float):
+        body = zlib.compress(content)
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, status, json.dumps(headers), body, len(body), expires_at, time.time()),
+            )
+            self.__count("stored")
+            self.__evict()
+
+    @staticmethod
+    def __tee(response: "requests.Response", on_complete: Callable[[bytes], None]) -> None:
+        # Wraps iter_content, which .content and .text read through as well, to collect the body as it streams by
+        from requests.utils import stream_decode_response_unicode
+
+        iter_content = response.iter_content
+
+        def teeing_iter_content(chunk_size: int = 1, decode_unicode: bool = False) -> Iterator:
+            def chunks() -> Iterator[bytes]:
+                body = []
+                for chunk in iter_content(chunk_size):
+                    body.append(chunk)
+                    yield chunk
+                on_complete(b"".join(body))
+
+            return stream_decode_response_unicode(chunks(), response) if decode_unicode else chunks()
+
+        response.iter_content = teeing_iter_content
+
+    def __stored_headers(self, headers: Dict[str, str]) -> Dict[str, str]:
+        return {name: headers[name] for name in self.__STORED_HEADERS if headers.get(name) is not None}
+
+    def __evict(self) -> None:
+        size = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if size <= self.MAX_SIZE:
+            return
+        evicted = []
+        for key, entry_size in self.__db.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if size <= self.MAX_SIZE:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.__db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self.__db.execute(
+            "INSERT INTO counters VALUES ('evicted', ?) ON CONFLICT (name) DO UPDATE SET value = value + ?",
+            (len(evicted), len(evicted)),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            counters = dict(self.__db.execute("SELECT name, value FROM counters"))
+            entries, size = self.__db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": entries, "size": size, **{name: counters.get(name, 0) for name in self.COUNTERS}}
+
+    def clear(self, reset_counters: bool = False) -> int:
+        with self.__lock, self.__db:
+            cleared = self.__db.execute("DELETE FROM entries").rowcount
+            if reset_counters:
+                self.__db.execute("DELETE FROM counters")
+        self.__db.execute("VACUUM")
+        return cleared
@@ -0,0 +1,175 @@
+from utilcli.modules.RequestScheduler import RequestScheduler, RetryPolicy
+from utilcli.modules.Tracer import Tracer, get_tracer
+from typing import TYPE_CHECKING, Dict, Optional, Tuple, Union
+from urllib.parse import urlparse
+import threading
+import time
+
+if TYPE_CHECKING:
+    from utilcli.modules.HTTPCache import HTTPCache
+    import requests
+
+
+def _traced_pool_classes(tracer: Tracer) -> Dict[str, type]:
+    # Connection pools whose connections report the TCP connect and TLS handshake time to the tracer
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+
+    class TracedConnection:
+        def _new_conn(self):
+            start = time.perf_counter()
+            try:
+                return super()._new_conn()
+            finally:
+                self._traced_connect = time.perf_counter() - start
+                tracer.record_phase("connect", self._traced_connect)
+
+        def connect(self):
+            start, self._traced_connect = time.perf_counter(), 0
+            super().connect()
+            if isinstance(self, HTTPSConnection):
+                tracer.record_phase("tls", time.perf_counter() - start - self._traced_connect)
+
+    class TracedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = type("TracedHTTPConnection", (TracedConnection, HTTPConnection), {})
+
+    class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = type("TracedHTTPSConnection", (TracedConnection, HTTPSConnection), {})
+
+    return {"http": TracedHTTPConnectionPool, "https": TracedHTTPSConnectionPool}
+
+
+class HTTPTransport:
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: Union[float, Tuple[float, float]] = (5, 30),
+        keep_alive: bool = True,
+        retries: int = 3,
+        cache: "HTTPCache" = None,
+    ) -> None:
+        self.POOL_SIZE = pool_size
+        self.TIMEOUT = timeout
+        self.KEEP_ALIVE = keep_alive
+        self.scheduler = RequestScheduler(RetryPolicy(retries=retries))
+        self.cache = cache
+        self.__session = None
+        self.__session_lock = threading.Lock()
+
+    def __build_session(self) -> "requests.Session":
+        # requests is imported on first use so commands that never hit the network don't pay for it
+        from requests.adapters import HTTPAdapter
+        import requests
+
+        session = requests.Session()
+        # One pool per host, each keeping up to POOL_SIZE warm connections for concurrent callers
+        adapter = HTTPAdapter(pool_connections=self.POOL_SIZE, pool_maxsize=self.POOL_SIZE, pool_block=True)
+        if get_tracer().enabled:
+            adapter.poolmanager.pool_classes_by_scheme = _traced_pool_classes(get_tracer())
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Connection"] = "keep-alive" if self.KEEP_ALIVE else "close"
+        return session
+
+    @property
+    def session(self) -> "requests.Session":
+        if self.__session is None:
+            # Concurrent first requests would otherwise each build a session, and a pool, of their own
+            with self.__session_lock:
+                if self.__session is None:
+                    with get_tracer().span("http session"):
+                        self.__session = self.__build_session()
+        return self.__session
+
+    def set_limits(self, url: str, rate: float = None, burst: int = None, retries: int = None) -> None:
+        self.scheduler.set_limits(url, rate=rate, burst=burst, retries=retries)
+
+    @staticmethod
+    def __trace_response(span: Dict, response: "requests.Response", total: float, streamed: bool) -> None:
+        # Splits the request into dns/connect/tls (only on new connections), wait (server time) and download
+        phases = span.setdefault("phases", {})
+        if "connect" in phases:
+            phases["connect"] = max(phases["connect"] - phases.get("dns", 0), 0)
+        until_headers = response.elapsed.total_seconds() * 1000
+        phases["wait"] = max(until_headers - sum(phases.values()), 0)
+        span["status"] = response.status_code
+        if streamed:
+            # The body is read by the caller later on, only its announced size is known here
+            span["bytes"] = int(response.headers.get("Content-Length", 0))
+        else:
+            phases["download"] = max(total * 1000 - until_headers, 0)
+            span["bytes"] = len(response.content)
+        span["reused_connection"] = "connect" not in phases
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        idempotent: bool = None,
+        retry_read_timeout: bool = False,
+        retries: int = None,
+        cache: bool = False,
+        **kwargs,
+    ) -> "requests.Response":
+        # Requests go through the scheduler for per-host rate limiting and retries on 429/5xx, see
+        # RequestScheduler.execute for read timeouts. Only callers passing `cache` use the response cache, reads that
+        # must reflect live state never get a stored answer.
+        kwargs.setdefault("timeout", self.TIMEOUT)
+        session = self.session
+        tracer = get_tracer()
+
+        def send() -> "requests.Response":
+            if not tracer.enabled:
+                return session.request(method=method, url=url, **kwargs)
+            # Every attempt gets its own span, retries show up as repeated requests
+            with tracer.span(f"{method} {urlparse(url).path}", "http", method=method, url=url) as span:
+                start = time.perf_counter()
+                response = session.request(method=method, url=url, **kwargs)
+                self.__trace_response(span, response, time.perf_counter() - start, kwargs.get("stream", False))
+                return response
+
+        if not cache or self.cache is None or not self.cache.accepts(method, kwargs):
+            return self.scheduler.execute(method, url, send, idempotent, retry_read_timeout, retries)
+
+        key, full_url = self.cache.key(url, kwargs)
+        entry = self.cache.lookup(key)
+        if entry is not None and entry.is_fresh():
+            with tracer.span(f"{method} {urlparse(url).path}", "http", method=method, url=url, cache="hit"):
+                return self.cache.hit(entry)
+        if entry is not None:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **entry.validators()}
+        response = self.scheduler.execute(method, url, send, idempotent, retry_read_timeout, retries)
+        return self.cache.update(key, full_url, entry, response, streamed=kwargs.get("stream", False))
+
+    def close(self) -> None:
+        if self.__session is not None:
+            self.__session.close()
+            self.__session = None
+        if self.cache is not None:
+            self.cache.close()
+
+
+_TRANSPORT: Optional[HTTPTransport] = None
+
+
+def configure_transport(
+    pool_size: int = 10,
+    timeout: Union[float, Tuple[float, float]] = (5, 30),
+    keep_alive: bool = True,
+    retries: int = 3,
+    cache: "HTTPCache" = None,
+) -> HTTPTransport:
+    global _TRANSPORT
+    if _TRANSPORT is not None:
+        _TRANSPORT.close()
+    _TRANSPORT = HTTPTransport(
+        pool_size=pool_size, timeout=timeout, keep_alive=keep_alive, retries=retries, cache=cache
+    )
+    return _TRANSPORT
+
+
+def get_transport() -> HTTPTransport:
+    global _TRANSPORT
+    if _TRANSPORT is None:
+        _TRANSPORT = HTTPTransport()
+    return _TRANSPORT
@@ -0,0 +1,85 @@
+from typing import Any, Dict, Iterable, Iterator
+from json import JSONDecodeError, JSONDecoder
+import codecs
+
+
+class JSONArrayStream:
+    # Parses a top level JSON object from byte chunks and yields the items of one array member as they arrive,
+    # so only the item being decoded is held in memory. The other members end up in `fields`.
+    __WHITESPACE = " \t\r\n"
+    __COMPACT_AFTER = 1 << 16
+
+    def __init__(self, chunks: Iterable[bytes], key: str) -> None:
+        self.KEY = key
+        self.fields: Dict[str, Any] = {}
+        self.__chunks = iter(chunks)
+        self.__decoder = codecs.getincrementaldecoder("utf-8")()
+        self.__json = JSONDecoder()
+        self.__buffer = ""
+        self.__pos = 0
+        self.__exhausted = False
+
+    def __read(self) -> bool:
+        # Appends the next chunk to the buffer, False once the input is exhausted
+        if self.__exhausted:
+            return False
+        if self.__pos > self.__COMPACT_AFTER:
+            self.__buffer, self.__pos = self.__buffer[self.__pos :], 0
+        try:
+            self.__buffer += self.__decoder.decode(next(self.__chunks))
+        except StopIteration:
+            self.__buffer += self.__decoder.decode(b"", final=True)
+            self.__exhausted = True
+        return True
+
+    def __peek(self) -> str:
+        # Skips whitespace and returns the next character without consuming it, "" at the end of the input
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos] in self.__WHITESPACE:
+                self.__pos += 1
+            if self.__pos < len(self.__buffer):
+                return self.__buffer[self.__pos]
+            if not self.__read():
+                return ""
+
+    def __expect(self, chars: str) -> str:
+        char = self.__peek()
+        if not char or char not in chars:
+            raise JSONDecodeError(f"Expecting one of {chars!r}", self.__buffer, self.__pos)
+        self.__pos += 1
+        return char
+
+    def __value(self) -> Any:
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__json.raw_decode(self.__buffer, self.__pos)
+                # A number or literal ending exactly at the buffer's end may continue in the next chunk
+                if end < len(self.__buffer) or self.__exhausted:
+                    self.__pos = end
+                    return value
+            except JSONDecodeError:
+                if self.__exhausted:
+                    raise
+            self.__read()
+
+    def __iter__(self) -> Iterator[Any]:
+        self.__expect("{")
+        if self.__peek() == "}":
+            return
+        while True:
+            key = self.__value()
+            self.__expect(":")
+            if key == self.KEY and self.__peek() == "[":
+                self.__pos += 1
+                if self.__peek() != "]":
+                    while True:
+                        yield self.__value()
+                        if self.__expect(",]") == "]":
+                            break
+                else:
+                    self.__pos += 1
+            else:
+                self.fields[key] = self.__value()
+            if self.__expect(",}") == "}":
+                return
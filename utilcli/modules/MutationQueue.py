@@ -0,0 +1,431 @@
+from utilcli.modules.CommandResponse import CommandResponse
+from utilcli.modules.Concurrency import run_keyed
+from utilcli.modules.PorkbunAPI import PorkbunRecord, PorkbunRecordIndex
+from utilcli.modules.RequestScheduler import RetryPolicy
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import sqlite3
+import json
+import time
+
+
+class QueuedMutation:
+    __slots__ = (
+        "id",
+        "provider",
+        "scope",
+        "key",
+        "action",
+        "payload",
+        "scope_wide",
+        "status",
+        "attempts",
+        "last_error",
+        "created_at",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        provider: str,
+        scope: str,
+        key: str,
+        action: str,
+        payload: Dict,
+        scope_wide: bool = False,
+        status: str = "pending",
+        attempts: int = 0,
+        last_error: str = None,
+        created_at: float = None,
+    ) -> None:
+        self.id = id
+        self.provider = provider
+        self.scope = scope
+        self.key = key
+        self.action = action
+        self.payload = payload
+        # About every target of its scope, e.g. a DNS delete by pattern, it's ordered against all of them
+        self.scope_wide = scope_wide
+        self.status = status
+        self.attempts = attempts
+        self.last_error = last_error
+        self.created_at = created_at
+
+    @property
+    def target(self) -> Hashable:
+        # Mutations of the same target are coalesced together and sent one after another in the order they came in
+        return (self.provider, self.scope, self.key)
+
+    @property
+    def scope_target(self) -> Hashable:
+        return (self.provider, self.scope)
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __str__(self) -> str:
+        error = f" ({' '.join(self.last_error.split())})" if self.last_error else ""
+        return f"#{self.id:<5} {self.status:<8} {self.provider} {self.action} {self.key} on {self.scope}{error}"
+
+
+def coalesce(mutations: List[QueuedMutation]) -> Tuple[List[int], Dict[int, Dict]]:
+    # Collapses the unsent mutations of one target, in the order they were queued. Returns (ids to drop, payloads to
+    # replace by id).
+    # - a delete supersedes everything queued before it. A short URL that was never sent is dropped along with its
+    #   delete, a DNS delete still goes out since it also removes records created elsewhere.
+    # - a short URL edit is folded into the unsent shorten of the same slug, or replaces the previous edit
+    # - a mutation identical to an earlier one is dropped
+    kept: List[QueuedMutation] = []
+    dropped, payloads = [], {}
+    for mutation in mutations:
+        if mutation.action == "delete":
+            superseded, kept = kept, []
+            dropped.extend(x.id for x in superseded)
+            unsent_short_url = any(x.action == "shorten" and x.attempts == 0 for x in superseded)
+            if mutation.provider == "shlink" and unsent_short_url:
+                dropped.append(mutation.id)
+                continue
+        elif mutation.action == "edit":
+            shorten = next((x for x in reversed(kept) if x.action == "shorten" and x.attempts == 0), None)
+            if shorten is not None:
+                shorten.payload = payloads[shorten.id] = {**shorten.payload, "url": mutation.payload["url"]}
+                dropped.append(mutation.id)
+                continue
+            dropped.extend(x.id for x in kept if x.action == "edit")
+            kept = [x for x in kept if x.action != "edit"]
+        elif any(x.action == mutation.action and x.payload == mutation.payload for x in kept):
+            dropped.append(mutation.id)
+            continue
+        kept.append(mutation)
+    return dropped, payloads
+
+
+def covered_creates(mutation: QueuedMutation, creates: List[QueuedMutation]) -> List[QueuedMutation]:
+    # The unsent DNS creates a scope wide delete removes again, matched against their host the way the delete matches
+    # the records of the zone
+    if mutation.provider != "porkbun" or mutation.action != "delete":
+        return []
+    creates = [x for x in creates if x.provider == "porkbun" and x.action == "create" and x.attempts == 0]
+    records = [
+        PorkbunRecord(id=x.id, host=f"{x.key}.{x.scope}" if x.key else x.scope, type=None, ip=None, ttl=None)
+        for x in creates
+    ]
+    matched = {x.id for x in PorkbunRecordIndex(records, mutation.scope).match(mutation.payload["host"])}
+    return [x for x in creates if x.id in matched]
+
+
+class MutationQueue:
+    # Durable journal of DNS and short URL mutations. Commands append to it and return, a flusher collapses redundant
+    # mutations and sends the rest with up to `workers` in flight. A mutation that fails to reach the server is
+    # retried with backoff up to MAX_ATTEMPTS times, one the server rejects fails at once. Failed mutations stay in
+    # the journal until they are retried or dropped.
+    __SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mutations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            provider TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            action TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            scope_wide INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS mutations_target ON mutations (provider, scope, key, id);
+        CREATE INDEX IF NOT EXISTS mutations_status ON mutations (status, next_attempt_at);
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL
+        );
+    """
+    __COLUMNS = "id, provider, scope, key, action, payload, scope_wide, status, attempts, last_error, created_at"
+    PENDING, SENDING, FAILED = "pending", "sending", "failed"
+
+    def __init__(self, path: Path, max_attempts: int = 8, retry_delay: float = 5, lease: float = 300) -> None:
+        self.PATH = Path(path)
+        self.MAX_ATTEMPTS = max_attempts
+        # A mutation claimed longer than LEASE seconds ago belongs to a flusher that died, it's sent again
+        self.LEASE = lease
+        self.retry_policy = RetryPolicy(retries=max_attempts, backoff=retry_delay, max_backoff=3600)
+        self.__lock = threading.RLock()
+        self.__connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def __db(self) -> sqlite3.Connection:
+        with self.__lock:
+            if self.__connection is None:
+                self.PATH.parent.mkdir(parents=True, exist_ok=True)
+                # Transactions are explicit, the journal is shared with flushers in other processes
+                connection = sqlite3.connect(self.PATH, timeout=30, isolation_level=None, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(self.__SCHEMA)
+                self.__connection = connection
+            return self.__connection
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, two flushers never claim the same mutation
+        with self.__lock:
+            db = self.__db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+    @staticmethod
+    def __mutation(row: tuple) -> QueuedMutation:
+        id, provider, scope, key, action, payload, scope_wide, status, attempts, last_error, created_at = row
+        payload, scope_wide = json.loads(payload), bool(scope_wide)
+        return QueuedMutation(
+            id, provider, scope, key, action, payload, scope_wide, status, attempts, last_error, created_at
+        )
+
+    def enqueue(
+        self, provider: str, scope: str, key: str, action: str, payload: Dict, scope_wide: bool = False
+    ) -> QueuedMutation:
+        now = time.time()
+        with self.__transaction() as db:
+            id = db.execute(
+                "INSERT INTO mutations "
+                "(provider, scope, key, action, payload, scope_wide, status, created_at, next_attempt_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (provider, scope, key, action, json.dumps(payload), scope_wide, self.PENDING, now, now),
+            ).lastrowid
+        return QueuedMutation(id, provider, scope, key, action, payload, scope_wide, created_at=now)
+
+    def coalesce(self) -> int:
+        # Collapses the pending mutations of every target, returns how many were dropped. Mutations on either side of
+        # a scope wide one aren't collapsed together, it may be about their target too. A scope wide delete drops the
+        # unsent creates before it that it covers.
+        with self.__transaction() as db:
+            rows = db.execute(
+                f"SELECT {self.__COLUMNS} FROM mutations WHERE status = ? ORDER BY id", (self.PENDING,)
+            ).fetchall()
+            targets: Dict[Hashable, List[QueuedMutation]] = {}
+            scope_wide: Dict[Hashable, int] = {}
+            creates: Dict[Hashable, List[QueuedMutation]] = {}
+            covered = set()
+            for row in rows:
+                mutation = self.__mutation(row)
+                if mutation.scope_wide:
+                    scope_wide[mutation.scope_target] = mutation.id
+                    scope_creates = creates.get(mutation.scope_target, [])
+                    covered.update(x.id for x in covered_creates(mutation, scope_creates))
+                    creates[mutation.scope_target] = [x for x in scope_creates if x.id not in covered]
+                    continue
+                if mutation.action == "create":
+                    creates.setdefault(mutation.scope_target, []).append(mutation)
+                targets.setdefault((mutation.target, scope_wide.get(mutation.scope_target)), []).append(mutation)
+            db.executemany("DELETE FROM mutations WHERE id = ?", [(x,) for x in covered])
+            dropped = len(covered)
+            for mutations in targets.values():
+                mutations = [x for x in mutations if x.id not in covered]
+                if len(mutations) < 2:
+                    continue
+                ids, payloads = coalesce(mutations)
+                db.executemany("DELETE FROM mutations WHERE id = ?", [(x,) for x in ids])
+                db.executemany(
+                    "UPDATE mutations SET payload = ? WHERE id = ?",
+                    [(json.dumps(payload), id) for id, payload in payloads.items()],
+                )
+                dropped += len(ids)
+        return dropped
+
+    def claim(self, limit: int = 100) -> List[QueuedMutation]:
+        # Due mutations whose target has nothing older still waiting or in flight. A scope wide mutation and the
+        # mutations of its scope on either side of it wait for each other to be sent, even when both are due, one of
+        # them may be held back by a third.
+        now = time.time()
+        with self.__transaction() as db:
+            db.execute(
+                "UPDATE mutations SET status = ? WHERE status = ? AND claimed_at < ?",
+                (self.PENDING, self.SENDING, now - self.LEASE),
+            )
+            rows = db.execute(
+                f"""
+                SELECT {self.__COLUMNS} FROM mutations m WHERE status = :pending AND next_attempt_at <= :now
+                AND NOT EXISTS (
+                    SELECT 1 FROM mutations e
+                    WHERE e.provider = m.provider AND e.scope = m.scope AND e.id < m.id
+                    AND (e.key = m.key OR e.scope_wide OR m.scope_wide)
+                    AND (
+                        e.status = :sending
+                        OR (e.status = :pending AND (e.next_attempt_at > :now OR e.key != m.key))
+                    )
+                )
+                ORDER BY id LIMIT :limit
+                """,
+                {"pending": self.PENDING, "sending": self.SENDING, "now": now, "limit": limit},
+            ).fetchall()
+            db.executemany(
+                "UPDATE mutations SET status = ?, claimed_at = ? WHERE id = ?",
+                [(self.SENDING, now, row[0]) for row in rows],
+            )
+        return [self.__mutation(row) for row in rows]
+
+    def complete(self, mutation: QueuedMutation) -> None:
+        with self.__transaction() as db:
+            db.execute("DELETE FROM mutations WHERE id = ?", (mutation.id,))
+
+    def release(self, mutation: QueuedMutation) -> None:
+        # Back to pending without counting an attempt
+        with self.__transaction() as db:
+            db.execute("UPDATE mutations SET status = ? WHERE id = ?", (self.PENDING, mutation.id))
+
+    def retry(self, mutation: QueuedMutation, error: str) -> bool:
+        # False when the mutation ran out of attempts and failed
+        mutation.attempts += 1
+        mutation.last_error = error
+        if mutation.attempts >= self.MAX_ATTEMPTS:
+            self.fail(mutation, error)
+            return False
+        next_attempt_at = time.time() + self.retry_policy.delay(mutation.attempts)
+        with self.__transaction() as db:
+            db.execute(
+                "UPDATE mutations SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (self.PENDING, mutation.attempts, error, next_attempt_at, mutation.id),
+            )
+        return True
+
+    def fail(self, mutation: QueuedMutation, error: str) -> None:
+        mutation.status, mutation.last_error = self.FAILED, error
+        with self.__transaction() as db:
+            db.execute(
+                "UPDATE mutations SET status = ?, attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (self.FAILED, error, mutation.id),
+            )
+
+    def flush(
+        self,
+        execute: Callable[[QueuedMutation], CommandResponse],
+        workers: int = 8,
+        wait: bool = False,
+        on_result: Callable[[QueuedMutation, Optional[str]], None] = None,
+    ) -> Dict[str, int]:
+        # Sends everything that's due, with `wait` also what's waiting for a retry. `on_result` gets every mutation
+        # that was sent with its error, None when it went through.
+        counts = {"sent": 0, "coalesced": 0, "retrying": 0, "failed": 0}
+        while True:
+            if wait:
+                self.heartbeat()
+            counts["coalesced"] += self.coalesce()
+            batch = self.claim(limit=workers * 16)
+            if not batch:
+                if not wait:
+                    return counts
+                next_attempt_at = self.next_attempt_at()
+                if next_attempt_at is None:
+                    if self.__stop():
+                        return counts
+                    continue
+                # Also waits out mutations held back by another flusher's mutation of the same target
+                time.sleep(min(max(next_attempt_at - time.time(), 0.5), 10))
+                continue
+
+            # A target whose mutation has to be retried keeps its later mutations back until then, and so does a scope
+            # for its later scope wide mutations, or for all of them after a scope wide one
+            held_back, lock = set(), threading.Lock()
+
+            def send(mutation: QueuedMutation) -> Optional[str]:
+                with lock:
+                    held = mutation.scope_target if mutation.scope_wide else mutation.target
+                    if held in held_back or ("wide", mutation.scope_target) in held_back:
+                        self.release(mutation)
+                        return None
+                try:
+                    res = execute(mutation)
+                except Exception as e:
+                    with lock:
+                        held_back.update((mutation.target, mutation.scope_target))
+                        if mutation.scope_wide:
+                            held_back.add(("wide", mutation.scope_target))
+                    return "retrying" if self.retry(mutation, str(e)) else "failed"
+                if not res.ok():
+                    self.fail(mutation, res.message)
+                    return "failed"
+                self.complete(mutation)
+                return "sent"
+
+            # Same order as claim: a target after the scope wide mutations before it, those after everything before
+            targets: Dict[Hashable, set] = {}
+
+            def keys(mutation: QueuedMutation) -> List[Hashable]:
+                if not mutation.scope_wide:
+                    targets.setdefault(mutation.scope_target, set()).add(mutation.target)
+                    return [mutation.target, mutation.scope_target]
+                return [mutation.scope_target, *targets.pop(mutation.scope_target, ())]
+
+            for mutation, outcome, error in run_keyed(send, batch, key=keys, workers=workers):
+                if error:
+                    outcome = "retrying" if self.retry(mutation, str(error)) else "failed"
+                if outcome is None:
+                    continue
+                counts[outcome] += 1
+                if on_result:
+                    on_result(mutation, mutation.last_error if outcome != "sent" else None)
+
+    def heartbeat(self) -> None:
+        with self.__transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('flusher_seen', ?)", (time.time(),))
+
+    def __stop(self) -> bool:
+        # Forgets the heartbeat unless something was queued since the last look, a command queueing right after then
+        # starts a flusher of its own instead of counting on this one
+        with self.__transaction() as db:
+            due = db.execute("SELECT 1 FROM mutations WHERE status = ? LIMIT 1", (self.PENDING,)).fetchone()
+            if due is None:
+                db.execute("DELETE FROM meta WHERE name = 'flusher_seen'")
+        return due is None
+
+    def flusher_seen(self) -> Optional[float]:
+        # When a flusher last looked at the journal
+        with self.__lock:
+            row = self.__db.execute("SELECT value FROM meta WHERE name = 'flusher_seen'").fetchone()
+        return row[0] if row else None
+
+    def next_attempt_at(self) -> Optional[float]:
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT MIN(next_attempt_at) FROM mutations WHERE status = ?", (self.PENDING,)
+            ).fetchone()
+        return row[0]
+
+    def mutations(self, status: str = None) -> List[QueuedMutation]:
+        query, params = f"SELECT {self.__COLUMNS} FROM mutations", ()
+        if status:
+            query, params = f"{query} WHERE status = ?", (status,)
+        with self.__lock:
+            rows = self.__db.execute(f"{query} ORDER BY id", params).fetchall()
+        return [self.__mutation(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self.__lock:
+            rows = dict(self.__db.execute("SELECT status, COUNT(*) FROM mutations GROUP BY status"))
+        return {status: rows.get(status, 0) for status in (self.PENDING, self.SENDING, self.FAILED)}
+
+    def requeue_failed(self) -> int:
+        now = time.time()
+        with self.__transaction() as db:
+            return db.execute(
+                "UPDATE mutations SET status = ?, attempts = 0, next_attempt_at = ? WHERE status = ?",
+                (self.PENDING, now, self.FAILED),
+            ).rowcount
+
+    def drop_failed(self) -> int:
+        with self.__transaction() as db:
+            return db.execute("DELETE FROM mutations WHERE status = ?", (self.FAILED,)).rowcount
@@ -0,0 +1,92 @@
+from typing import Any, Callable, Dict, Optional, Sequence, TextIO
+from enum import Enum
+import json
+import csv
+import sys
+
+
+class OutputFormat(str, Enum):
+    text = "text"
+    json = "json"
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+def to_json(value: Any) -> Any:
+    # JSON ready copy of a response, record or any nesting of them
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, dict):
+        return {key: to_json(x) for key, x in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(x) for x in value]
+    return value
+
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return " ".join(str(x) for x in value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+class RecordWriter:
+    # Writes records one at a time as they are produced, nothing is kept once a record is written. json is a single
+    # array written element by element, ndjson one object per line and csv one row per record under a header of
+    # FIELDS, or of the first record's keys. text writes `text(record)` the way the commands always have.
+    def __init__(
+        self, format: OutputFormat, file: TextIO = None, fields: Sequence[str] = None, text: Callable = str
+    ) -> None:
+        self.FORMAT = OutputFormat(format)
+        self.FIELDS: Optional[Sequence[str]] = fields
+        self.count = 0
+        self.__file = file if file is not None else sys.stdout
+        self.__text = text
+        self.__csv = csv.writer(self.__file, lineterminator="\n") if self.FORMAT == OutputFormat.csv else None
+
+    def write(self, record: Any) -> None:
+        if self.FORMAT == OutputFormat.text:
+            self.__file.write(f"{self.__text(record)}\n")
+        elif self.FORMAT == OutputFormat.csv:
+            row: Dict = to_json(record)
+            if self.count == 0:
+                self.FIELDS = self.FIELDS or list(row)
+                self.__csv.writerow(self.FIELDS)
+            self.__csv.writerow([_csv_value(row.get(x)) for x in self.FIELDS])
+        else:
+            line = json.dumps(to_json(record))
+            if self.FORMAT == OutputFormat.json:
+                line = f"{',' if self.count else '['}\n{line}"
+            self.__file.write(line if self.FORMAT == OutputFormat.json else f"{line}\n")
+        self.count += 1
+
+    def close(self) -> None:
+        if self.FORMAT == OutputFormat.json:
+            self.__file.write("\n]\n" if self.count else "[]\n")
+        elif self.FORMAT == OutputFormat.csv and self.count == 0 and self.FIELDS:
+            self.__csv.writerow(self.FIELDS)
+        self.__file.flush()
+
+    def __enter__(self) -> "RecordWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # A listing cut short by an error is left unterminated, a json consumer sees it's incomplete
+        if exc_type is None:
+            self.close()
+        else:
+            self.__file.flush()
+
+
+def write_record(format: OutputFormat, record: Any, file: TextIO = None, text: Callable = str) -> None:
+    # A single result, json is the object itself rather than an array of one
+    if OutputFormat(format) == OutputFormat.json:
+        (file if file is not None else sys.stdout).write(f"{json.dumps(to_json(record), indent=2)}\n")
+        return
+    with RecordWriter(format, file, text=text) as writer:
+        writer.write(record)
@@ -1,10 +1,19 @@
 from utilcli.modules.CommandResponse import CommandResponse
+from utilcli.modules.HTTPTransport import HTTPTransport, get_transport
+from utilcli.modules.Concurrency import run_concurrently
+from utilcli.modules.RequestScheduler import is_transient_status
+from utilcli.modules.JSONStream import JSONArrayStream
+from utilcli.modules.Tracer import get_tracer
+from collections import defaultdict
 from ipaddress import ip_address
-from typing import Dict, List
+from fnmatch import fnmatch
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
 from enum import Enum
-import requests
 import json
 
+if TYPE_CHECKING:
+    from utilcli.modules.PorkbunMirror import PorkbunMirror
+
 
 class Type(Enum):
     A = "A"
@@ -20,24 +29,63 @@ class Type(Enum):
 
 
 class PorkbunRecord:
-    def __init__(self, id: str, host: str, type: Type, ip: str, ttl: int, notes: str = None) -> None:
+    # Zones can hold tens of thousands of records, slots keep each one small
+    FIELDS = ("id", "host", "type", "ip", "ttl", "notes", "prio")
+    __slots__ = FIELDS
+
+    def __init__(self, id: str, host: str, type: Type, ip: str, ttl: int, notes: str = None, prio: int = None) -> None:
         self.id = id
         self.host = host
         self.type = type
         self.ttl = ttl
         self.ip = ip
         self.notes = notes
+        self.prio = prio
 
     @staticmethod
     def get_appropriate_type(record_type: str) -> Type:
-        record_type = record_type.upper()
-        for type in Type:
-            if type.name == record_type:
-                return type
-        raise Exception("Invalid record type")
+        type = Type.__members__.get(record_type.upper())
+        if type is None:
+            raise Exception("Invalid record type")
+        return type
+
+    @property
+    def type_name(self) -> Optional[str]:
+        # Records known only by id, like the ones `delete_records(ids=...)` returns, have no type
+        return self.type.name if self.type else None
+
+    def to_dict(self) -> Dict:
+        return {**{field: getattr(self, field) for field in self.FIELDS}, "type": self.type_name}
 
     def __str__(self):
-        return f"ID    : {self.id}\n" f"Host  : {self.host}\n" f"Type  : {self.type.name}\n" f"IP    : {self.ip}\n"
+        return f"ID    : {self.id}\n" f"Host  : {self.host}\n" f"Type  : {self.type_name}\n" f"IP    : {self.ip}\n"
+
+
+class PorkbunRecordIndex:
+    def __init__(self, records: List[PorkbunRecord], domain: str) -> None:
+        self.DOMAIN = domain.lower()
+        self.by_fqdn: Dict[str, List[PorkbunRecord]] = defaultdict(list)
+        self.by_label: Dict[str, List[PorkbunRecord]] = defaultdict(list)
+        for record in records:
+            fqdn = record.host.lower()
+            self.by_fqdn[fqdn].append(record)
+            relative = fqdn[: -len(self.DOMAIN) - 1] if fqdn.endswith(f".{self.DOMAIN}") else ""
+            for label in set(relative.split(".")) if relative else []:
+                self.by_label[label].append(record)
+
+    @staticmethod
+    def is_pattern(host: str) -> bool:
+        return any(x in host for x in "*?[")
+
+    def match(self, host: str) -> List[PorkbunRecord]:
+        host = host.strip().lower().rstrip(".")
+        is_hostname = host.find(".") == -1
+        index = self.by_label if is_hostname else self.by_fqdn
+        if self.is_pattern(host):
+            keys = [x for x in index if fnmatch(x, host) or (not is_hostname and fnmatch(x, f"{host}.{self.DOMAIN}"))]
+        else:
+            keys = [host] if is_hostname or host in index else [f"{host}.{self.DOMAIN}"]
+        return [record for key in keys for record in index.get(key, [])]
 
 
 class PorkbunResponse(CommandResponse):
@@ -48,36 +96,66 @@ class PorkbunResponse(CommandResponse):
         list_records: List[PorkbunRecord] = None,
         new_record: PorkbunRecord = None,
         deleted_record: PorkbunRecord = None,
+        deleted_records: List[PorkbunRecord] = None,
     ) -> None:
         super().__init__(is_ok, message)
         self.list_records = list_records
         self.new_record = new_record
         self.deleted_record = deleted_record
+        self.deleted_records = deleted_records
 
     def __str__(self):
-        return json.dumps(
-            {
-                "is_ok": self.is_ok,
-                "message": self.message,
-                "list_records": self.list_records,
-                "new_record": self.new_record,
-                "deleted_record": self.deleted_record,
-            },
-            indent=2,
-        )
+        return json.dumps(self.to_dict(), indent=2)
 
 
 class PorkbunAPI:
 
     __BASE = "https://porkbun.com/api/json/v3"
 
-    def __init__(self, api_key: str, secret_key: str, domain: str, default_ip: str) -> None:
+    def __init__(
+        self,
+        api_key: str,
+        secret_key: str,
+        domain: str,
+        default_ip: str,
+        transport: HTTPTransport = None,
+        base_url: str = None,
+        mirror: "PorkbunMirror" = None,
+    ) -> None:
         self.__API_KEY = api_key
         self.__SECRET_KEY = secret_key
         self.DOMAIN = domain
         self.DEFAULT_IP = default_ip
+        self.__transport = transport if transport else get_transport()
+        self.mirror = mirror
+        if base_url:
+            self.__BASE = base_url.rstrip("/")
+
+    @property
+    def base_url(self) -> str:
+        return self.__BASE
+
+    def __api_call(self, endpoint: str, payload: Dict = {}, idempotent: bool = True) -> Dict:
+        try:
+            default_payload = {
+                "secretapikey": self.__SECRET_KEY,
+                "apikey": self.__API_KEY,
+            }
 
-    def __api_call(self, endpoint: str, payload: Dict = {}) -> Dict:
+            url = f"{self.__BASE}{endpoint}"
+            tracer = get_tracer()
+            with tracer.span(f"porkbun {endpoint}", "api", endpoint=endpoint) as span:
+                r = self.__transport.request("POST", url, json={**payload, **default_payload}, idempotent=idempotent)
+                span["status"] = r.status_code
+                if is_transient_status(r.status_code):
+                    r.raise_for_status()
+                with tracer.phase("parse"):
+                    return r.json()
+        except Exception as e:
+            raise Exception("Error occur while sending request to server") from e
+
+    def __api_stream(self, endpoint: str, key: str) -> JSONArrayStream:
+        # Like __api_call, but the `key` array of the response is decoded item by item while it downloads
         try:
             default_payload = {
                 "secretapikey": self.__SECRET_KEY,
@@ -85,86 +163,205 @@ class PorkbunAPI:
             }
 
             url = f"{self.__BASE}{endpoint}"
-            r = requests.post(url=url, json={**payload, **default_payload})
-            return r.json()
+            with get_tracer().span(f"porkbun {endpoint}", "api", endpoint=endpoint, streamed=True) as span:
+                r = self.__transport.request("POST", url, json=default_payload, stream=True)
+                span["status"] = r.status_code
+                if is_transient_status(r.status_code):
+                    r.close()
+                    r.raise_for_status()
         except Exception as e:
-            raise Exception("Error occur while sending request to server")
+            raise Exception("Error occur while sending request to server") from e
+
+        def chunks() -> Iterator[bytes]:
+            with r:
+                try:
+                    yield from r.iter_content(chunk_size=1 << 16)
+                except Exception as e:
+                    raise Exception("Error occur while sending request to server") from e
+
+        return JSONArrayStream(chunks(), key)
 
-    def create_record(self, host: str, ip: str, record_type: str, ttl: int) -> PorkbunResponse:
+    @staticmethod
+    def __parse_records(stream: JSONArrayStream, type: Optional[Type]) -> Iterator[PorkbunRecord]:
+        try:
+            for x in stream:
+                # Compare the raw type first so filtered out records are never built
+                if type is not None and (x.get("type") or "").upper() != type.value:
+                    continue
+                yield PorkbunRecord(
+                    id=x.get("id"),
+                    host=x.get("name"),
+                    type=PorkbunRecord.get_appropriate_type(x.get("type")),
+                    ttl=x.get("ttl"),
+                    ip=x.get("content"),
+                    notes=x.get("notes"),
+                    prio=x.get("prio"),
+                )
+        except ValueError:
+            raise Exception("Error occur while parsing request from the server")
+
+    def relative_name(self, host: str) -> str:
+        host = host.rstrip(".")
+        if host == self.DOMAIN or host == "@":
+            return ""
+        if host.endswith(f".{self.DOMAIN}"):
+            return host[: -len(self.DOMAIN) - 1]
+        return host
+
+    def __record_payload(self, host: str, content: str, type: Type, ttl: int, prio: int = None) -> Dict:
+        if type in (Type.A, Type.AAAA):
+            content = str(ip_address(content))
+        if not isinstance(ttl, int):
+            raise Exception("TTL must be in integer type")
+        payload = {"name": self.relative_name(host), "type": type.name, "content": content, "ttl": ttl}
+        if prio is not None:
+            payload["prio"] = prio
+        return payload
+
+    def record_payload(self, host: str, ip: str, record_type: str, ttl: int, prio: int = None) -> Dict:
+        # Validates a record without sending it, the payload create_record would send
+        type = PorkbunRecord.get_appropriate_type(record_type)
+        return self.__record_payload(host, ip if ip else self.DEFAULT_IP, type, ttl, prio)
+
+    def __fqdn(self, name: str) -> str:
+        return f"{name}.{self.DOMAIN}" if name else self.DOMAIN
+
+    def create_record(self, host: str, ip: str, record_type: str, ttl: int, prio: int = None) -> PorkbunResponse:
         ENDPOINT = f"/dns/create/{self.DOMAIN}"
         ip = ip if ip else self.DEFAULT_IP
 
         type = PorkbunRecord.get_appropriate_type(record_type)
-        ip_obj = ip_address(ip)
-        if not isinstance(ttl, int):
-            raise Exception("TTL must be in integer type")
-        payload = {"name": host, "type": type.name, "content": str(ip_obj), "ttl": ttl}
+        payload = self.__record_payload(host, ip, type, ttl, prio)
+
+        res = self.__api_call(ENDPOINT, payload, idempotent=False)
+
+        host = self.__fqdn(payload["name"])
+        if res.get("status") == "SUCCESS":
+            record = PorkbunRecord(id=res.get("id"), host=host, type=type, ip=payload["content"], ttl=ttl, prio=prio)
+            if self.mirror:
+                self.mirror.upsert(self.DOMAIN, record)
+            return PorkbunResponse(is_ok=True, new_record=record)
+        else:
+            return PorkbunResponse(is_ok=False, message=f'{res.get("message")} ({host})')
+
+    def edit_record(
+        self, id: str, host: str, content: str, record_type: str, ttl: int, prio: int = None
+    ) -> PorkbunResponse:
+        ENDPOINT = f"/dns/edit/{self.DOMAIN}/{id}"
+
+        type = PorkbunRecord.get_appropriate_type(record_type)
+        payload = self.__record_payload(host, content, type, ttl, prio)
 
         res = self.__api_call(ENDPOINT, payload)
 
+        host = self.__fqdn(payload["name"])
         if res.get("status") == "SUCCESS":
-            return PorkbunResponse(
-                is_ok=True,
-                new_record=PorkbunRecord(
-                    id=res.get("id"), host=f"{host}.{self.DOMAIN}", type=type, ip=str(ip_obj), ttl=ttl
-                ),
-            )
+            record = PorkbunRecord(id=id, host=host, type=type, ip=payload["content"], ttl=ttl, prio=prio)
+            if self.mirror:
+                self.mirror.upsert(self.DOMAIN, record)
+            return PorkbunResponse(is_ok=True, new_record=record)
         else:
-            return PorkbunResponse(is_ok=False, message=f'{res.get("message")} ({host}.{self.DOMAIN})')
-
-    def list_record(self, record_type: str = None) -> PorkbunResponse:
-        check = False
-        type = None
-        if record_type:
-            type = PorkbunRecord.get_appropriate_type(record_type)
-            check = True
-        ENDPOINT = f"/dns/retrieve/{self.DOMAIN}"
+            return PorkbunResponse(is_ok=False, message=f'{res.get("message")} ({host})')
+
+    def delete_record_by_id(self, record: PorkbunRecord) -> PorkbunResponse:
+        ENDPOINT = f"/dns/delete/{self.DOMAIN}/{record.id}"
         res = self.__api_call(ENDPOINT)
+
         if res.get("status") == "SUCCESS":
-            return PorkbunResponse(
-                is_ok=True,
-                list_records=[
-                    PorkbunRecord(
-                        id=x.get("id"),
-                        host=x.get("name"),
-                        type=PorkbunRecord.get_appropriate_type(x.get("type")),
-                        ttl=x.get("ttl"),
-                        ip=x.get("content"),
-                        notes=x.get("notes"),
-                    )
-                    for x in res.get("records")
-                    if not check or PorkbunRecord.get_appropriate_type(x.get("type")) == type
-                ],
-            )
+            if self.mirror:
+                self.mirror.delete(self.DOMAIN, record.id)
+            return PorkbunResponse(is_ok=True, deleted_record=record)
         else:
-            return PorkbunResponse(is_ok=False, message=res.get("message"))
+            return PorkbunResponse(is_ok=False, message=f'{res.get("message")} ({record.host})')
 
-    def delete_record(self, host: str = None, id: str = None) -> PorkbunResponse:
-        host = host.strip()
-        if not id and not host:
-            raise Exception("Please provide a host, hostname or id")
-        BASE_ENDPOINT = f"/dns/delete/{self.DOMAIN}"
+    def __use_mirror(self, refresh: bool) -> bool:
+        return self.mirror is not None and not refresh and self.mirror.is_fresh(self.DOMAIN)
+
+    def __retrieve(self, type: Optional[Type]) -> Tuple[JSONArrayStream, Iterator[PorkbunRecord]]:
+        stream = self.__api_stream(f"/dns/retrieve/{self.DOMAIN}", "records")
+
+        def records(type: Optional[Type]) -> Iterator[PorkbunRecord]:
+            yield from self.__parse_records(stream, type)
+            # Raising here also rolls back the mirror, an error response never replaces a good copy
+            if stream.fields.get("status") != "SUCCESS":
+                raise Exception(stream.fields.get("message"))
+
+        if not self.mirror:
+            return stream, records(type)
+        # The mirror needs the whole zone, filtering happens after it's stored
+        stored = self.mirror.replace(self.DOMAIN, records(None))
+        return stream, (x for x in stored if type is None or x.type == type)
+
+    def list_record(self, record_type: str = None, refresh: bool = False, host: str = None) -> PorkbunResponse:
+        # Served from the mirror while it's fresh, `refresh` always asks the API
+        type = PorkbunRecord.get_appropriate_type(record_type) if record_type else None
+        if self.__use_mirror(refresh):
+            return PorkbunResponse(is_ok=True, list_records=self.mirror.records(self.DOMAIN, record_type, host))
+
+        stream, records = self.__retrieve(type)
+        try:
+            records = list(records)
+        except Exception:
+            if stream.fields.get("status", "SUCCESS") == "SUCCESS":
+                raise
+            return PorkbunResponse(is_ok=False, message=stream.fields.get("message"))
         if host:
-            res = self.list_record()
-            if not res.ok():
-                raise Exception("Error while fetching list of records, try using record's id directly")
+            records = [x for x in records if x.host.lower() == host.lower()]
+        return PorkbunResponse(is_ok=True, list_records=records)
 
-            is_hostname = True if host.find(".") == -1 else False
-            if is_hostname:
-                match = [x for x in res.list_records if host in x.host.split(".")]
-            else:
-                match = [x for x in res.list_records if host == x.host]
+    def iter_records(self, record_type: str = None, refresh: bool = False) -> Iterator[PorkbunRecord]:
+        # Yields records while the zone is still downloading, memory stays bounded by a single record
+        type = PorkbunRecord.get_appropriate_type(record_type) if record_type else None
+        if self.__use_mirror(refresh):
+            return iter(self.mirror.records(self.DOMAIN, record_type))
+        return self.__retrieve(type)[1]
+
+    def delete_records(
+        self, hosts: List[str] = None, ids: List[str] = None, workers: int = 8, refresh: bool = False
+    ) -> PorkbunResponse:
+        hosts = [x.strip() for x in hosts or [] if x.strip()]
+        ids = [x.strip() for x in ids or [] if x.strip()]
+        if not ids and not hosts:
+            raise Exception("Please provide a host, hostname or id")
+
+        match = [PorkbunRecord(id=x, host=x, type=None, ip=None, ttl=None) for x in ids]
+        if hosts:
+            # A miss in the mirror may be a record created elsewhere, the API gets a second look before giving up
+            for refresh in (False, True) if self.__use_mirror(refresh) else (True,):
+                res = self.list_record(refresh=refresh)
+                if not res.ok():
+                    raise Exception("Error while fetching list of records, try using record's id directly")
 
+                index = PorkbunRecordIndex(res.list_records, self.DOMAIN)
+                found, invalid = [], []
+                for host in hosts:
+                    records = index.match(host)
+                    if len(records) == 0 and not index.is_pattern(host):
+                        invalid.append(host)
+                    found.extend(records)
+                if not invalid:
+                    break
+            if invalid:
+                raise Exception(f'Provided host is invalid ({", ".join(invalid)})')
+            match.extend(found)
+
+        match = list({x.id: x for x in match}.values())
         if len(match) == 0:
             raise Exception("Provided host is invalid")
 
-        ENDPOINT = f"{BASE_ENDPOINT}/{match[0].id}"
-        res = self.__api_call(ENDPOINT)
+        deleted, errors = [], []
+        for record, res, error in run_concurrently(self.delete_record_by_id, match, workers):
+            if error or not res.ok():
+                errors.append(str(error) if error else res.message)
+            else:
+                deleted.append(record)
 
-        if res.get("status") == "SUCCESS":
-            return PorkbunResponse(
-                is_ok=True,
-                deleted_record=match[0],
-            )
-        else:
-            return PorkbunResponse(is_ok=False, message=res.get("message"))
+        return PorkbunResponse(
+            is_ok=len(errors) == 0,
+            message="\n".join(errors) if errors else None,
+            deleted_record=deleted[0] if deleted else None,
+            deleted_records=deleted,
+        )
+
+    def delete_record(self, host: str = None, id: str = None) -> PorkbunResponse:
+        return self.delete_records(hosts=[host] if host else None, ids=[id] if id else None)
@@ -0,0 +1,150 @@
+from utilcli.modules.PorkbunAPI import PorkbunAPI, PorkbunRecord, Type
+from ipaddress import ip_address, IPv6Address
+from typing import Callable, Optional
+from abc import ABC, abstractmethod
+from pathlib import Path
+import subprocess
+import threading
+import random
+import socket
+import struct
+import sys
+
+
+class IPSource(ABC):
+    def __init__(self, version: int = 4) -> None:
+        self.VERSION = version
+
+    @abstractmethod
+    def read(self) -> str:
+        pass
+
+    def get(self) -> str:
+        ip = ip_address(self.read().strip())
+        if ip.version != self.VERSION:
+            raise Exception(f"Expected an IPv{self.VERSION} address but got {ip}")
+        return str(ip)
+
+
+class InterfaceIPSource(IPSource):
+    __SIOCGIFADDR = 0x8915
+
+    def __init__(self, interface: str, version: int = 4) -> None:
+        super().__init__(version)
+        if not sys.platform.startswith("linux"):
+            raise Exception("Reading interface addresses is only supported on Linux, use a command instead")
+        self.INTERFACE = interface
+
+    def __read_ipv4(self) -> str:
+        import fcntl
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                ifreq = struct.pack("256s", self.INTERFACE.encode()[:15])
+                return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), self.__SIOCGIFADDR, ifreq)[20:24])
+            except OSError:
+                raise Exception(f'Interface "{self.INTERFACE}" has no IPv4 address')
+
+    def __read_ipv6(self) -> str:
+        # /proc/net/if_inet6: address, index, prefix length, scope, flags, interface name
+        for line in Path("/proc/net/if_inet6").read_text().splitlines():
+            address, _, _, scope, _, interface = line.split()
+            if interface == self.INTERFACE and scope == "00":
+                return str(IPv6Address(bytes.fromhex(address)))
+        raise Exception(f'Interface "{self.INTERFACE}" has no global IPv6 address')
+
+    def read(self) -> str:
+        return self.__read_ipv4() if self.VERSION == 4 else self.__read_ipv6()
+
+
+class CommandIPSource(IPSource):
+    def __init__(self, command: str, version: int = 4, timeout: int = 30) -> None:
+        super().__init__(version)
+        self.COMMAND = command
+        self.TIMEOUT = timeout
+
+    def read(self) -> str:
+        try:
+            result = subprocess.run(
+                self.COMMAND, shell=True, capture_output=True, universal_newlines=True, timeout=self.TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            raise Exception(f"IP command timed out after {self.TIMEOUT}s")
+        if result.returncode != 0:
+            raise Exception(f"IP command failed with exit code {result.returncode}: {result.stderr.strip()}")
+        lines = result.stdout.strip().splitlines()
+        if not lines:
+            raise Exception("IP command printed nothing")
+        return lines[0]
+
+
+class DDNSUpdater:
+    def __init__(self, api: PorkbunAPI, host: str, source: IPSource, record_type: str = "A", ttl: int = 600) -> None:
+        self.api = api
+        self.source = source
+        self.TYPE = PorkbunRecord.get_appropriate_type(record_type)
+        if self.TYPE not in (Type.A, Type.AAAA):
+            raise Exception("Dynamic DNS only supports A and AAAA records")
+        if (self.TYPE == Type.A) != (source.VERSION == 4):
+            raise Exception(f"{self.TYPE.name} records need an IPv{4 if self.TYPE == Type.A else 6} source")
+        self.TTL = ttl
+        self.HOST = api.relative_name(host)
+        self.FQDN = f"{self.HOST}.{api.DOMAIN}" if self.HOST else api.DOMAIN
+        self.record: Optional[PorkbunRecord] = None
+        self.__loaded = False
+        self.__refresh = False
+
+    def __load(self) -> None:
+        res = self.api.list_record(record_type=self.TYPE.name, refresh=self.__refresh, host=self.FQDN)
+        if not res.ok():
+            raise Exception(res.message)
+        self.record = res.list_records[0] if res.list_records else None
+        self.__loaded = True
+
+    def sync(self) -> Optional[str]:
+        # Returns a description of what changed, None when the record is already up to date
+        ip = self.source.get()
+        if not self.__loaded:
+            self.__load()
+        if self.record and self.record.ip == ip:
+            return None
+
+        if self.record:
+            res = self.api.edit_record(self.record.id, self.HOST, ip, self.TYPE.name, self.TTL)
+            if res.ok():
+                previous, self.record.ip = self.record.ip, ip
+                return f"{self.FQDN} updated {previous} -> {ip}"
+        else:
+            res = self.api.create_record(self.HOST, ip, self.TYPE.name, self.TTL)
+            if res.ok():
+                self.record = res.new_record
+                return f"{self.FQDN} created with {ip}"
+
+        # The record may have been changed outside of this process, start over from the API next time
+        self.__loaded = False
+        self.__refresh = True
+        raise Exception(res.message)
+
+    def run(
+        self,
+        interval: float = 300,
+        max_backoff: float = 3600,
+        on_event: Callable[[str], None] = print,
+        stop: threading.Event = None,
+    ) -> None:
+        stop = stop if stop else threading.Event()
+        failures = 0
+        while not stop.is_set():
+            try:
+                change = self.sync()
+                failures = 0
+                if change:
+                    on_event(change)
+                delay = interval * random.uniform(0.9, 1.1)
+            except Exception as e:
+                failures += 1
+                # Exponential backoff with equal jitter, capped at max_backoff
+                backoff = min(max_backoff, min(interval, 30) * 2 ** min(failures - 1, 16))
+                delay = backoff / 2 + random.uniform(0, backoff / 2)
+                on_event(f"{e} (retrying in {delay:.0f}s)")
+            stop.wait(delay)
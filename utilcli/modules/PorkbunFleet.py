@@ -0,0 +1,100 @@
+from utilcli.modules.PorkbunAPI import PorkbunAPI, PorkbunRecord
+from utilcli.modules.Concurrency import run_concurrently
+from collections import defaultdict
+from ipaddress import ip_address
+from fnmatch import fnmatch
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+def _normalize_content(content: str) -> str:
+    # Addresses compare in their canonical form, 2001:DB8::0:1 and 2001:db8::1 are the same record
+    content = (content or "").strip().rstrip(".").lower()
+    try:
+        return str(ip_address(content))
+    except ValueError:
+        return content
+
+
+class PorkbunSearchIndex:
+    # Records of many domains indexed by content, FQDN and type
+    def __init__(self) -> None:
+        self.records: List[Tuple[str, PorkbunRecord]] = []
+        self.by_content: Dict[str, List[int]] = defaultdict(list)
+        self.by_fqdn: Dict[str, List[int]] = defaultdict(list)
+        self.by_type: Dict[str, List[int]] = defaultdict(list)
+
+    def add(self, domain: str, records: List[PorkbunRecord]) -> None:
+        for record in records:
+            position = len(self.records)
+            self.records.append((domain, record))
+            self.by_content[_normalize_content(record.ip)].append(position)
+            self.by_fqdn[record.host.lower()].append(position)
+            self.by_type[record.type.name].append(position)
+
+    @staticmethod
+    def __lookup(index: Dict[str, List[int]], value: str) -> List[int]:
+        if any(x in value for x in "*?["):
+            return [position for key, positions in index.items() if fnmatch(key, value) for position in positions]
+        return index.get(value, [])
+
+    def search(
+        self, content: str = None, host: str = None, record_type: str = None
+    ) -> List[Tuple[str, PorkbunRecord]]:
+        # Every given criterion must match, content and host accept glob patterns
+        candidates: Optional[set] = None
+        for index, value in (
+            (self.by_content, _normalize_content(content) if content else None),
+            (self.by_fqdn, host.strip().rstrip(".").lower() if host else None),
+            (self.by_type, PorkbunRecord.get_appropriate_type(record_type).name if record_type else None),
+        ):
+            if value is None:
+                continue
+            positions = set(self.__lookup(index, value))
+            candidates = positions if candidates is None else candidates & positions
+        positions = sorted(candidates) if candidates is not None else range(len(self.records))
+        return [self.records[x] for x in positions]
+
+
+class PorkbunFleet:
+    # Several Porkbun domains handled together, zones are retrieved concurrently
+    def __init__(self, apis: List[PorkbunAPI], workers: int = 8) -> None:
+        self.APIS = apis
+        self.WORKERS = workers
+
+    def retrieve(
+        self, record_type: str = None, refresh: bool = False
+    ) -> Iterator[Tuple[str, List[PorkbunRecord], Optional[str]]]:
+        # Yields (domain, records, error) as each zone comes in
+        if record_type:
+            PorkbunRecord.get_appropriate_type(record_type)
+
+        def retrieve(api: PorkbunAPI):
+            return api.list_record(record_type=record_type, refresh=refresh)
+
+        for api, res, error in run_concurrently(retrieve, self.APIS, workers=self.WORKERS):
+            if error or not res.ok():
+                yield api.DOMAIN, [], str(error) if error else res.message
+            else:
+                yield api.DOMAIN, res.list_records, None
+
+    def list_records(
+        self, record_type: str = None, refresh: bool = False, sort: Callable = None
+    ) -> Tuple[List[Tuple[str, PorkbunRecord]], Dict[str, str]]:
+        # ((domain, record) for every domain, errors by domain). Without `sort` domains keep the order they were
+        # given in and records the order of the API.
+        zones, errors = {}, {}
+        for domain, records, error in self.retrieve(record_type, refresh):
+            zones[domain] = records
+            if error:
+                errors[domain] = error
+        merged = [(api.DOMAIN, record) for api in self.APIS for record in zones.get(api.DOMAIN, [])]
+        if sort:
+            merged.sort(key=sort)
+        return merged, errors
+
+    def index(self, refresh: bool = False) -> Tuple[PorkbunSearchIndex, Dict[str, str]]:
+        # One concurrent pass over every zone, indexed in the order the domains were given in
+        index, (records, errors) = PorkbunSearchIndex(), self.list_records(refresh=refresh)
+        for domain, record in records:
+            index.add(domain, [record])
+        return index, errors
@@ -0,0 +1,135 @@
+from utilcli.modules.PorkbunAPI import PorkbunRecord
+from typing import Iterable, Iterator, List
+from pathlib import Path
+import threading
+import sqlite3
+import time
+import uuid
+
+
+class PorkbunMirror:
+    # Local copy of Porkbun zones keyed by record id. Rows keep the API's order through their rowid since a refresh
+    # replaces the whole zone.
+    __SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            domain TEXT NOT NULL,
+            id TEXT NOT NULL,
+            host TEXT NOT NULL,
+            type TEXT NOT NULL,
+            content TEXT,
+            ttl TEXT,
+            prio TEXT,
+            notes TEXT,
+            PRIMARY KEY (domain, id)
+        );
+        CREATE INDEX IF NOT EXISTS records_host ON records (domain, host COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS records_type ON records (domain, type);
+        CREATE TABLE IF NOT EXISTS zones (
+            domain TEXT PRIMARY KEY,
+            refreshed_at REAL NOT NULL
+        );
+        CREATE TEMP TABLE IF NOT EXISTS staged_records (
+            download TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            id TEXT NOT NULL,
+            host TEXT NOT NULL,
+            type TEXT NOT NULL,
+            content TEXT,
+            ttl TEXT,
+            prio TEXT,
+            notes TEXT
+        );
+        CREATE INDEX IF NOT EXISTS temp.staged_records_download ON staged_records (download);
+    """
+
+    __INSERT = "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    __STAGE = "INSERT INTO staged_records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    __STAGE_BATCH = 500
+    __SELECT = "SELECT id, host, type, content, ttl, prio, notes FROM records WHERE domain = ?"
+
+    def __init__(self, path: Path, ttl: int = 300) -> None:
+        self.PATH = Path(path)
+        self.TTL = ttl
+        self.PATH.parent.mkdir(parents=True, exist_ok=True)
+        # Deletes run on worker threads, every access goes through the lock
+        self.__db = sqlite3.connect(self.PATH, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript(self.__SCHEMA)
+        self.__lock = threading.RLock()
+
+    def close(self) -> None:
+        self.__db.close()
+
+    @staticmethod
+    def __row(domain: str, record: PorkbunRecord) -> tuple:
+        fields = [None if x is None else str(x) for x in (record.ip, record.ttl, record.prio, record.notes)]
+        return (domain, str(record.id), record.host, record.type.name, *fields)
+
+    @staticmethod
+    def __record(row: tuple) -> PorkbunRecord:
+        id, host, type, content, ttl, prio, notes = row
+        return PorkbunRecord(
+            id=id,
+            host=host,
+            type=PorkbunRecord.get_appropriate_type(type),
+            ip=content,
+            ttl=ttl,
+            notes=notes,
+            prio=prio,
+        )
+
+    def is_fresh(self, domain: str) -> bool:
+        with self.__lock:
+            row = self.__db.execute("SELECT refreshed_at FROM zones WHERE domain = ?", (domain,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.TTL
+
+    def __stage(self, download: str, rows: List[tuple]) -> None:
+        with self.__lock, self.__db:
+            self.__db.executemany(self.__STAGE, [(download, *row) for row in rows])
+
+    def replace(self, domain: str, records: Iterable[PorkbunRecord]) -> Iterator[PorkbunRecord]:
+        # Stores a full zone while passing its records through. Records are staged in a temporary table in batches
+        # as they download, so memory stays bounded by a batch and zones of several domains download concurrently
+        # without holding the lock. The staged zone only replaces the mirror once the records are consumed to the
+        # end, a partial download never replaces a complete mirror.
+        download, rows = uuid.uuid4().hex, []
+        try:
+            for record in records:
+                rows.append(self.__row(domain, record))
+                if len(rows) >= self.__STAGE_BATCH:
+                    self.__stage(download, rows)
+                    rows = []
+                yield record
+            self.__stage(download, rows)
+            with self.__lock, self.__db:
+                self.__db.execute("DELETE FROM records WHERE domain = ?", (domain,))
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO records SELECT domain, id, host, type, content, ttl, prio, notes "
+                    "FROM staged_records WHERE download = ? ORDER BY rowid",
+                    (download,),
+                )
+                self.__db.execute("INSERT OR REPLACE INTO zones VALUES (?, ?)", (domain, time.time()))
+        finally:
+            with self.__lock, self.__db:
+                self.__db.execute("DELETE FROM staged_records WHERE download = ?", (download,))
+
+    def records(self, domain: str, record_type: str = None, host: str = None) -> List[PorkbunRecord]:
+        query, params = self.__SELECT, [domain]
+        if record_type:
+            query, params = f"{query} AND type = ?", params + [record_type.upper()]
+        if host:
+            query, params = f"{query} AND host = ? COLLATE NOCASE", params + [host]
+        with self.__lock:
+            return [self.__record(x) for x in self.__db.execute(f"{query} ORDER BY rowid", params)]
+
+    def upsert(self, domain: str, record: PorkbunRecord) -> None:
+        with self.__lock, self.__db:
+            self.__db.execute(self.__INSERT, self.__row(domain, record))
+
+    def delete(self, domain: str, id: str) -> None:
+        with self.__lock, self.__db:
+            self.__db.execute("DELETE FROM records WHERE domain = ? AND id = ?", (domain, str(id)))
+
+    def invalidate(self, domain: str) -> None:
+        with self.__lock, self.__db:
+            self.__db.execute("DELETE FROM zones WHERE domain = ?", (domain,))
@@ -0,0 +1,300 @@
+from utilcli.modules.PorkbunAPI import PorkbunAPI, PorkbunRecord, PorkbunResponse, Type
+from utilcli.modules.Concurrency import run_concurrently
+from typing import Dict, Iterator, List, Tuple
+from collections import defaultdict
+from ipaddress import ip_address
+from pathlib import Path
+import json
+import re
+
+
+DEFAULT_TTL = 600
+PRIO_TYPES = (Type.MX, Type.SRV)
+TARGET_TYPES = (Type.CNAME, Type.ALIAS, Type.MX, Type.NS, Type.SRV)
+TTL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+BIND_CLASSES = ("IN", "CH", "HS")
+
+
+class ZoneChange:
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+
+    def __init__(self, action: str, record: PorkbunRecord, current: PorkbunRecord = None) -> None:
+        self.action = action
+        self.record = record
+        self.current = current
+
+    def to_dict(self) -> Dict:
+        # Flat so it fits a csv row, `current_*` are the live values an update replaces
+        record, current = self.record, self.current
+        return {
+            "action": self.action,
+            "id": current.id if current else record.id,
+            "host": record.host,
+            "type": record.type.name,
+            "ip": record.ip,
+            "ttl": record.ttl,
+            "prio": record.prio,
+            "current_ip": current.ip if current else None,
+            "current_ttl": current.ttl if current else None,
+            "current_prio": current.prio if current else None,
+        }
+
+    def __str__(self) -> str:
+        record = self.record
+        if self.action == self.CREATE:
+            return f"+ {record.type.name:<5} {record.host} {record.ip} (ttl {record.ttl})"
+        if self.action == self.DELETE:
+            return f"- {record.type.name:<5} {record.host} {record.ip} (id {record.id})"
+        prio = f", prio {self.current.prio} -> {record.prio}" if record.type in PRIO_TYPES else ""
+        return (
+            f"~ {record.type.name:<5} {record.host} {self.current.ip} -> {record.ip} "
+            f"(ttl {self.current.ttl} -> {record.ttl}{prio}, id {self.current.id})"
+        )
+
+
+class ZonePlan:
+    def __init__(self) -> None:
+        self.creates: List[ZoneChange] = []
+        self.updates: List[ZoneChange] = []
+        self.deletes: List[ZoneChange] = []
+
+    @property
+    def changes(self) -> List[ZoneChange]:
+        return self.deletes + self.updates + self.creates
+
+    def is_empty(self) -> bool:
+        return len(self.changes) == 0
+
+    def summary(self) -> str:
+        return f"Plan: {len(self.creates)} to create, {len(self.updates)} to update, {len(self.deletes)} to delete"
+
+
+def parse_ttl(value) -> int:
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().lower()
+    if value.isdigit():
+        return int(value)
+    total = 0
+    for amount, unit in re.findall(r"(\d+)([smhdw])", value):
+        total += int(amount) * TTL_UNITS[unit]
+    if total == 0 or re.sub(r"\d+[smhdw]", "", value):
+        raise Exception(f'Invalid TTL "{value}"')
+    return total
+
+
+def normalize_content(type: Type, content: str) -> str:
+    content = str(content).strip()
+    if type in (Type.A, Type.AAAA):
+        return str(ip_address(content))
+    if type in TARGET_TYPES:
+        return content.rstrip(".").lower()
+    return content
+
+
+def _fqdn(name: str, origin: str) -> str:
+    name = name.strip()
+    if name in ("", "@"):
+        return origin
+    if name.endswith("."):
+        return name.rstrip(".").lower()
+    return f"{name}.{origin}".lower()
+
+
+def _make_record(host: str, type: Type, content: str, ttl: int, prio: int = None) -> PorkbunRecord:
+    content = normalize_content(type, content)
+    if type in PRIO_TYPES:
+        prio = int(prio) if prio is not None else 0
+    return PorkbunRecord(id=None, host=host, type=type, ip=content, ttl=ttl, prio=prio)
+
+
+def _strip_comment(line: str) -> str:
+    quoted = False
+    for index, char in enumerate(line):
+        if char == '"' and (index == 0 or line[index - 1] != "\\"):
+            quoted = not quoted
+        elif char == ";" and not quoted:
+            return line[:index]
+    return line
+
+
+def _bind_entries(text: str) -> Iterator[Tuple[int, bool, List[str]]]:
+    # Yields (line number, starts with owner, tokens), joining parenthesized continuation lines
+    buffer, has_owner, start, depth = [], False, 0, 0
+    for number, raw in enumerate(text.splitlines(), 1):
+        line = _strip_comment(raw)
+        if depth == 0:
+            if not line.strip():
+                continue
+            has_owner, start = not line[0].isspace(), number
+        tokens = re.findall(r'"(?:[^"\\]|\\.)*"|[()]|[^\s()]+', line)
+        for token in tokens:
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            else:
+                buffer.append(token)
+        if depth == 0 and buffer:
+            yield start, has_owner, buffer
+            buffer = []
+    if depth != 0:
+        raise Exception(f"Unbalanced parentheses in zone file (line {start})")
+
+
+def parse_bind_zone(text: str, domain: str) -> List[PorkbunRecord]:
+    origin, default_ttl, owner = domain.lower(), DEFAULT_TTL, None
+    records = []
+    for number, has_owner, tokens in _bind_entries(text):
+        if tokens[0].upper() == "$ORIGIN":
+            origin = tokens[1].rstrip(".").lower()
+            continue
+        if tokens[0].upper() == "$TTL":
+            default_ttl = parse_ttl(tokens[1])
+            continue
+        if tokens[0].startswith("$"):
+            raise Exception(f'Unsupported directive "{tokens[0]}" (line {number})')
+
+        if has_owner:
+            owner = _fqdn(tokens.pop(0), origin)
+        if owner is None:
+            raise Exception(f"Record without owner name (line {number})")
+
+        ttl = default_ttl
+        while tokens and (tokens[0].upper() in BIND_CLASSES or re.fullmatch(r"(\d+[smhdwSMHDW]?)+", tokens[0])):
+            token = tokens.pop(0)
+            if token.upper() not in BIND_CLASSES:
+                ttl = parse_ttl(token)
+        if len(tokens) < 2:
+            raise Exception(f"Incomplete record (line {number})")
+
+        record_type, rdata = tokens[0].upper(), tokens[1:]
+        if record_type == "SOA":
+            continue
+        try:
+            type = PorkbunRecord.get_appropriate_type(record_type)
+        except Exception:
+            raise Exception(f'Invalid record type "{record_type}" (line {number})')
+
+        prio = None
+        if type in PRIO_TYPES:
+            prio, rdata = int(rdata[0]), rdata[1:]
+        if type == Type.TXT:
+            content = "".join(x[1:-1] if x.startswith('"') else x for x in rdata)
+        else:
+            content = " ".join(rdata)
+        if type in TARGET_TYPES:
+            parts = content.split(" ")
+            parts[-1] = _fqdn(parts[-1], origin)
+            content = " ".join(parts)
+        records.append(_make_record(owner, type, content, ttl, prio))
+    return records
+
+
+def parse_record_file(data, domain: str) -> List[PorkbunRecord]:
+    default_ttl = DEFAULT_TTL
+    if isinstance(data, dict):
+        if data.get("domain") and data.get("domain").rstrip(".").lower() != domain.lower():
+            raise Exception(f'Zone file is for "{data.get("domain")}", but the configured domain is "{domain}"')
+        default_ttl = parse_ttl(data.get("ttl", DEFAULT_TTL))
+        data = data.get("records")
+    if not isinstance(data, list):
+        raise Exception('Zone file must contain a list of records, either top level or under "records"')
+
+    records = []
+    for index, entry in enumerate(data, 1):
+        if not isinstance(entry, dict) or not entry.get("type") or entry.get("content") is None:
+            raise Exception(f'Record #{index} must have at least "type" and "content"')
+        type = PorkbunRecord.get_appropriate_type(str(entry.get("type")))
+        host = str(entry.get("host") or "@").lower()
+        if host != domain.lower() and not host.endswith(f".{domain.lower()}"):
+            host = _fqdn(host, domain.lower())
+        ttl = parse_ttl(entry.get("ttl", default_ttl))
+        contents = entry.get("content")
+        for content in contents if isinstance(contents, list) else [contents]:
+            records.append(_make_record(host, type, content, ttl, entry.get("prio")))
+    return records
+
+
+def load_zone_file(path: Path, domain: str) -> List[PorkbunRecord]:
+    text = Path(path).read_text()
+    suffix = Path(path).suffix.lower()
+    if suffix in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise Exception(
+                "PyYAML is required to read YAML zone files, install utilcli[yaml] or use a JSON/BIND zone file"
+            )
+        return parse_record_file(yaml.safe_load(text), domain)
+    if suffix == ".json":
+        return parse_record_file(json.loads(text), domain)
+    return parse_bind_zone(text, domain)
+
+
+def _same(type: Type, current: PorkbunRecord, desired: PorkbunRecord) -> bool:
+    if int(current.ttl) != desired.ttl:
+        return False
+    return type not in PRIO_TYPES or int(current.prio or 0) == desired.prio
+
+
+def plan_zone(
+    desired: List[PorkbunRecord], existing: List[PorkbunRecord], domain: str, prune: bool = True
+) -> ZonePlan:
+    plan = ZonePlan()
+    desired_by_key: Dict[Tuple, List[PorkbunRecord]] = defaultdict(list)
+    existing_by_key: Dict[Tuple, List[PorkbunRecord]] = defaultdict(list)
+    for record in desired:
+        desired_by_key[(record.host, record.type)].append(record)
+    for record in existing:
+        # Apex NS records are managed by the registrar unless the zone file declares them
+        key = (record.host.lower(), record.type)
+        if record.type == Type.NS and record.host.lower() == domain.lower() and key not in desired_by_key:
+            continue
+        existing_by_key[key].append(record)
+
+    for key in list(desired_by_key) + [x for x in existing_by_key if x not in desired_by_key]:
+        type = key[1]
+        wanted = list(desired_by_key.get(key, []))
+        current = {}
+        for record in existing_by_key.get(key, []):
+            current.setdefault(normalize_content(type, record.ip), []).append(record)
+
+        unmatched = []
+        for record in wanted:
+            match = current.get(record.ip)
+            if match:
+                found = match.pop(0)
+                if not _same(type, found, record):
+                    plan.updates.append(ZoneChange(ZoneChange.UPDATE, record, found))
+            else:
+                unmatched.append(record)
+
+        leftover = [x for records in current.values() for x in records]
+        for record in unmatched:
+            if leftover:
+                plan.updates.append(ZoneChange(ZoneChange.UPDATE, record, leftover.pop(0)))
+            else:
+                plan.creates.append(ZoneChange(ZoneChange.CREATE, record))
+        if prune:
+            plan.deletes.extend(ZoneChange(ZoneChange.DELETE, record) for record in leftover)
+    return plan
+
+
+def _apply_change(api: PorkbunAPI, change: ZoneChange) -> PorkbunResponse:
+    record = change.record
+    if change.action == ZoneChange.CREATE:
+        return api.create_record(record.host, record.ip, record.type.name, record.ttl, record.prio)
+    if change.action == ZoneChange.UPDATE:
+        return api.edit_record(change.current.id, record.host, record.ip, record.type.name, record.ttl, record.prio)
+    return api.delete_record_by_id(record)
+
+
+def apply_plan(
+    api: PorkbunAPI, plan: ZonePlan, workers: int = 8
+) -> Iterator[Tuple[ZoneChange, PorkbunResponse, Exception]]:
+    # Deletions go first so a replaced record (e.g. CNAME -> A on the same host) never conflicts
+    for phase in (plan.deletes, plan.updates + plan.creates):
+        yield from run_concurrently(lambda change: _apply_change(api, change), phase, workers)
@@ -0,0 +1,186 @@
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import threading
+import random
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float = None, burst: int = None) -> None:
+        # rate is in requests per second, None means unlimited
+        self.RATE = rate
+        self.BURST = max(burst if burst else 1, 1)
+        self.__tokens = float(self.BURST)
+        self.__updated = time.monotonic()
+        self.__paused_until = 0.0
+        self.__lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        with self.__lock:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+
+    def acquire(self) -> float:
+        # Blocks until a request may be sent, returns the time spent waiting
+        waited = 0.0
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                delay = self.__paused_until - now
+                if delay <= 0 and self.RATE:
+                    self.__tokens = min(self.BURST, self.__tokens + (now - self.__updated) * self.RATE)
+                    self.__updated = now
+                    if self.__tokens >= 1:
+                        self.__tokens -= 1
+                        return waited
+                    delay = (1 - self.__tokens) / self.RATE
+                elif delay <= 0:
+                    return waited
+            time.sleep(delay)
+            waited += delay
+
+
+class RetryPolicy:
+    ALWAYS_RETRY = (429, 503)
+    IDEMPOTENT_RETRY = (500, 502, 504)
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+    def __init__(self, retries: int = 3, backoff: float = 0.5, max_backoff: float = 60) -> None:
+        self.RETRIES = retries
+        self.BACKOFF = backoff
+        self.MAX_BACKOFF = max_backoff
+
+    def should_retry(self, status_code: int, idempotent: bool) -> bool:
+        return status_code in self.ALWAYS_RETRY or (idempotent and status_code in self.IDEMPOTENT_RETRY)
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+        # Full jitter backoff, a Retry-After header wins when present; None means give up
+        delay = random.uniform(0, min(self.MAX_BACKOFF, self.BACKOFF * 2**attempt))
+        server_delay = self.parse_retry_after(retry_after)
+        if server_delay is not None:
+            if server_delay > self.MAX_BACKOFF:
+                return None
+            delay = max(delay, server_delay)
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+def is_connect_error(error: Exception) -> bool:
+    # True when the connection was never established, so the request can't have reached the server
+    from requests.exceptions import ConnectTimeout, ConnectionError
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if isinstance(error, ConnectionError) and error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def is_read_timeout(error: Exception) -> bool:
+    # The server got the request but didn't answer in time, it may still have acted on it
+    from requests.exceptions import ReadTimeout
+
+    return isinstance(error, ReadTimeout)
+
+
+def is_transient_status(status_code: int) -> bool:
+    # The server is having trouble, not refusing the request
+    return status_code == 429 or status_code >= 500
+
+
+def is_transient_error(error: Exception) -> bool:
+    # True when the transport failed or the server answered with a transient status, anywhere in the chain of causes
+    from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, Timeout
+
+    while error is not None:
+        if isinstance(error, HTTPError) and error.response is not None:
+            return is_transient_status(error.response.status_code)
+        if isinstance(error, (ChunkedEncodingError, ConnectionError, Timeout)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class RequestScheduler:
+    def __init__(self, retry_policy: RetryPolicy = None) -> None:
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.__buckets: Dict[str, TokenBucket] = {}
+        self.__policies: Dict[str, RetryPolicy] = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        return urlparse(url if "//" in url else f"//{url}").netloc.lower()
+
+    def set_limits(self, url: str, rate: float = None, burst: int = None, retries: int = None) -> None:
+        host = self.host_of(url)
+        with self.__lock:
+            self.__buckets[host] = TokenBucket(rate, burst if burst else (int(rate) if rate else 1))
+            if retries is not None:
+                policy = self.retry_policy
+                self.__policies[host] = RetryPolicy(retries, policy.BACKOFF, policy.MAX_BACKOFF)
+
+    def __bucket(self, host: str) -> TokenBucket:
+        with self.__lock:
+            if host not in self.__buckets:
+                self.__buckets[host] = TokenBucket()
+            return self.__buckets[host]
+
+    def execute(
+        self,
+        method: str,
+        url: str,
+        send: Callable,
+        idempotent: bool = None,
+        retry_read_timeout: bool = False,
+        retries: int = None,
+    ):
+        # A read timeout is only retried for idempotent requests whose caller opts in, retrying it multiplies the
+        # caller's timeout and may repeat a request the server already acted on. `retries` overrides the host's
+        # policy for this request, 0 for callers with a deadline of their own.
+        host = self.host_of(url)
+        bucket = self.__bucket(host)
+        policy = self.__policies.get(host, self.retry_policy)
+        if retries is not None:
+            policy = RetryPolicy(retries, policy.BACKOFF, policy.MAX_BACKOFF)
+        if idempotent is None:
+            idempotent = method.upper() in RetryPolicy.IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = send()
+            except Exception as e:
+                # Only retry failures where the request can't have reached the server, or is safe to repeat
+                if attempt >= policy.RETRIES or not (idempotent or is_connect_error(e)):
+                    raise
+                if is_read_timeout(e) and not (idempotent and retry_read_timeout):
+                    raise
+                time.sleep(policy.delay(attempt))
+                attempt += 1
+                continue
+
+            if attempt >= policy.RETRIES or not policy.should_retry(response.status_code, idempotent):
+                return response
+            delay = policy.delay(attempt, response.headers.get("Retry-After"))
+            if delay is None:
+                return response
+            if response.status_code == 429:
+                # Every caller sharing this host backs off, not only the one that got throttled
+                bucket.pause(delay)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
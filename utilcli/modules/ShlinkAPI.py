@@ -1,10 +1,17 @@
 from utilcli.modules.CommandResponse import CommandResponse
-from typing import List, Dict, Tuple
+from utilcli.modules.HTTPTransport import HTTPTransport, get_transport
+from utilcli.modules.DiskCache import DiskCache
+from utilcli.modules.Concurrency import run_ordered
+from utilcli.modules.Tracer import get_tracer
+from typing import TYPE_CHECKING, Iterator, List, Dict, Optional, Tuple
 from urllib.parse import urlparse
-import requests
+from datetime import datetime
 import json
 import re
 
+if TYPE_CHECKING:
+    from utilcli.modules.ShlinkURLIndex import ShlinkURLIndex
+
 
 class ShlinkIdentifier:
     def __init__(self, identifier: str, available_domain: List[str]) -> None:
@@ -53,30 +60,85 @@ class ShlinkResponse(CommandResponse):
         self.short_url = short_url
 
     def __str__(self):
-        return json.dumps(
-            {
-                "is_ok": self.is_ok,
-                "status_code": self.status_code,
-                "message": self.message,
-                "error_type": self.error_type,
-                "domains": self.domains,
-                "short_code": self.short_code,
-                "short_url": self.short_url,
-            },
-            indent=2,
-        )
+        return json.dumps(self.to_dict(), indent=2)
+
+
+class ShlinkShortURL:
+    FIELDS = ("short_code", "short_url", "long_url", "domain", "date_created", "visits", "tags", "title")
+    __slots__ = FIELDS
+
+    def __init__(
+        self,
+        short_code: str,
+        short_url: str,
+        long_url: str,
+        domain: str = None,
+        date_created: str = None,
+        visits: int = None,
+        tags: List[str] = None,
+        title: str = None,
+    ) -> None:
+        self.short_code = short_code
+        self.short_url = short_url
+        self.long_url = long_url
+        self.domain = domain
+        self.date_created = date_created
+        self.visits = visits
+        self.tags = tags if tags else []
+        self.title = title
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __str__(self):
+        return f"{self.short_url}\t{self.long_url}"
+
+
+class ShlinkVisit:
+    __slots__ = ("date", "referer", "user_agent", "potential_bot", "country", "city")
+
+    def __init__(
+        self,
+        date: str,
+        referer: str = None,
+        user_agent: str = None,
+        potential_bot: bool = False,
+        country: str = None,
+        city: str = None,
+    ) -> None:
+        self.date = date
+        self.referer = referer
+        self.user_agent = user_agent
+        self.potential_bot = potential_bot
+        self.country = country
+        self.city = city
 
 
 class ShlinkAPI:
-    def __init__(self, domain: str, api_key: str) -> None:
+    def __init__(
+        self,
+        domain: str,
+        api_key: str,
+        transport: HTTPTransport = None,
+        domain_cache: DiskCache = None,
+        api_url: str = None,
+        url_index: "ShlinkURLIndex" = None,
+    ) -> None:
         self.API_DOMAIN = domain
         self.API_KEY = api_key
-        self.API_ENDPOINT = f"https://{self.API_DOMAIN}/rest/v2"
+        self.API_ENDPOINT = api_url.rstrip("/") if api_url else f"https://{self.API_DOMAIN}/rest/v2"
         self.__HEADER = {
             "Accept": "application/json",
             "Content-Type": "application/json",
             "X-Api-Key": self.API_KEY,
         }
+        self.__transport = transport if transport else get_transport()
+        self.domain_cache = domain_cache
+        self.url_index = url_index
+
+    @property
+    def base_url(self) -> str:
+        return self.API_ENDPOINT
 
     @staticmethod
     def validate_url(url: str, validate_protocol: bool = True) -> bool:
@@ -88,7 +150,7 @@ class ShlinkAPI:
     def __construct_message(self, response: Dict) -> str:
         return f"[{response.get('type')}] {response.get('title')}\n{response.get('detail')}"
 
-    def get_available_domain(self) -> ShlinkResponse:
+    def __fetch_available_domain(self) -> ShlinkResponse:
         ENDPOINT = "/domains"
         res = self.__api_call(endpoint=ENDPOINT)
         if res.get("status_code") == 200:
@@ -105,38 +167,85 @@ class ShlinkAPI:
                 message=self.__construct_message(response=res),
             )
 
+    def __refresh_domain_cache(self) -> List[str]:
+        res = self.__fetch_available_domain()
+        return res.domains if res.ok() else None
+
+    def get_available_domain(self, refresh: bool = False) -> ShlinkResponse:
+        if not self.domain_cache:
+            return self.__fetch_available_domain()
+
+        if not refresh:
+            domains, is_fresh = self.domain_cache.get(self.API_DOMAIN)
+            if domains is not None:
+                if not is_fresh:
+                    self.domain_cache.revalidate(self.API_DOMAIN, self.__refresh_domain_cache)
+                return ShlinkResponse(is_ok=True, status_code=200, domains=domains)
+
+        res = self.__fetch_available_domain()
+        if res.ok():
+            self.domain_cache.set(self.API_DOMAIN, res.domains)
+        return res
+
     def __api_call(
         self,
         method: str = "GET",
         payload: Dict = {},
         params: Dict = None,
         endpoint: str = None,
+        idempotent: bool = None,
     ) -> Dict:
         FINAL_ENDPOINT = f'{self.API_ENDPOINT}{endpoint if endpoint else ""}'
+        tracer = get_tracer()
         try:
-            r = requests.request(
-                method=method,
-                url=FINAL_ENDPOINT,
-                headers=self.__HEADER,
-                json=payload,
-                params=params,
-            )
-            res = {"status_code": r.status_code}
-            return {**r.json(), **res} if len(r.text) > 0 else res
-        except Exception:
-            raise Exception("Error occur while sending request to server")
+            with tracer.span(f"shlink {method} {endpoint or '/'}", "api", method=method, endpoint=endpoint) as span:
+                r = self.__transport.request(
+                    method,
+                    FINAL_ENDPOINT,
+                    headers=self.__HEADER,
+                    json=payload,
+                    params=params,
+                    idempotent=idempotent,
+                )
+                res = {"status_code": r.status_code}
+                span["status"] = r.status_code
+                with tracer.phase("parse"):
+                    return {**r.json(), **res} if len(r.text) > 0 else res
+        except Exception as e:
+            raise Exception("Error occur while sending request to server") from e
+
+    def resolve_identifiers(self, identifiers: List[str]) -> Tuple[ShlinkResponse, List[ShlinkIdentifier]]:
+        # Parses many identifiers against a single domain lookup
+        res = self.get_available_domain()
+        if not res.ok():
+            return res, None
+        parsed = [ShlinkIdentifier(x, res.domains) for x in identifiers]
+        if self.domain_cache and any("/" in x.get_short_code() for x in parsed):
+            # The cached list may predate a domain used in the identifiers
+            res = self.get_available_domain(refresh=True)
+            if not res.ok():
+                return res, None
+            parsed = [ShlinkIdentifier(x, res.domains) for x in identifiers]
+        return res, parsed
 
-    def edit_short_url(self, identifier: str, new_long_url: str) -> ShlinkResponse:
+    def __resolve_identifier(
+        self, identifier: str, domains: List[str] = None
+    ) -> Tuple[ShlinkResponse, ShlinkIdentifier]:
+        if domains is not None:
+            return ShlinkResponse(is_ok=True, status_code=200, domains=domains), ShlinkIdentifier(identifier, domains)
+        res, parsed = self.resolve_identifiers([identifier])
+        return res, parsed[0] if parsed else None
+
+    def edit_short_url(self, identifier: str, new_long_url: str, domains: List[str] = None) -> ShlinkResponse:
         ENDPOINT = "/short-urls"
         if not self.validate_url(new_long_url):
             raise Exception(
                 "Please provide a valid url, make sure the new url contains either http:// or https:// prefix"
             )
 
-        res = self.get_available_domain()
+        res, shlink_identifier = self.__resolve_identifier(identifier, domains)
         if not res.ok():
             return res
-        shlink_identifier = ShlinkIdentifier(identifier, res.domains)
 
         payload = {"longUrl": new_long_url, "validateUrl": True, "crawlable": False}
 
@@ -147,6 +256,7 @@ class ShlinkAPI:
             payload=payload,
             params=query_param,
             endpoint=f"{ENDPOINT}/{shlink_identifier.get_short_code()}",
+            idempotent=True,
         )
         if res.get("status_code") != 200:
             return ShlinkResponse(
@@ -156,14 +266,14 @@ class ShlinkAPI:
                 message=self.__construct_message(res),
             )
         else:
+            self.__forget(shlink_identifier)
             return ShlinkResponse(is_ok=True, status_code=res.get("status_code"))
 
-    def delete_short_url(self, identifier: str) -> ShlinkResponse:
+    def delete_short_url(self, identifier: str, domains: List[str] = None) -> ShlinkResponse:
         ENDPOINT = "/short-urls"
-        res = self.get_available_domain()
+        res, shlink_identifier = self.__resolve_identifier(identifier, domains)
         if not res.ok():
             return res
-        shlink_identifier = ShlinkIdentifier(identifier, res.domains)
 
         status, domain = shlink_identifier.is_domain_specified()
         query_param = {"domain": domain} if status else None
@@ -175,6 +285,7 @@ class ShlinkAPI:
         )
 
         if res.get("status_code") == 204:
+            self.__forget(shlink_identifier)
             return ShlinkResponse(is_ok=True, status_code=res.get("status_code"))
         else:
             return ShlinkResponse(
@@ -184,27 +295,86 @@ class ShlinkAPI:
                 message=self.__construct_message(res),
             )
 
-    def shorten(self, url: str, slug: str = None, alt_domain: str = None) -> ShlinkResponse:
+    def __forget(self, shlink_identifier: ShlinkIdentifier) -> None:
+        # An edited or deleted short URL no longer answers for its old long URL
+        if self.url_index:
+            _, domain = shlink_identifier.is_domain_specified()
+            self.url_index.remove(domain or self.API_DOMAIN, shlink_identifier.get_short_code())
+
+    def get_short_url(self, short_code: str, domain: str = None) -> Optional[ShlinkShortURL]:
+        # None when the server doesn't know the short code
+        res = self.__api_call(
+            endpoint=f"/short-urls/{short_code}", params={"domain": domain} if domain else None, idempotent=True
+        )
+        if res.get("status_code") == 404:
+            return None
+        if res.get("status_code") != 200:
+            raise Exception(self.__construct_message(res))
+        return next(self.__parse_short_urls({"data": [res]}))
+
+    def __is_current(self, short_url: ShlinkShortURL) -> bool:
+        # Whether the server still has the indexed short URL pointing at the same long URL, stale entries are dropped
+        from utilcli.modules.ShlinkURLIndex import normalize_url
+
+        current = self.get_short_url(short_url.short_code, short_url.domain)
+        if current is None or normalize_url(current.long_url) != normalize_url(short_url.long_url):
+            self.url_index.remove(short_url.domain, short_url.short_code)
+            return False
+        return True
+
+    def verify_url_index(self, workers: int = 8) -> Tuple[int, int]:
+        # Checks every indexed short URL with the server, returns (confirmed, removed)
+        confirmed = removed = 0
+        for _, current, error in run_ordered(self.__is_current, self.url_index.entries(), workers):
+            if error:
+                raise error
+            confirmed += current
+            removed += not current
+        return confirmed, removed
+
+    def shorten(
+        self,
+        url: str,
+        slug: str = None,
+        alt_domain: str = None,
+        domains: List[str] = None,
+        verify: bool = False,
+        find_if_exists: bool = False,
+    ) -> ShlinkResponse:
+        # A URL shortened before is answered from the url index, `verify` confirms the indexed short URL first.
+        # `find_if_exists` has the server answer with a matching short URL it already has instead of creating another.
         ENDPOINT = "/short-urls"
         if not self.validate_url(url):
             raise Exception("Please provide a valid url, make sure the url contains either http:// or https:// prefix")
 
+        if self.url_index:
+            known = self.url_index.lookup(url, alt_domain or self.API_DOMAIN, slug)
+            if known and (not verify or self.__is_current(known)):
+                return ShlinkResponse(
+                    is_ok=True, status_code=200, short_code=known.short_code, short_url=known.short_url
+                )
+
         payload = {
             "longUrl": url,
-            "findIfExists": False,
+            "findIfExists": find_if_exists,
             "domain": self.API_DOMAIN,
             "validateUrl": True,
             "crawlable": False,
         }
 
-        if alt_domain:
+        if alt_domain and domains is None:
             res = self.get_available_domain()
+            if res.ok() and alt_domain not in res.domains and self.domain_cache:
+                # The cached list may predate a newly added domain
+                res = self.get_available_domain(refresh=True)
             if not res.ok():
                 return res
-            if alt_domain in res.domains:
+            domains = res.domains
+        if alt_domain:
+            if alt_domain in domains:
                 payload["domain"] = alt_domain
             else:
-                raise Exception(f'Please provide a valid domain. Available domain: "{", ".join(res.domains)}"')
+                raise Exception(f'Please provide a valid domain. Available domain: "{", ".join(domains)}"')
 
         if slug:
             payload["customSlug"] = slug
@@ -219,9 +389,108 @@ class ShlinkAPI:
                 message=self.__construct_message(res),
             )
         else:
+            if self.url_index:
+                self.url_index.add(
+                    payload["domain"],
+                    ShlinkShortURL(short_code=res.get("shortCode"), short_url=res.get("shortUrl"), long_url=url),
+                )
             return ShlinkResponse(
                 is_ok=True,
                 status_code=res.get("status_code"),
                 short_code=res.get("shortCode"),
                 short_url=res.get("shortUrl"),
             )
+
+    def __list_page(self, page: int, params: Dict) -> Dict:
+        res = self.__api_call(endpoint="/short-urls", params={**params, "page": page}, idempotent=True)
+        if res.get("status_code") != 200:
+            raise Exception(self.__construct_message(res))
+        return res.get("shortUrls")
+
+    @staticmethod
+    def __parse_short_urls(page: Dict) -> Iterator[ShlinkShortURL]:
+        for x in page.get("data"):
+            # Shlink 3 moved the visit count into visitsSummary
+            visits = (x.get("visitsSummary") or {}).get("total", x.get("visitsCount"))
+            yield ShlinkShortURL(
+                short_code=x.get("shortCode"),
+                short_url=x.get("shortUrl"),
+                long_url=x.get("longUrl"),
+                domain=x.get("domain"),
+                date_created=x.get("dateCreated"),
+                visits=visits,
+                tags=x.get("tags"),
+                title=x.get("title"),
+            )
+
+    def list_short_urls(
+        self,
+        tags: List[str] = None,
+        match_all_tags: bool = False,
+        domain: str = None,
+        start_date: datetime = None,
+        end_date: datetime = None,
+        search_term: str = None,
+        page_size: int = 500,
+        workers: int = 8,
+    ) -> Tuple[Optional[int], Iterator[ShlinkShortURL]]:
+        # The first page is fetched right away for the page count, the rest are fetched concurrently and yielded in
+        # order with at most 2 * workers pages held in memory. Returns (total, short URLs).
+        params = {"itemsPerPage": page_size, "orderBy": "dateCreated-ASC"}
+        if tags:
+            params["tags[]"] = list(tags)
+            params["tagsMode"] = "all" if match_all_tags else "any"
+        if domain:
+            params["domain"] = domain
+        if start_date:
+            params["startDate"] = start_date.isoformat()
+        if end_date:
+            params["endDate"] = end_date.isoformat()
+        if search_term:
+            params["searchTerm"] = search_term
+
+        first = self.__list_page(1, params)
+        pagination = first.get("pagination") or {}
+        pages = pagination.get("pagesCount", 1)
+
+        def short_urls() -> Iterator[ShlinkShortURL]:
+            yield from self.__parse_short_urls(first)
+            for _, page, error in run_ordered(lambda x: self.__list_page(x, params), range(2, pages + 1), workers):
+                if error:
+                    raise error
+                yield from self.__parse_short_urls(page)
+
+        return pagination.get("totalItems"), short_urls()
+
+    def get_visits(
+        self, short_code: str, domain: str = None, start_date: str = None, page_size: int = 5000
+    ) -> List[ShlinkVisit]:
+        # start_date is inclusive and in Shlink's own ISO 8601 format, e.g. the date of the last visit already seen
+        ENDPOINT = f"/short-urls/{short_code}/visits"
+        params = {"itemsPerPage": page_size}
+        if domain:
+            params["domain"] = domain
+        if start_date:
+            params["startDate"] = start_date
+
+        visits, page, pages = [], 1, 1
+        while page <= pages:
+            res = self.__api_call(endpoint=ENDPOINT, params={**params, "page": page}, idempotent=True)
+            if res.get("status_code") != 200:
+                raise Exception(self.__construct_message(res))
+            data = res.get("visits")
+            for x in data.get("data"):
+                location = x.get("visitLocation") or {}
+                visits.append(
+                    ShlinkVisit(
+                        date=x.get("date"),
+                        referer=x.get("referer"),
+                        user_agent=x.get("userAgent"),
+                        potential_bot=x.get("potentialBot", False),
+                        country=location.get("countryCode"),
+                        city=location.get("cityName"),
+                    )
+                )
+            pages = (data.get("pagination") or {}).get("pagesCount", 1)
+            page += 1
+        return visits
@@ -0,0 +1,165 @@
+from utilcli.modules.ShlinkAPI import ShlinkShortURL
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+from pathlib import Path
+import threading
+import sqlite3
+import time
+
+
+def normalize_url(url: str) -> str:
+    # Scheme and host are case insensitive, default ports and an empty path are implied. The rest of the URL is
+    # compared as is, the server treats any other difference as a different long URL.
+    parts = urlsplit(url.strip())
+    scheme, host = parts.scheme.lower(), (parts.hostname or "").rstrip(".")
+    try:
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    if ":" in host:
+        host = f"[{host}]"
+    if port is not None and port != {"http": 80, "https": 443}.get(scheme):
+        host = f"{host}:{port}"
+    userinfo = parts.netloc.rpartition("@")[0]
+    netloc = f"{userinfo}@{host}" if userinfo else host
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+class ShlinkURLIndex:
+    # Short URLs by long URL so shortening a URL again is answered locally. Entries are keyed by (domain, short
+    # code) like on the server, filled from shorten responses and server exports, and the least recently used are
+    # evicted past MAX_ENTRIES.
+    __SCHEMA = """
+        CREATE TABLE IF NOT EXISTS short_urls (
+            domain TEXT NOT NULL,
+            short_code TEXT NOT NULL,
+            short_url TEXT NOT NULL,
+            long_url TEXT NOT NULL,
+            normalized_url TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (domain, short_code)
+        );
+        CREATE INDEX IF NOT EXISTS short_urls_normalized_url ON short_urls (normalized_url, domain, last_used);
+        CREATE INDEX IF NOT EXISTS short_urls_last_used ON short_urls (last_used);
+    """
+    __INSERT = "INSERT OR REPLACE INTO short_urls VALUES (?, ?, ?, ?, ?, ?)"
+    __SEED_CHUNK = 1000
+
+    def __init__(self, path: Path, max_entries: int = 100000) -> None:
+        self.PATH = Path(path)
+        self.MAX_ENTRIES = max_entries
+        self.__lock = threading.RLock()
+        self.__connection: Optional[sqlite3.Connection] = None
+        self.__size: Optional[int] = None
+
+    @property
+    def __db(self) -> sqlite3.Connection:
+        # Opened on first use, shlink commands that never shorten don't touch the file
+        with self.__lock:
+            if self.__connection is None:
+                self.PATH.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(self.PATH, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                # The index can always be rebuilt from the server, a lost commit on power failure is fine
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.executescript(self.__SCHEMA)
+                self.__connection = connection
+                self.__size = connection.execute("SELECT COUNT(*) FROM short_urls").fetchone()[0]
+            return self.__connection
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+    @staticmethod
+    def __row(domain: str, short_url: ShlinkShortURL) -> tuple:
+        return (
+            domain,
+            short_url.short_code,
+            short_url.short_url,
+            short_url.long_url,
+            normalize_url(short_url.long_url),
+            time.time(),
+        )
+
+    def lookup(self, long_url: str, domain: str, slug: str = None) -> Optional[ShlinkShortURL]:
+        # The most recently used short URL of `long_url` on `domain`, only the one with that short code with `slug`
+        query = "SELECT short_code, short_url, long_url FROM short_urls WHERE normalized_url = ? AND domain = ?"
+        params = [normalize_url(long_url), domain]
+        if slug:
+            query, params = f"{query} AND short_code = ?", [*params, slug]
+        with self.__lock:
+            row = self.__db.execute(f"{query} ORDER BY last_used DESC LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            with self.__db:
+                self.__db.execute(
+                    "UPDATE short_urls SET last_used = ? WHERE domain = ? AND short_code = ?",
+                    (time.time(), domain, row[0]),
+                )
+        short_code, short_url, long_url = row
+        return ShlinkShortURL(short_code=short_code, short_url=short_url, long_url=long_url, domain=domain)
+
+    def add(self, domain: str, short_url: ShlinkShortURL) -> None:
+        self.add_many(domain, [short_url])
+
+    def add_many(self, default_domain: str, short_urls: Iterable[ShlinkShortURL]) -> int:
+        # Short URLs without a domain belong to `default_domain`. Returns the number of short URLs added.
+        added, chunk = 0, []
+        for short_url in short_urls:
+            chunk.append(self.__row(short_url.domain or default_domain, short_url))
+            if len(chunk) >= self.__SEED_CHUNK:
+                added += self.__insert(chunk)
+                chunk = []
+        return added + self.__insert(chunk)
+
+    def __insert(self, rows: List[tuple]) -> int:
+        if not rows:
+            return 0
+        added = 0
+        with self.__lock, self.__db:
+            for row in rows:
+                exists = self.__db.execute("SELECT 1 FROM short_urls WHERE domain = ? AND short_code = ?", row[:2])
+                added += exists.fetchone() is None
+                self.__db.execute(self.__INSERT, row)
+            self.__size += added
+            self.__evict()
+        return added
+
+    def __evict(self) -> None:
+        excess = self.__size - self.MAX_ENTRIES
+        if excess <= 0:
+            return
+        self.__db.execute(
+            "DELETE FROM short_urls WHERE rowid IN (SELECT rowid FROM short_urls ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self.__size -= excess
+
+    def remove(self, domain: str, short_code: str) -> None:
+        with self.__lock, self.__db:
+            removed = self.__db.execute(
+                "DELETE FROM short_urls WHERE domain = ? AND short_code = ?", (domain, short_code)
+            ).rowcount
+            self.__size -= removed
+
+    def entries(self) -> List[ShlinkShortURL]:
+        with self.__lock:
+            rows = self.__db.execute("SELECT domain, short_code, short_url, long_url FROM short_urls").fetchall()
+        return [
+            ShlinkShortURL(short_code=code, short_url=short_url, long_url=long_url, domain=domain)
+            for domain, code, short_url, long_url in rows
+        ]
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            domains = self.__db.execute("SELECT COUNT(DISTINCT domain) FROM short_urls").fetchone()[0]
+            return {"entries": self.__size, "domains": domains, "max_entries": self.MAX_ENTRIES}
+
+    def clear(self) -> int:
+        with self.__lock, self.__db:
+            cleared = self.__db.execute("DELETE FROM short_urls").rowcount
+            self.__size = 0
+        return cleared
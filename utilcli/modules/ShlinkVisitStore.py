@@ -0,0 +1,109 @@
+from utilcli.modules.ShlinkAPI import ShlinkVisit
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import threading
+import sqlite3
+
+
+class ShlinkVisitStore:
+    # Visits are kept per (domain, short code), the default domain is stored as "". daily_visits is maintained on
+    # every sync so reports never scan the visits table.
+    __SCHEMA = """
+        CREATE TABLE IF NOT EXISTS visits (
+            domain TEXT NOT NULL,
+            short_code TEXT NOT NULL,
+            date TEXT NOT NULL,
+            day TEXT NOT NULL,
+            referer TEXT,
+            user_agent TEXT,
+            potential_bot INTEGER NOT NULL DEFAULT 0,
+            country TEXT,
+            city TEXT
+        );
+        CREATE INDEX IF NOT EXISTS visits_short_code ON visits (domain, short_code, date);
+        CREATE TABLE IF NOT EXISTS daily_visits (
+            domain TEXT NOT NULL,
+            short_code TEXT NOT NULL,
+            day TEXT NOT NULL,
+            visits INTEGER NOT NULL,
+            PRIMARY KEY (domain, short_code, day)
+        );
+        CREATE INDEX IF NOT EXISTS daily_visits_day ON daily_visits (day, visits);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            domain TEXT NOT NULL,
+            short_code TEXT NOT NULL,
+            high_water TEXT,
+            visits_count INTEGER,
+            PRIMARY KEY (domain, short_code)
+        );
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.PATH = Path(path)
+        self.PATH.parent.mkdir(parents=True, exist_ok=True)
+        # The store is shared by commands running on different threads in `util serve` and `util batch`
+        self.__db = sqlite3.connect(self.PATH, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript(self.__SCHEMA)
+        self.__lock = threading.RLock()
+
+    def close(self) -> None:
+        self.__db.close()
+
+    def sync_state(self) -> Dict[Tuple[str, str], Tuple[Optional[str], Optional[int]]]:
+        # (domain, short code) -> (date of the newest stored visit, visit count reported by the server at that time)
+        with self.__lock:
+            rows = self.__db.execute("SELECT domain, short_code, high_water, visits_count FROM sync_state").fetchall()
+        return {(domain, code): (high_water, count) for domain, code, high_water, count in rows}
+
+    def store(
+        self, domain: str, short_code: str, visits: List[ShlinkVisit], since: Optional[str], visits_count: int = None
+    ) -> int:
+        # `visits` is everything the server has at or after `since`, or all of them when `since` is None. Visits at
+        # exactly `since` were stored by the previous sync too, they're replaced since visits have no id to
+        # deduplicate on. Returns the number of visits that weren't stored before.
+        domain = domain or ""
+        days = {x.date[:10] for x in visits}
+        high_water = max([x.date for x in visits] + ([since] if since else []), default=None)
+        with self.__lock, self.__db:
+            key = (domain, short_code)
+            if since:
+                replaced = self.__db.execute(
+                    "DELETE FROM visits WHERE domain = ? AND short_code = ? AND date = ?", (*key, since)
+                ).rowcount
+                days.add(since[:10])
+            else:
+                # A full sync of this short code, start over
+                replaced = self.__db.execute("DELETE FROM visits WHERE domain = ? AND short_code = ?", key).rowcount
+                self.__db.execute("DELETE FROM daily_visits WHERE domain = ? AND short_code = ?", key)
+            self.__db.executemany(
+                "INSERT INTO visits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (domain, short_code, x.date, x.date[:10], x.referer, x.user_agent, int(bool(x.potential_bot)))
+                    + (x.country, x.city)
+                    for x in visits
+                ),
+            )
+            for day in days:
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO daily_visits SELECT domain, short_code, day, COUNT(*) FROM visits"
+                    " WHERE domain = ? AND short_code = ? AND day = ? GROUP BY domain, short_code, day",
+                    (*key, day),
+                )
+            self.__db.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)", (*key, high_water, visits_count)
+            )
+        return len(visits) - replaced
+
+    def top_by_day(self, since: str, top: int = 10) -> List[Tuple[str, str, str, int]]:
+        # (day, domain, short code, visits) for the `top` short codes of every day on or after `since`
+        with self.__lock:
+            return self.__db.execute(
+                """
+                SELECT day, domain, short_code, visits FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY day ORDER BY visits DESC, short_code) AS rank
+                    FROM daily_visits WHERE day >= ?
+                ) WHERE rank <= ? ORDER BY day DESC, rank
+                """,
+                (since, top),
+            ).fetchall()
@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+import threading
+import socket
+import json
+import time
+import os
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.__origin = time.perf_counter()
+        self.__spans: List[Dict] = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+        self.enabled = True
+        # urllib3 resolves inside create_connection, timing getaddrinfo is the only way to split DNS from TCP connect
+        resolve = socket.getaddrinfo
+
+        def traced_getaddrinfo(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return resolve(*args, **kwargs)
+            finally:
+                self.record_phase("dns", time.perf_counter() - start)
+
+        socket.getaddrinfo = traced_getaddrinfo
+
+    def __stack(self) -> List[Dict]:
+        if not hasattr(self.__local, "stack"):
+            self.__local.stack = []
+        return self.__local.stack
+
+    @contextmanager
+    def span(self, name: str, category: str = "cli", **attrs) -> Iterator[Dict]:
+        # Yields the span's attributes so callers can add to them, e.g. the status code of a response
+        if not self.enabled:
+            yield attrs
+            return
+        stack = self.__stack()
+        stack.append(attrs)
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            end = time.perf_counter()
+            stack.pop()
+            thread = threading.current_thread()
+            span = {"name": name, "category": category, "start": start, "end": end, "thread": thread.name}
+            span["tid"] = thread.ident
+            with self.__lock:
+                self.__spans.append({**span, "attrs": attrs})
+
+    def record_phase(self, phase: str, seconds: float) -> None:
+        # Adds time to a phase of the innermost open span on this thread, e.g. the TLS handshake of a request
+        stack = self.__stack() if self.enabled else None
+        if stack:
+            phases = stack[-1].setdefault("phases", {})
+            phases[phase] = phases.get(phase, 0) + seconds * 1000
+
+    @contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - start)
+
+    @staticmethod
+    def __rounded(attrs: Dict) -> Dict:
+        return {k: ({p: round(v, 3) for p, v in v.items()} if k == "phases" else v) for k, v in attrs.items()}
+
+    def summary(self) -> Dict:
+        with self.__lock:
+            spans = sorted(self.__spans, key=lambda x: x["start"])
+        http = [x["attrs"] for x in spans if x["category"] == "http"]
+        phases: Dict[str, float] = {}
+        for attrs in http:
+            for phase, ms in attrs.get("phases", {}).items():
+                phases[phase] = phases.get(phase, 0) + ms
+        return {
+            "total_ms": round((time.perf_counter() - self.__origin) * 1000, 3),
+            "http": {
+                "requests": len(http),
+                "bytes": sum(x.get("bytes", 0) for x in http),
+                "new_connections": len([x for x in http if x.get("reused_connection") is False]),
+                "reused_connections": len([x for x in http if x.get("reused_connection")]),
+                "phases_ms": {k: round(v, 3) for k, v in phases.items()},
+            },
+            "spans": [
+                {
+                    "name": x["name"],
+                    "category": x["category"],
+                    "thread": x["thread"],
+                    "start_ms": round((x["start"] - self.__origin) * 1000, 3),
+                    "duration_ms": round((x["end"] - x["start"]) * 1000, 3),
+                    **self.__rounded(x["attrs"]),
+                }
+                for x in spans
+            ],
+        }
+
+    def chrome_trace(self) -> Dict:
+        # Trace Event Format, loads in chrome://tracing, Perfetto and speedscope
+        pid = os.getpid()
+        with self.__lock:
+            spans = list(self.__spans)
+        threads = {x["tid"]: x["thread"] for x in spans}
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        events += [
+            {
+                "name": x["name"],
+                "cat": x["category"],
+                "ph": "X",
+                "ts": round((x["start"] - self.__origin) * 1e6, 1),
+                "dur": round((x["end"] - x["start"]) * 1e6, 1),
+                "pid": pid,
+                "tid": x["tid"],
+                "args": self.__rounded(x["attrs"]),
+            }
+            for x in spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, format: str = "summary") -> str:
+        return json.dumps(self.chrome_trace() if format == "chrome" else self.summary(), indent=2, default=str)
+
+
+_TRACER = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _TRACER
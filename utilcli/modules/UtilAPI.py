@@ -1,28 +1,113 @@
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from utilcli.modules.CommandResponse import CommandResponse
-import requests
+from utilcli.modules.HTTPTransport import HTTPTransport, get_transport
+from utilcli.modules.Tracer import get_tracer
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+import threading
 import json
+import time
 
 
 class LyricsItem:
-    def __init__(self, title: str, artist: str, provider: str, lyrics: Callable) -> None:
+    def __init__(self, title: str, artist: str, provider: str, lyrics: Callable, stream: Callable = None) -> None:
         self.title = title
         self.artist = artist
         self.provider = provider
         self.lyrics = lyrics
+        self.stream = stream
 
     def get_lyrics(self) -> str:
         return self.lyrics()
 
+    def stream_lyrics(self) -> Iterator[str]:
+        # Text chunks as they are downloaded
+        if self.stream:
+            return self.stream()
+        return (x() for x in [self.get_lyrics])
+
+    def to_dict(self) -> Dict:
+        return {"title": self.title, "artist": self.artist, "provider": self.provider}
+
     def __str__(self) -> str:
-        return json.dumps(
-            {
-                "title": self.title,
-                "artist": self.artist,
-                "provider": self.provider,
-            },
-            indent=2,
-        )
+        return json.dumps(self.to_dict(), indent=2)
+
+
+class PrefetchedLyrics:
+    # Streams an item's lyrics into a buffer on a daemon thread, a download nobody is waiting for anymore never holds
+    # up the exit. Iterating yields what's buffered so far and then follows the same download.
+    def __init__(self, item: LyricsItem) -> None:
+        self.__chunks: List[str] = []
+        self.__done = False
+        self.__cancelled = False
+        self.__error: Optional[Exception] = None
+        self.__condition = threading.Condition()
+        threading.Thread(target=self.__download, args=(item,), name="lyrics-prefetch", daemon=True).start()
+
+    def __download(self, item: LyricsItem) -> None:
+        chunks, error = item.stream_lyrics(), None
+        try:
+            for chunk in chunks:
+                with self.__condition:
+                    if self.__cancelled:
+                        break
+                    self.__chunks.append(chunk)
+                    self.__condition.notify_all()
+        except Exception as e:
+            error = e
+        finally:
+            # Closes the response of a cancelled download
+            getattr(chunks, "close", lambda: None)()
+            with self.__condition:
+                self.__done, self.__error = True, error
+                self.__condition.notify_all()
+
+    def cancel(self) -> None:
+        with self.__condition:
+            self.__cancelled = True
+
+    def __iter__(self) -> Iterator[str]:
+        read = 0
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: read < len(self.__chunks) or self.__done)
+                chunks, error = self.__chunks[read:], self.__error
+            if not chunks:
+                if error:
+                    raise error
+                return
+            read += len(chunks)
+            yield from chunks
+
+
+class LyricsPrefetcher:
+    def __init__(self, limit: int = 3) -> None:
+        self.LIMIT = max(limit, 0)
+        self.__prefetched: Dict[LyricsItem, PrefetchedLyrics] = {}
+        self.__closed = False
+        self.__lock = threading.Lock()
+
+    def prefetch(self, item: LyricsItem) -> None:
+        with self.__lock:
+            if not self.__closed and len(self.__prefetched) < self.LIMIT and item not in self.__prefetched:
+                self.__prefetched[item] = PrefetchedLyrics(item)
+
+    def get_lyrics(self, item: LyricsItem) -> str:
+        return "".join(self.stream_lyrics(item))
+
+    def stream_lyrics(self, item: LyricsItem) -> Iterator[str]:
+        # A prefetched item carries on from what's already downloaded, anything else is streamed
+        with self.__lock:
+            prefetched = self.__prefetched.pop(item, None)
+        # Nothing else will be shown, the other downloads are dropped
+        self.close()
+        return iter(prefetched) if prefetched else item.stream_lyrics()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__closed = True
+            for prefetched in self.__prefetched.values():
+                prefetched.cancel()
+            self.__prefetched.clear()
 
 
 class UtilAPIResponse(CommandResponse):
@@ -32,27 +117,72 @@ class UtilAPIResponse(CommandResponse):
 
 
 class UtilAPI:
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(self, host: str, port: int, transport: HTTPTransport = None) -> None:
         self.__HOST = host
         self.__PORT = port
         self.__BASE = f"{self.__HOST}:{self.__PORT}/api"
         self.__LYRICS_SOURCES = ["ln", "genius", "al"]
+        # Small enough that the first lines of a slow response show up right away
+        self.__STREAM_CHUNK_SIZE = 1024
+        self.__transport = transport if transport else get_transport()
 
-    def __api_call(self, endpoint: str, query_params: Dict) -> Dict:
-        try:
-            r = requests.get(url=f"{self.__BASE}{endpoint}", params=query_params)
-            content_type = r.headers.get("Content-Type")
-            if content_type.find("json") == -1:
+    @property
+    def base_url(self) -> str:
+        return self.__BASE
+
+    def __api_call(self, endpoint: str, query_params: Dict, timeout: float = None) -> Dict:
+        # A timeout is the whole budget of the call, retries would multiply it
+        options = {"timeout": timeout, "retries": 0} if timeout else {}
+        options["cache"] = True
+        tracer = get_tracer()
+        with tracer.span(f"utilapi {endpoint}", "api", endpoint=endpoint) as span:
+            try:
+                r = self.__transport.request("GET", f"{self.__BASE}{endpoint}", params=query_params, **options)
+                content_type = r.headers.get("Content-Type")
+                span["status"] = r.status_code
+            except Exception:
+                raise Exception("Error occur while sending request to server")
+            if (content_type or "").find("json") == -1:
                 return r.text
-            else:
-                return r.json()
-        except requests.exceptions.JSONDecodeError:
-            raise Exception("Error occur while parsing request from the server")
-        except Exception:
-            raise Exception("Error occur while sending request to server")
+            try:
+                with tracer.phase("parse"):
+                    return r.json()
+            except ValueError:
+                raise Exception("Error occur while parsing request from the server")
 
-    def search_lyrics(self, query: str, source: Optional[List[str]] = None) -> UtilAPIResponse:
-        ENDPOINT = "/lyrics"
+    def __api_stream(
+        self, endpoint: str, query_params: Dict, timeout: float = None, headers: Dict = None
+    ) -> Iterator[Tuple[str, str]]:
+        # Yields (content type, text chunk) as the response is downloaded
+        # A timeout is the whole budget of the call, retries would multiply it and a response trickling in is cut off
+        # once it's spent
+        options = {"timeout": timeout, "retries": 0} if timeout else {}
+        options["cache"] = True
+        deadline = time.monotonic() + timeout if timeout else None
+        tracer = get_tracer()
+        with tracer.span(f"utilapi {endpoint}", "api", endpoint=endpoint, streamed=True) as span:
+            try:
+                r = self.__transport.request(
+                    "GET", f"{self.__BASE}{endpoint}", params=query_params, headers=headers, stream=True, **options
+                )
+                span["status"] = r.status_code
+            except Exception:
+                raise Exception("Error occur while sending request to server")
+            with r:
+                content_type = r.headers.get("Content-Type") or ""
+                r.encoding = r.encoding or "utf-8"
+                try:
+                    for chunk in r.iter_content(self.__STREAM_CHUNK_SIZE, decode_unicode=True):
+                        if deadline is not None and time.monotonic() > deadline:
+                            break
+                        yield content_type, chunk
+                    else:
+                        return
+                except Exception:
+                    raise Exception("Error occur while sending request to server")
+                raise Exception(f"No answer within {timeout}s")
+
+    def __query_params(self, query: str, source: Optional[List[str]]) -> Dict:
         query_params = {"q": query}
         if source:
             if len([x.strip() for x in source if x.strip() in self.__LYRICS_SOURCES]) == 0:
@@ -60,19 +190,118 @@ class UtilAPI:
                     f'Please provide a valid lyrics source. Source available "{", ".join(self.__LYRICS_SOURCES)}"'
                 )
             query_params["p"] = source
-        res = self.__api_call(endpoint=ENDPOINT, query_params=query_params)
+        return query_params
+
+    def __lyrics_item(self, index: int, entry: Dict, query_params: Dict) -> LyricsItem:
+        ENDPOINT = f"/lyrics/{index}"
+        query_params = {**query_params, "lyricsonly": 1}
+
+        def stream() -> Iterator[str]:
+            chunks = self.__api_stream(endpoint=ENDPOINT, query_params=query_params)
+            for content_type, chunk in chunks:
+                if content_type.find("json") == -1:
+                    yield chunk
+                    yield from (x for _, x in chunks)
+                    return
+                # Errors come back as JSON, read them whole
+                yield str(self.__parse("".join([chunk, *(x for _, x in chunks)])))
+
+        return LyricsItem(
+            entry.get("title"),
+            entry.get("artist"),
+            entry.get("provider"),
+            lambda: self.__api_call(endpoint=ENDPOINT, query_params=query_params),
+            stream,
+        )
+
+    @staticmethod
+    def __parse(text: str) -> Dict:
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise Exception("Error occur while parsing request from the server")
+
+    def search_lyrics(self, query: str, source: Optional[List[str]] = None, timeout: float = None) -> UtilAPIResponse:
+        ENDPOINT = "/lyrics"
+        query_params = self.__query_params(query, source)
+        res = self.__api_call(endpoint=ENDPOINT, query_params=query_params, timeout=timeout)
         if res.get("status") != "OK":
             return UtilAPIResponse(is_ok=False, message=res.get("message"))
         else:
-            query_params["lyricsonly"] = 1
-
             results = [
-                LyricsItem(
-                    entry.get("title"),
-                    entry.get("artist"),
-                    entry.get("provider"),
-                    lambda x=index: (self.__api_call(endpoint=f"{ENDPOINT}/{x}", query_params=query_params)),
-                )
-                for index, entry in enumerate(res.get("results"), 1)
+                self.__lyrics_item(index, entry, query_params) for index, entry in enumerate(res.get("results"), 1)
             ]
             return UtilAPIResponse(results=results, is_ok=True)
+
+    def stream_search_lyrics(
+        self, query: str, source: Optional[List[str]] = None, timeout: float = None
+    ) -> Iterator[LyricsItem]:
+        # Asks for NDJSON and yields every result as its line arrives. A server that answers with plain JSON has its
+        # results yielded once the whole response is in. Raises when the search fails.
+        ENDPOINT = "/lyrics"
+        query_params = self.__query_params(query, source)
+        headers = {"Accept": "application/x-ndjson, application/json;q=0.9"}
+
+        def results() -> Iterator[LyricsItem]:
+            chunks = self.__api_stream(endpoint=ENDPOINT, query_params=query_params, timeout=timeout, headers=headers)
+            buffer, index, content_type = "", 0, ""
+            for content_type, chunk in chunks:
+                buffer += chunk
+                if content_type.find("ndjson") == -1:
+                    continue
+                *lines, buffer = buffer.split("\n")
+                for line in filter(str.strip, lines):
+                    entry = self.__parse(line)
+                    if entry.get("status", "OK") != "OK":
+                        raise Exception(entry.get("message"))
+                    index += 1
+                    yield self.__lyrics_item(index, entry, query_params)
+            if content_type.find("ndjson") != -1:
+                if buffer.strip():
+                    index += 1
+                    yield self.__lyrics_item(index, self.__parse(buffer), query_params)
+                return
+            res = self.__parse(buffer)
+            if res.get("status") != "OK":
+                raise Exception(res.get("message"))
+            for index, entry in enumerate(res.get("results"), 1):
+                yield self.__lyrics_item(index, entry, query_params)
+
+        return results()
+
+    def search_lyrics_parallel(
+        self, query: str, source: Optional[List[str]] = None, timeout: float = None
+    ) -> Iterator[Tuple[str, UtilAPIResponse]]:
+        # One request per provider, yielded as each provider answers so a slow one doesn't hold back the rest. The
+        # requests run on daemon threads, a provider still busy once `timeout` is spent is given up on.
+        providers = [x.strip() for x in source or self.__LYRICS_SOURCES if x.strip() in self.__LYRICS_SOURCES]
+        if len(providers) == 0:
+            raise Exception(
+                f'Please provide a valid lyrics source. Source available "{", ".join(self.__LYRICS_SOURCES)}"'
+            )
+
+        def search(provider: str, future: Future) -> None:
+            try:
+                future.set_result(self.search_lyrics(query=query, source=[provider], timeout=timeout))
+            except Exception as e:
+                future.set_exception(e)
+
+        def responses() -> Iterator[Tuple[str, UtilAPIResponse]]:
+            deadline = time.monotonic() + timeout if timeout else None
+            futures = {Future(): provider for provider in providers}
+            for future, provider in futures.items():
+                threading.Thread(target=search, args=(provider, future), name="lyrics-search", daemon=True).start()
+            pending = set(futures)
+            while pending:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    error = future.exception()
+                    res = UtilAPIResponse(is_ok=False, message=str(error), results=[]) if error else future.result()
+                    yield futures[future], res
+            for future in pending:
+                yield futures[future], UtilAPIResponse(is_ok=False, message=f"No answer within {timeout}s", results=[])
+
+        return responses()
@@ -1,3 +1,4 @@
+from .HTTPTransport import HTTPTransport, configure_transport, get_transport
 from .PorkbunAPI import PorkbunAPI
 from .ShlinkAPI import ShlinkAPI
 from .UtilAPI import UtilAPI
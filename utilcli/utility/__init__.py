@@ -1 +1,14 @@
-from .utility import copy_to_clipboard, CONFIG
+from .utility import (
+    copy_to_clipboard,
+    configure_limits,
+    echo_error,
+    get_app_dir,
+    get_config,
+    get_config_path,
+    get_http_cache,
+    get_http_transport,
+    get_mutation_queue,
+    load_config,
+    set_clipboard_enabled,
+    start_flusher,
+)
@@ -1,24 +1,142 @@
+from functools import lru_cache
+from typing import Dict
 import json
 import subprocess
 import typer
+import time
+import sys
 from pathlib import Path
 
 
+# Turned off by commands that run many others, e.g. `util batch`
+_clipboard_enabled = True
+
+
+def set_clipboard_enabled(enabled: bool) -> None:
+    global _clipboard_enabled
+    _clipboard_enabled = enabled
+
+
 def copy_to_clipboard(data: str) -> None:
-    subprocess.run("clip", universal_newlines=True, input=data)
+    if _clipboard_enabled:
+        subprocess.run("clip", universal_newlines=True, input=data)
+
+
+def echo_error(message, output: str = "text") -> None:
+    # Plain output reports errors on stdout like it always has. Machine readable output keeps stdout for the
+    # records, the error goes to stderr and the command fails.
+    if output == "text":
+        return typer.echo(message)
+    typer.echo(message, err=True)
+    raise typer.Exit(code=1)
+
+
+def get_app_dir() -> Path:
+    app_dir = Path(typer.get_app_dir("utilcli"))
+    app_dir.mkdir(parents=True, exist_ok=True)
+    return app_dir
+
+
+def get_config_path() -> Path:
+    return Path(typer.get_app_dir("utilcli")) / "config.json"
+
+
+@lru_cache(maxsize=None)
+def load_config() -> Dict:
+    from utilcli.modules.Tracer import get_tracer
 
+    config_path = get_config_path()
+    with get_tracer().span("config load", path=str(config_path)):
+        if not config_path.is_file():
+            typer.echo("Config file doesn't exist yet")
+            raise typer.Exit(code=1)
+        try:
+            with open(config_path) as config:
+                return json.loads(config.read())
+        except Exception as e:
+            typer.echo(e)
+            raise typer.Exit(code=1)
 
-def load_config():
-    config_path: Path = Path(typer.get_app_dir("utilcli")) / "config.json"
-    if not config_path.is_file():
-        typer.echo("Config file doesn't exist yet")
+
+def get_config(section: str, required: bool = True) -> Dict:
+    config = load_config().get(section)
+    if config is None and required:
+        typer.echo(f'Section "{section}" is missing from the config file')
         raise typer.Exit(code=1)
-    with open(config_path) as config:
-        return json.loads(config.read())
+    return config if config is not None else {}
+
+
+@lru_cache(maxsize=None)
+def get_http_cache():
+    # None when CACHE_SIZE_MB is 0
+    from utilcli.modules.HTTPCache import HTTPCache
+
+    http_config = get_config("http", required=False)
+    size = http_config.get("CACHE_SIZE_MB", 64)
+    if not size:
+        return None
+    return HTTPCache(
+        get_app_dir() / "http_cache.sqlite3",
+        max_size=int(size * (1 << 20)),
+        default_ttl=http_config.get("CACHE_DEFAULT_TTL", 0),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_http_transport():
+    from utilcli.modules import configure_transport
+
+    http_config = get_config("http", required=False)
+    return configure_transport(
+        pool_size=http_config.get("POOL_SIZE", 10),
+        timeout=(http_config.get("CONNECT_TIMEOUT", 5), http_config.get("READ_TIMEOUT", 30)),
+        keep_alive=http_config.get("KEEP_ALIVE", True),
+        retries=http_config.get("RETRIES", 3),
+        cache=get_http_cache(),
+    )
+
+
+def configure_limits(section: str, url: str) -> None:
+    # Applies the optional LIMITS of a config section to the host of `url` on the shared transport
+    limits = get_config(section).get("LIMITS")
+    if limits:
+        get_http_transport().set_limits(
+            url, rate=limits.get("RATE"), burst=limits.get("BURST"), retries=limits.get("RETRIES")
+        )
+
+
+@lru_cache(maxsize=None)
+def get_mutation_queue():
+    # None unless the queue section turns it on
+    from utilcli.modules.MutationQueue import MutationQueue
+
+    queue_config = get_config("queue", required=False)
+    if not queue_config.get("ENABLED", False):
+        return None
+    return MutationQueue(
+        get_app_dir() / "mutation_queue.sqlite3",
+        max_attempts=queue_config.get("MAX_ATTEMPTS", 8),
+        retry_delay=queue_config.get("RETRY_DELAY", 5),
+    )
 
 
-try:
-    CONFIG = load_config()
-except Exception as e:
-    typer.echo(e)
-    quit(code=1)
+def start_flusher() -> None:
+    # Starts a detached `util queue flush --wait` unless a flusher looked at the queue recently
+    queue = get_mutation_queue()
+    seen = queue.flusher_seen()
+    if seen is not None and time.time() - seen < 30:
+        return
+    # Counts as seen right away so commands queued in the meantime don't start flushers of their own
+    queue.heartbeat()
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.argv[0] = 'util'; from utilcli.daemon import main; main()",
+            *("queue", "flush", "--wait", "--quiet"),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )